@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象庁のページを並行して取得するための仕組み
+#              - TokenBucket: プロセス全体で共有するリクエスト数の上限
+#                (rate件/秒、最大burst件まで連続可)
+#              - fetch_map: 同時実行数を制限したスレッドプールで関数を実行し、
+#                結果を入力と同じ順序で返す
+#              - Coalescer: 同じキーの処理が実行中の場合は、新たに実行せずに
+#                実行中の処理の結果を待って返す(同じページの重複取得を防ぐ)
+#              - RetryPolicy: 失敗した取得を、待ち時間を指数的に延ばしながら
+#                (ゆらぎ付き)リトライする
+#              - CircuitBreaker: ホスト毎に連続して失敗した回数を数え、
+#                一定回数を超えたら一定時間そのホストへの要求を止める
+# environment:
+#   WEATHER_RATE: 1秒あたりのリクエスト数の上限 既定値は1.0
+#   WEATHER_BURST: 連続して送信できるリクエスト数 既定値は1
+#   WEATHER_WORKERS: 同時に実行するリクエスト数の上限 既定値は4
+#   WEATHER_RETRY_TRIES: 1件の取得の試行回数(初回を含む) 既定値は4
+#   WEATHER_RETRY_BASE: 1回目のリトライまでの待ち時間(秒) 既定値は1.0
+#                       以降は2倍ずつ延ばす
+#   WEATHER_RETRY_MAX: リトライまでの待ち時間の上限(秒) 既定値は30
+#   WEATHER_BREAKER_FAILURES: 要求を止めるまでの連続失敗回数 既定値は5
+#   WEATHER_BREAKER_RESET: 要求を止める時間(秒) 既定値は30
+#   WEATHER_FAILURE_BUDGET: 出力ファイル毎に、ページを取得できなくても
+#                           処理を続ける日数(超えた場合は異常終了)
+#                           既定値は20
+
+# --基本モジュール--
+import http.client
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+
+# 変数定義
+default_rate = 1.0
+default_burst = 1
+default_workers = 4
+default_tries = 4
+default_retry_base = 1.0
+default_retry_max = 30.0
+default_breaker_failures = 5
+default_breaker_reset = 30.0
+default_failure_budget = 20
+# リトライしないHTTPのステータス(408、429以外の4xx)
+retry_status = (408, 429)
+
+
+class CircuitOpen(Exception):
+    '''ホストへの要求を止めている間の例外(remaining: 再開までの秒数)'''
+
+    def __init__(self, host, remaining):
+        Exception.__init__(self, "circuit is open: " + str(host))
+        self.host = host
+        self.remaining = remaining
+
+
+class FailureBudgetExceeded(Exception):
+    '''取得できなかった日数が上限を超えた場合の例外'''
+    pass
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate must be positive: " + str(rate))
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # トークンを1つ取得する。無い場合は補充されるまで待つ
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1.0:
+                    self.tokens = self.tokens - 1.0
+                    return
+                wait = (1.0 - self.tokens)/self.rate
+            time.sleep(wait)
+
+
+class Coalescer(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # キー: [完了イベント, 結果, 例外]
+
+    def call(self, key, func):
+        # func()を実行して結果を返す。同じkeyのfuncが他のスレッドで実行中の
+        # 場合は、その完了を待って同じ結果(例外の場合は同じ例外)を返す
+        with self.lock:
+            call = self.calls.get(key)
+            owner = call is None
+            if owner:
+                call = [threading.Event(), None, None]
+                self.calls[key] = call
+        if not owner:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = func()
+            return call[1]
+        except BaseException as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, failures=default_breaker_failures,
+                 reset=default_breaker_reset):
+        self.failures = failures
+        self.reset = reset
+        self.lock = threading.Lock()
+        self.counts = {}  # ホスト: 連続して失敗した回数
+        self.opened = {}  # ホスト: 要求を止めた時刻
+        self.trial = set()  # 再開を試している(1件だけ要求中の)ホスト
+
+    def check(self, host):
+        # 要求を止めている場合はCircuitOpenとする
+        # 止めてからreset秒経過した後は、1件だけ要求を通して様子を見る
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return
+            remaining = opened + self.reset - time.monotonic()
+            if (remaining > 0) or (host in self.trial):
+                raise CircuitOpen(host, max(remaining, 0.0))
+            self.trial.add(host)
+
+    def record(self, host, ok):
+        with self.lock:
+            self.trial.discard(host)
+            if ok:
+                self.counts.pop(host, None)
+                self.opened.pop(host, None)
+                return
+            self.counts[host] = self.counts.get(host, 0) + 1
+            if self.counts[host] >= self.failures:
+                self.opened[host] = time.monotonic()
+
+
+class RetryPolicy(object):
+
+    def __init__(self, tries=default_tries, base=default_retry_base,
+                 max_wait=default_retry_max, breaker=None):
+        self.tries = max(1, int(tries))
+        self.base = base
+        self.max_wait = max_wait
+        self.breaker = breaker
+
+    def wait_time(self, attempt):
+        # attempt回目(0始まり)の失敗後の待ち時間
+        # 上限の半分を必ず待ち、残りの半分はランダムとする(同時に失敗した
+        # 要求が同じ時刻にリトライしないように)
+        cap = min(self.max_wait, self.base*(2**attempt))
+        return cap/2.0 + random.uniform(0, cap/2.0)
+
+    def call(self, url, func, on_retry=None):
+        # func()を実行して結果を返す。リトライしても失敗した場合は最後の例外
+        # on_retry(回数, 例外, 待ち時間, url)はリトライの前に呼ぶ
+        host = urlsplit(url).netloc
+        for attempt in range(self.tries):
+            try:
+                if self.breaker is not None:
+                    self.breaker.check(host)
+                result = func()
+            except CircuitOpen as e:
+                err = e
+                wait = min(self.max_wait,
+                           max(e.remaining, self.wait_time(attempt)))
+            except Exception as e:
+                retryable = is_retryable(e)
+                if self.breaker is not None:
+                    # 404等はサーバが応答しているため、失敗として数えない
+                    self.breaker.record(host, not retryable)
+                if not retryable:
+                    raise
+                err = e
+                wait = self.wait_time(attempt)
+            else:
+                if self.breaker is not None:
+                    self.breaker.record(host, True)
+                return result
+            if attempt == self.tries - 1:
+                raise err
+            if on_retry is not None:
+                on_retry(attempt + 1, err, wait, url)
+            time.sleep(wait)
+
+
+# 関数定義
+def is_retryable(e):
+    # 通信の失敗(タイムアウト、接続の切断、5xxなど)はリトライする
+    if isinstance(e, HTTPError):
+        return (e.code >= 500) or (e.code in retry_status)
+    return isinstance(e, (OSError, http.client.HTTPException))
+
+
+def fetch_map(func, items, workers=None):
+    # func(item)を最大workers並列で実行し、結果をitemsの順序で返す
+    # 1件でも例外となった場合は、その例外を送出する
+    if workers is None:
+        workers = get_default_workers()
+    items = list(items)
+    if (workers <= 1) or (len(items) <= 1):
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
+def get_default_workers():
+    return max(1, int(os.environ.get("WEATHER_WORKERS", default_workers)))
+
+
+# 環境変数の設定で生成したTokenBucket(プロセス内の全リクエストで共有)
+_default_bucket = []
+_default_lock = threading.Lock()
+
+
+def get_default_bucket():
+    with _default_lock:
+        if len(_default_bucket) == 0:
+            _default_bucket.append(TokenBucket(
+                float(os.environ.get("WEATHER_RATE", default_rate)),
+                int(os.environ.get("WEATHER_BURST", default_burst))))
+    return _default_bucket[0]
+
+
+# 環境変数の設定で生成したRetryPolicy(ホスト毎の状態をプロセス内で共有)
+_default_retry = []
+
+
+def get_default_retry():
+    with _default_lock:
+        if len(_default_retry) == 0:
+            breaker = CircuitBreaker(
+                int(os.environ.get("WEATHER_BREAKER_FAILURES",
+                                   default_breaker_failures)),
+                float(os.environ.get("WEATHER_BREAKER_RESET",
+                                     default_breaker_reset)))
+            _default_retry.append(RetryPolicy(
+                int(os.environ.get("WEATHER_RETRY_TRIES", default_tries)),
+                float(os.environ.get("WEATHER_RETRY_BASE",
+                                     default_retry_base)),
+                float(os.environ.get("WEATHER_RETRY_MAX",
+                                     default_retry_max)),
+                breaker))
+    return _default_retry[0]
+
+
+def check_failure_budget(gaps, budget=None):
+    # gaps(取得できなかった日のリスト)が上限を超えた場合は
+    # FailureBudgetExceededとする
+    if budget is None:
+        budget = int(os.environ.get("WEATHER_FAILURE_BUDGET",
+                                    default_failure_budget))
+    if len(gaps) > budget:
+        raise FailureBudgetExceeded(
+            "number of failed days exceeds the budget: " + str(len(gaps))
+            + " > " + str(budget))
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象庁・heartrailsのページを取得するHTTPクライアント
+#              (urllib.request.urlopenの代わりに使用する)
+#              - 接続をホスト毎に保持して再利用する(keep-alive)
+#              - gzip/deflateで圧縮された応答を受け取って展開する
+#              - get_revalidated: 前回の応答のETag/Last-Modifiedを保存して
+#                おき、次回はIf-None-Match/If-Modified-Sinceを付けて要求する
+#                (変更が無い場合(304)は保存した内容を返す)
+# environment:
+#   WEATHER_HTTP_TIMEOUT: 接続・応答待ちのタイムアウト(秒) 既定値は30
+#   WEATHER_HTTP_POOL: ホスト毎に保持する接続の数 既定値は8
+
+# --基本モジュール--
+import gzip
+import http.client
+import os
+import threading
+import zlib
+from collections import namedtuple
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin
+
+from metrics import get_metrics
+from page_cache import CacheMiss
+
+
+# 変数定義
+default_timeout = 30.0
+default_pool_size = 8
+max_redirects = 5
+user_agent = "weather_get/1.0 (+http.client)"
+redirect_status = (301, 302, 303, 307, 308)
+# 再利用した接続がサーバ側で切断されていた場合の例外(新しい接続で再送する)
+stale_errors = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                ConnectionResetError, BrokenPipeError)
+
+Response = namedtuple("Response", [
+    "url",      # 最終的なURL(リダイレクト後)
+    "status",   # ステータスコード
+    "headers",  # ヘッダ(http.client.HTTPMessage)
+    "body",     # 内容(bytes、展開済み)
+])
+
+
+# 関数定義
+def decode_body(body, encoding):
+    encoding = (encoding or "").strip().lower()
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+class HttpPool(object):
+
+    def __init__(self, timeout=default_timeout, pool_size=default_pool_size):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.idle = {}  # (scheme, host:port): [接続, ...]
+
+    def get_conn(self, key):
+        # 戻り値: (接続, 再利用した接続の場合True)
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+        get_metrics().add("http_connections")
+        conn_class = http.client.HTTPSConnection if key[0] == "https" \
+            else http.client.HTTPConnection
+        return conn_class(key[1], timeout=self.timeout), False
+
+    def release(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.pool_size:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def send(self, url, headers):
+        # 1回の要求(リダイレクトはたどらない)
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path = path + "?" + parts.query
+        req_headers = {"Accept-Encoding": "gzip, deflate",
+                       "User-Agent": user_agent}
+        req_headers.update(headers or {})
+        while True:
+            conn, reused = self.get_conn(key)
+            try:
+                conn.request("GET", path, headers=req_headers)
+                res = conn.getresponse()
+                body = res.read()
+            except stale_errors:
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            break
+        if res.will_close:
+            conn.close()
+        else:
+            self.release(key, conn)
+        get_metrics().add("http_wire_bytes", len(body))
+        body = decode_body(body, res.getheader("Content-Encoding"))
+        return Response(url, res.status, res.msg, body)
+
+    def request(self, url, headers=None):
+        # リダイレクトをたどって応答を返す
+        # 304(変更なし)はそのまま返し、400以上はHTTPErrorとする
+        for _ in range(max_redirects + 1):
+            res = self.send(url, headers)
+            if res.status in redirect_status:
+                url = urljoin(url, res.headers.get("Location", ""))
+                continue
+            if res.status >= 400:
+                raise HTTPError(url, res.status, "HTTP status "
+                                + str(res.status), res.headers, None)
+            return res
+        raise HTTPError(url, res.status, "too many redirects", res.headers,
+                        None)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
+# 環境変数の設定で生成した接続プール(プロセス内で共有)
+_default_pool = []
+_default_lock = threading.Lock()
+
+
+def get_default_pool():
+    with _default_lock:
+        if len(_default_pool) == 0:
+            _default_pool.append(HttpPool(
+                float(os.environ.get("WEATHER_HTTP_TIMEOUT",
+                                     default_timeout)),
+                int(os.environ.get("WEATHER_HTTP_POOL", default_pool_size))))
+    return _default_pool[0]
+
+
+def get(url, headers=None):
+    # 戻り値: 内容(bytes)
+    return get_default_pool().request(url, headers).body
+
+
+def get_revalidated(url, cache=None):
+    # 戻り値: 内容(bytes)
+    # cache(page_cache.PageCache)に前回の内容がある場合は、条件付きで要求し、
+    # 変更が無ければ前回の内容を返す。cacheがNoneの場合は常に取得する
+    if cache is None:
+        return get(url)
+    saved = cache.get_validated(url)
+    headers = {}
+    if saved is not None:
+        if cache.offline:
+            return saved[2]
+        if saved[0]:
+            headers["If-None-Match"] = saved[0]
+        if saved[1]:
+            headers["If-Modified-Since"] = saved[1]
+    elif cache.offline:
+        raise CacheMiss("page is not cached: " + url)
+    res = get_default_pool().request(url, headers)
+    if (res.status == 304) and (saved is not None):
+        get_metrics().add("not_modified")
+        return saved[2]
+    cache.put_validated(url, res.headers.get("ETag"),
+                        res.headers.get("Last-Modified"), res.body)
+    return res.body
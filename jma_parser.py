@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象庁の1時間毎の値のページ(hourly_s1/hourly_a1)の表を
+#              pandas.read_htmlを使用せずに読み込む
+#              (日毎の値(daily_s1/daily_a1)・月毎の値(monthly_s1/monthly_a1)
+#              のページも同じ形式。0列目は日・月になる)
+#              - parse_hourly: 表の見出し行と24時間分のデータ行を、数値の配列
+#                (values)と品質情報の配列(flags)に分けて返す
+#              - stack_hourly: 複数日の表を、日付の配列とともに1つの配列に
+#                まとめる
+#              - gap_hourly: ページを取得できなかった日の代わりの表(全て欠損)
+# flags:
+#   品質情報(記号)は、値から取り除かずにflagsに以下のコードで保持する
+#   FLAG_OK(0):            正常値
+#   FLAG_QUASI(1):         ")" 準正常値(値は有効)
+#   FLAG_INSUFFICIENT(2):  "]" 資料不足値(値は有効)
+#   FLAG_NO_PHENOMENON(3): "--" 該当現象なし(値は0)
+#   FLAG_BOUNDARY(4):      "0+"/"10-" 雲量の境界値(値は0/10)
+#   FLAG_MISSING(5):       "×" 欠測(値はNaN)
+#   FLAG_NOT_OBSERVED(6):  "///" 観測していない(値はNaN)
+#   FLAG_DOUBTFUL(7):      "#" 疑問値(値はNaN)
+#   FLAG_ASTERISK(8):      "*" (値はNaN)
+#   FLAG_EMPTY(9):         空欄(値はNaN)
+#   FLAG_TEXT(10):         風向・天気など数値でない値(値はNaN、textに保持)
+#                          ")"/"]"が付いた場合は、記号を除いてtextに保持し、
+#                          品質情報はFLAG_QUASI/FLAG_INSUFFICIENT(値はNaN)
+#   FLAG_GAP(11):          ページを取得できなかった(値はNaN、後で再取得する)
+
+# --基本モジュール--
+import numpy as np
+import re
+from collections import namedtuple
+from html import unescape
+
+
+# 変数定義
+FLAG_OK = 0
+FLAG_QUASI = 1
+FLAG_INSUFFICIENT = 2
+FLAG_NO_PHENOMENON = 3
+FLAG_BOUNDARY = 4
+FLAG_MISSING = 5
+FLAG_NOT_OBSERVED = 6
+FLAG_DOUBTFUL = 7
+FLAG_ASTERISK = 8
+FLAG_EMPTY = 9
+FLAG_TEXT = 10
+FLAG_GAP = 11
+
+# 記号そのものの値 (値, 品質情報)
+symbol_table = {
+    "--": (0.0, FLAG_NO_PHENOMENON),
+    "0+": (0.0, FLAG_BOUNDARY),
+    "10-": (10.0, FLAG_BOUNDARY),
+    "×": (np.nan, FLAG_MISSING),
+    "///": (np.nan, FLAG_NOT_OBSERVED),
+    "#": (np.nan, FLAG_DOUBTFUL),
+    "*": (np.nan, FLAG_ASTERISK),
+    "": (np.nan, FLAG_EMPTY),
+}
+# 値の後ろに付く記号
+suffix_table = {
+    ")": FLAG_QUASI,
+    "]": FLAG_INSUFFICIENT,
+}
+
+table_re = re.compile(r'<table[^>]*id="tablefix1"[^>]*>(.*?)</table>',
+                      re.S | re.I)
+table_re2 = re.compile(r'<table[^>]*class="data2_s"[^>]*>(.*?)</table>',
+                       re.S | re.I)
+row_re = re.compile(r'<tr[^>]*>(.*?)</tr>', re.S | re.I)
+cell_re = re.compile(r'<(t[dh])[^>]*>(.*?)</t[dh]>', re.S | re.I)
+img_alt_re = re.compile(r'<img[^>]*alt="([^"]*)"', re.I)
+tag_re = re.compile(r'<[^>]+>')
+space_re = re.compile(r'\s+')
+
+HourlyTable = namedtuple("HourlyTable", [
+    "header",   # 見出し行(文字列のリストのリスト)
+    "hours",    # 時(int、1〜24) ※日毎の値は日、月毎の値は月
+    "values",   # 値(float64、行数×(列数-1)) ※0列目(時)は含まない
+    "flags",    # 品質情報(uint8、valuesと同じ形)
+    "text",     # 元の文字列(object、行数×列数) ※0列目(時)を含む
+                # 値の後ろの記号(")"/"]")は除く
+])
+
+HourlyStack = namedtuple("HourlyStack", [
+    "days",     # 日付(datetime64[D]、行数) ※各行のページの日付
+    "hours",    # 時(int、1〜24) ※日毎の値は日、月毎の値は月
+    "values",   # 値(float64、行数×列数)
+    "flags",    # 品質情報(uint8、valuesと同じ形)
+    "text",     # 元の文字列(object、valuesと同じ形)
+    "cols",     # 各列の元の表での列番号(1始まり、0列目は時)、または
+                # 列名(page_layoutsで形式を判定した場合)
+    "text_cols",  # 各列が数値でない値の列か(boolのリスト、形式から判定)
+                  # 形式が不明な場合はNone
+])
+
+
+# 関数定義
+def cell_text(html):
+    # セルの文字列を取得する。画像(天気)の場合はalt属性の文字列
+    text = unescape(tag_re.sub("", html)).strip()
+    if text == "":
+        alt = img_alt_re.search(html)
+        if alt is not None:
+            text = unescape(alt.group(1)).strip()
+    return text
+
+
+def decode_cell(text):
+    # 戻り値: (値, 品質情報, 値の後ろの記号を除いた文字列)
+    if text in symbol_table:
+        return symbol_table[text] + (text,)
+    flag = FLAG_OK
+    if text[-1] in suffix_table:
+        flag = suffix_table[text[-1]]
+        text = text[:-1].rstrip()
+    try:
+        return float(text), flag, text
+    except ValueError:
+        # 数値でない値は、記号が付いていればその品質情報のまま残す
+        return np.nan, (FLAG_TEXT if flag == FLAG_OK else flag), text
+
+
+def text_cells(values, flags):
+    # 数値でない値(風向・天気など)のセル(boolの配列)
+    # 記号の付いた値は、数値ならvaluesがNaNにならない
+    return (flags == FLAG_TEXT) | (np.isnan(values) & (
+        (flags == FLAG_QUASI) | (flags == FLAG_INSUFFICIENT)))
+
+
+def find_table(html):
+    match = table_re.search(html)
+    if match is None:
+        match = table_re2.search(html)
+    if match is None:
+        raise ValueError("hourly table is not found.")
+    return match.group(1)
+
+
+def parse_hourly(html):
+    # html: ページの内容(str)
+    header = []
+    rows = []
+    for row_html in row_re.findall(find_table(html)):
+        cells = cell_re.findall(row_html)
+        if len(cells) == 0:
+            continue
+        if all(tag.lower() == "th" for tag, _ in cells):
+            # 見出し行は改行等の空白を除いて連結する(例: "気圧(hPa)")
+            header.append([space_re.sub("", cell_text(body))
+                           for _, body in cells])
+        else:
+            rows.append([cell_text(body) for _, body in cells])
+    if len(rows) == 0:
+        raise ValueError("hourly table has no data rows.")
+
+    ncols = max(len(row) for row in rows)
+    text = np.empty((len(rows), ncols), dtype=object)
+    text[:] = ""
+    values = np.empty((len(rows), ncols - 1), dtype=np.float64)
+    flags = np.empty((len(rows), ncols - 1), dtype=np.uint8)
+    hours = np.empty(len(rows), dtype=np.int64)
+    for i, row in enumerate(rows):
+        text[i, 0:len(row)] = row
+        hours[i] = int(row[0])
+        for j in range(1, ncols):
+            values[i, j-1], flags[i, j-1], text[i, j] = \
+                decode_cell(text[i, j])
+    return HourlyTable(header, hours, values, flags, text)
+
+
+def gap_hourly(nrows=24):
+    # 取得できなかった日の表(見出し行はNone、nrows行(1〜nrows)の列の無い行)
+    # stack_hourlyで、全ての列をFLAG_GAPとする
+    text = np.empty((nrows, 1), dtype=object)
+    text[:] = ""
+    return HourlyTable(None, np.arange(1, nrows + 1), np.empty((nrows, 0)),
+                       np.empty((nrows, 0), dtype=np.uint8), text)
+
+
+def stack_hourly(tables, days, cols=None):
+    # tables: HourlyTableのリスト、days: 各表の日付のリスト
+    # cols: 取り出す列番号のリスト(1始まり)。省略時は全ての列
+    #       表によって列数が異なる場合、足りない列は空欄(FLAG_EMPTY)とする
+    #       (gap_hourlyの表はFLAG_GAPとする)
+    ncols = max([table.text.shape[1] for table in tables] + [1])
+    if cols is None:
+        cols = list(range(1, ncols))
+    nrows = [len(table.hours) for table in tables]
+    total = sum(nrows)
+    values = np.full((total, len(cols)), np.nan, dtype=np.float64)
+    flags = np.full((total, len(cols)), FLAG_EMPTY, dtype=np.uint8)
+    text = np.full((total, len(cols)), "", dtype=object)
+    pos = 0
+    for table, n in zip(tables, nrows):
+        if table.header is None:
+            flags[pos:pos+n, :] = FLAG_GAP
+        for j, col in enumerate(cols):
+            if col < table.text.shape[1]:
+                values[pos:pos+n, j] = table.values[:, col-1]
+                flags[pos:pos+n, j] = table.flags[:, col-1]
+                text[pos:pos+n, j] = table.text[:, col]
+        pos = pos + n
+    hours = np.concatenate([table.hours for table in tables]) \
+        if len(tables) > 0 else np.empty(0, dtype=np.int64)
+    days = np.repeat(np.array(days, dtype="datetime64[D]"), nrows)
+    return HourlyStack(days, hours, values, flags, text, list(cols), None)
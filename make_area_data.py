@@ -3,11 +3,23 @@
 # discription: 気象庁で公開されている気象台・観測所の情報を取得する
 # arguments:
 #   argvs[1]: 出力先ディレクトリ
+#   argvs[2]: "refresh"の場合は、前回から内容が変わった都道府県(地方)の
+#             ページだけを読み込む(省略時は全てのページを読み込む)
 # output:
 #   area_data_all.pickle:
 #     全ての気象台・観測所の情報を持つpickleファイル
 #   area_data_temp_valid.pickle:
 #     気温が観測されていて、かつ、現在有効な気象台・観測所のpickleファイル
+#   area_data_temp_valid.reg:
+#     area_data_temp_valid.pickleと同じ内容の登録ファイル(各コマンドは
+#     こちらを読み込む。形式はstation_registry.pyを参照)
+#   area_data_pages.json:
+#     都道府県(地方)のページ毎のハッシュ・観測所の情報と、一覧の版
+#     (次回の"refresh"で使用する)
+#   area_data_versions/area_data_temp_valid.v<版>.reg:
+#     版毎の登録ファイル(生成する毎に版を1ずつ増やす)
+#   area_data_versions/area_data_diff.v<版>.csv:
+#     前の版からの変更(追加・観測終了・移設・削除された観測所)
 #   取得項目
 #   "pref", "area", "proc_no", "block_no", "緯度_経度", "標高",
 #   "ObservatoryType", "雨", "風", "気温", "日射", "雪", "観測終了日"
@@ -17,13 +29,21 @@ import pandas as pd
 import os
 import sys
 
-import time
 import dateutil.parser  # 変数の時間型への変換で使用
 
-import urllib.request
 from bs4 import BeautifulSoup
 import re
 import pickle
+import hashlib
+import json
+from collections import namedtuple, OrderedDict
+
+from fetch_engine import fetch_map, get_default_bucket, get_default_retry, \
+    CircuitOpen
+from metrics import get_metrics, start_run
+from page_cache import get_default_cache
+from station_registry import write_registry, registry_file
+import http_client
 
 
 # ログ用
@@ -34,21 +54,59 @@ cmd = "make_area_data"
 pid = str(os.getpid())
 logfile = "/tmp/"+cmd+"_"+pid+".log"
 logger = getLogger(cmd)
-Fhandler = FileHandler(logfile)
-Fhandler.setLevel(INFO)
-logger.addHandler(Fhandler)
-Shandler = StreamHandler()
-Shandler.setLevel(WARN)
-logger.addHandler(Shandler)
 logger.setLevel(INFO)
+arg_str = ' '.join(map(str, sys.argv))
+
+
+def setup_logger():
+    # コマンドとして実行する場合のみログファイルを作成する
+    Fhandler = FileHandler(logfile)
+    Fhandler.setLevel(INFO)
+    logger.addHandler(Fhandler)
+    Shandler = StreamHandler()
+    Shandler.setLevel(WARN)
+    logger.addHandler(Shandler)
+
+
+def warn_print(msg):
+    d = datetime.datetime.today()
+    logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+def debug_print(msg):
+    d = datetime.datetime.today()
+    logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
 
 
 # 変数定義
-url_com = "http://www.data.jma.go.jp/obd/stats/etrn/select/"
+# 環境変数 WEATHER_JMA_URL で変更可能(weather_get.pyと同じ)
+url_com = os.environ.get("WEATHER_JMA_URL",
+                         "http://www.data.jma.go.jp/obd/stats/etrn/") \
+    + "select/"
 url = url_com + "/prefecture00.php?prec_no=&block_no=&year=&month=&day=&view="
 url1 = url_com + "/prefecture.php?prec_no="
 url2 = "&block_no=&year=&month=&day=&view="
 key = "onmouseover"
+state_file = "area_data_pages.json"
+version_dir = "area_data_versions"
+refresh_flag = "refresh"
+# 観測所を識別する列
+key_cols = ["proc_no", "block_no"]
+open_date = "9999/99/99"
+diff_cols = ["change", "pref", "area", "proc_no", "block_no", "緯度_旧",
+             "経度_旧", "標高_旧", "緯度", "経度", "標高", "観測終了日"]
+area_cols = ["pref", "area", "proc_no", "block_no", "緯度_経度", "標高",
+             "ObservatoryType", "雨", "風", "気温", "日射", "雪", "観測終了日"]
+
+# onmouseover属性の内容
+# viewPoint('種別','block_no','地点名','カナ','緯度(度)','緯度(分)','経度(度)',
+#           '経度(分)','標高','雨','風','気温','日射','雪','終了年','終了月',
+#           '終了日',...)
+AreaRecord = namedtuple("AreaRecord", [
+    "ObservatoryType", "ido", "keido", "elevation", "rain", "wind", "temp",
+    "sun", "snow", "end_date"])
 
 
 # 関数定義
@@ -56,12 +114,298 @@ def datetime_parser(x):
     return dateutil.parser.parse(x)
 
 
+def parse_onmouseover(value):
+    # onmouseover属性を1回だけ分割して、AreaRecordを返す
+    # 形式が想定と異なる場合はValueError/IndexErrorとなる
+    items = re.split("\'\,\'", value)
+    return AreaRecord(
+        ObservatoryType=items[0].split("\'")[1],
+        ido=int(items[4]) + float(items[5])/60.0,
+        keido=int(items[6]) + float(items[7])/60.0,
+        elevation=float(items[8]),
+        rain=items[9], wind=items[10], temp=items[11], sun=items[12],
+        snow=items[13],
+        end_date=str(items[14])+"/"+str(items[15])+"/"+str(items[16]))
+
+
+def get_page(tgt_url):
+    # 戻り値: ページの内容(bytes)
+    # スクレイピング先のサーバに負荷をかけないように、リクエスト数の上限
+    # (既定値は1秒に1件)を守って取得する
+    # キャッシュ(WEATHER_CACHE)に前回の内容がある場合は、変更があった場合
+    # のみ取得する(If-None-Match/If-Modified-Since)
+    # 通信に失敗した場合は、待ち時間を延ばしながらリトライする
+    metrics = get_metrics()
+
+    def get_func():
+        with metrics.timer("rate_wait"):
+            get_default_bucket().acquire()
+        with metrics.timer("fetch"):
+            return http_client.get_revalidated(tgt_url, get_default_cache())
+
+    def log_retry(retry_cnt, err, wait, url):
+        if isinstance(err, CircuitOpen):
+            metrics.add("circuit_open")
+        warn_print("retry scraping (" + str(retry_cnt) + ") after "
+                   + str(round(wait, 1)) + "s: " + repr(err) + " url: "
+                   + url)
+        metrics.add("fetch_retry")
+
+    data = get_default_retry().call(tgt_url, get_func, log_retry)
+    metrics.add("fetch_pages")
+    metrics.add("fetch_bytes", len(data))
+    return data
+
+
+def parse_page(data):
+    with get_metrics().timer("parse"):
+        return BeautifulSoup(data, 'html.parser')
+
+
+def get_soup(tgt_url):
+    return parse_page(get_page(tgt_url))
+
+
+def page_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def parse_pref_page(soup2, tmp_pref, tmp_prec_no, area_lists):
+    # 都道府県(地方)のページの各観測所を、列毎のリスト(area_lists)に追加
+    # 戻り値: 形式が想定と異なり、読み飛ばした要素の数
+    skip_cnt = 0
+    for li in soup2.find_all("area",):
+        try:
+            tmp = str(re.split('block_no=', str(li.get("href")))[1])
+            tmp_BN = re.split("&", tmp)[0]
+            rec = parse_onmouseover(li.get(key))
+        except (IndexError, ValueError, TypeError):
+            skip_cnt = skip_cnt + 1
+            continue
+        for col, value in zip(area_cols, [
+                tmp_pref, li.get("alt"), tmp_prec_no, tmp_BN,
+                (rec.ido, rec.keido), rec.elevation, rec.ObservatoryType,
+                rec.rain, rec.wind, rec.temp, rec.sun, rec.snow,
+                rec.end_date]):
+            area_lists[col].append(value)
+    return skip_cnt
+
+
+def get_pref_list():
+    # 地域名・地域コードのリスト [(地域名, prec_no), ...]
+    soup = get_soup(url)
+
+    pref_list = []
+    for li in soup.find_all("area"):
+        tmp1 = li.get("alt")
+        tmp2 = str(re.split('prec_no=', str(li.get("href")))[1])
+        tmp3 = re.split("&", tmp2)[0]
+        pref_list.append((tmp1, tmp3))
+    return pref_list
+
+
+def append_rows(area_lists, rows):
+    # 観測所の行のリストを、列毎のリスト(area_lists)に追加
+    for row in rows:
+        for col, value in zip(area_cols, row):
+            if col == "緯度_経度":
+                value = tuple(value)
+            area_lists[col].append(value)
+
+
+def get_area_lists(pref_list, state=None):
+    # 各観測所の情報を列毎のリストにまとめる
+    # 都道府県(地方)のページは並行して取得する
+    # state: 前回のページの状態(load_page_state) 指定した場合は、内容の
+    #        ハッシュが前回と同じページは読み込まずに前回の情報を使う
+    # 戻り値: (列毎のリスト, 読み飛ばした要素の数, ページの状態,
+    #          読み込んだページの数)
+    pages = fetch_map(lambda pref: get_page(url1 + str(pref[1]) + url2),
+                      pref_list)
+    old_pages = {} if state is None else state.get("pages", {})
+    area_lists = dict((col, []) for col in area_cols)
+    new_pages = OrderedDict()
+    skip_cnt = 0
+    parse_cnt = 0
+    for (tmp_pref, tmp_prec_no), data in zip(pref_list, pages):
+        tmp_hash = page_hash(data)
+        old = old_pages.get(str(tmp_prec_no))
+        if (old is not None) and (old["hash"] == tmp_hash):
+            rows = old["rows"]
+            tmp_skip = old["skipped"]
+        else:
+            page_lists = dict((col, []) for col in area_cols)
+            tmp_skip = parse_pref_page(parse_page(data), tmp_pref,
+                                       tmp_prec_no, page_lists)
+            rows = [list(row) for row in
+                    zip(*[page_lists[col] for col in area_cols])]
+            parse_cnt = parse_cnt + 1
+        append_rows(area_lists, rows)
+        new_pages[str(tmp_prec_no)] = OrderedDict([
+            ("pref", tmp_pref), ("hash", tmp_hash), ("skipped", tmp_skip),
+            ("rows", rows)])
+        skip_cnt = skip_cnt + tmp_skip
+    get_metrics().add("skipped_elements", skip_cnt)
+    get_metrics().add("parsed_pages", parse_cnt)
+    return area_lists, skip_cnt, new_pages, parse_cnt
+
+
+def load_page_state(out_dir):
+    # 前回のページの状態 {"version": 版, "pages": {prec_no: {...}}}
+    # 無い場合はNone
+    path = os.path.join(out_dir, state_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_page_state(out_dir, pages, version):
+    path = os.path.join(out_dir, state_file)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(OrderedDict([("version", version), ("pages", pages)]), f,
+                  ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def state_frame(state):
+    # 前回のページの状態から、全ての観測所のDataFrameを作る
+    area_lists = dict((col, []) for col in area_cols)
+    for page in state["pages"].values():
+        append_rows(area_lists, page["rows"])
+    return make_area_frames(area_lists)[0]
+
+
+def diff_areas(old_DF, new_DF):
+    # 前の版からの変更(1行1観測所、diff_colsの列)
+    # change: added(追加)、closed(観測終了日が設定された)、
+    #         moved(緯度経度・標高が変わった)、removed(ページから削除)
+    old = old_DF.drop_duplicates(key_cols).set_index(key_cols)
+    new = new_DF.drop_duplicates(key_cols).set_index(key_cols)
+    diff_lists = []
+
+    def add_diff(change, key, old_rec, new_rec):
+        rec = new_rec if new_rec is not None else old_rec
+        out = [change, rec["pref"], rec["area"], key[0], key[1]]
+        for tmp in (old_rec, new_rec):
+            if tmp is None:
+                out = out + [None, None, None]
+            else:
+                out = out + [tmp["緯度_経度"][0], tmp["緯度_経度"][1],
+                             tmp["標高"]]
+        diff_lists.append(out + [rec["観測終了日"]])
+
+    for tmp_key, new_rec in new.iterrows():
+        if tmp_key not in old.index:
+            add_diff("added", tmp_key, None, new_rec)
+            continue
+        old_rec = old.loc[tmp_key]
+        if (old_rec["観測終了日"] == open_date) and \
+                (new_rec["観測終了日"] != open_date):
+            add_diff("closed", tmp_key, old_rec, new_rec)
+        elif (tuple(old_rec["緯度_経度"]) != tuple(new_rec["緯度_経度"])) or \
+                (float(old_rec["標高"]) != float(new_rec["標高"])):
+            add_diff("moved", tmp_key, old_rec, new_rec)
+    for tmp_key, old_rec in old.iterrows():
+        if tmp_key not in new.index:
+            add_diff("removed", tmp_key, old_rec, None)
+    diff_DF = pd.DataFrame(diff_lists, columns=diff_cols)
+    return diff_DF.sort_values(key_cols, kind="mergesort") \
+        .reset_index(drop=True)
+
+
+def make_area_frames(area_lists):
+    # 戻り値: (全ての観測所, 気温が観測されていて現在有効な観測所)
+    area_DF = pd.DataFrame(area_lists, columns=area_cols)
+    area_DF = area_DF.drop_duplicates()
+    area_DF.index = range(len(area_DF))
+
+    area_DF2 = area_DF[area_DF["気温"] == "1"].copy()
+    area_DF2 = area_DF2[area_DF2["観測終了日"] == "9999/99/99"]
+    area_DF2.index = range(len(area_DF2))
+    return area_DF, area_DF2
+
+
+def write_area_data(out_dir, area_DF, area_DF2, version=0):
+    out_file1 = out_dir + "/area_data_all.pickle"
+    out_file2 = out_dir + "/area_data_temp_valid.pickle"
+
+    with open(out_file1, 'wb') as f:
+        pickle.dump(area_DF, f)
+    with open(out_file2, 'wb') as f:
+        pickle.dump(area_DF2[area_DF2.columns[0:7]], f)
+    write_registry(out_dir + "/" + registry_file,
+                   area_DF2[area_DF2.columns[0:7]], version=version)
+
+
+def write_version(out_dir, area_DF2, diff_DF, version):
+    # 版毎の登録ファイルと、前の版からの変更(diff_DFがNoneの場合は無し)
+    tmp_dir = os.path.join(out_dir, version_dir)
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    suffix = ".v" + str(version).zfill(4)
+    write_registry(os.path.join(tmp_dir, os.path.splitext(registry_file)[0]
+                                + suffix + ".reg"),
+                   area_DF2[area_DF2.columns[0:7]], version=version)
+    if diff_DF is not None:
+        diff_file = os.path.join(tmp_dir, "area_data_diff" + suffix + ".csv")
+        diff_DF.to_csv(diff_file + ".tmp", index=False)
+        os.replace(diff_file + ".tmp", diff_file)
+
+
+def make_area_data(out_dir, refresh=False):
+    # 気象台・観測所の一覧を生成してout_dirに出力する
+    # refresh: Trueの場合は、前回から内容が変わったページだけを読み込む
+    # 戻り値: 気温が観測されていて現在有効な観測所のDataFrame
+    # 前回のページの状態の読み込み
+    state = load_page_state(out_dir)
+    if refresh and (state is None):
+        warn_print("page state not found. all pages are parsed.")
+
+    # URLからデータ取得し、地域名・地域コードのリストへ変換
+    debug_print("start making pref data.")
+    pref_list = get_pref_list()
+    debug_print("end making pref data. prefs: " + str(len(pref_list)))
+
+    # 各観測所の情報を結合
+    debug_print("start making detail data.")
+    area_lists, skip_cnt, pages, parse_cnt = get_area_lists(
+        pref_list, state if refresh else None)
+    if skip_cnt > 0:
+        warn_print("skipped area elements: " + str(skip_cnt))
+    debug_print("end making detail data. areas: "
+                + str(len(area_lists["area"])) + ", skipped: "
+                + str(skip_cnt) + ", parsed pages: " + str(parse_cnt))
+
+    # データ整形、加工
+    debug_print("start processing data.")
+    area_DF, area_DF2 = make_area_frames(area_lists)
+    version = 1
+    diff_DF = None
+    if state is not None:
+        version = state["version"] + 1
+        diff_DF = diff_areas(state_frame(state), area_DF)
+    debug_print("end processing data. version: " + str(version)
+                + ", changes: "
+                + str(0 if diff_DF is None else len(diff_DF)))
+
+    # pickleファイル・登録ファイルの出力
+    debug_print("start output file.")
+    write_area_data(out_dir, area_DF, area_DF2, version)
+    write_version(out_dir, area_DF2, diff_DF, version)
+    write_page_state(out_dir, pages, version)
+    debug_print("end output file.")
+    return area_DF2[area_DF2.columns[0:7]]
+
+
 # main処理
 if __name__ == '__main__':
 
+    setup_logger()
+    start_run(cmd)
+
     # 引数取得
     argvs = sys.argv
-    arg_str = ' '.join(map(str, argvs))
 
     # ログ関数生成
     def error_exit(code, msg):
@@ -73,16 +417,6 @@ if __name__ == '__main__':
         os.rename(logfile, logfile2)
         sys.exit(code)
 
-    def warn_print(msg):
-        d = datetime.datetime.today()
-        logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
-                    + str(msg)+" command: "+arg_str)
-
-    def debug_print(msg):
-        d = datetime.datetime.today()
-        logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
-                    + str(msg)+" command: "+arg_str)
-
     debug_print("start process.")
 
     # 引数チェック
@@ -93,123 +427,19 @@ if __name__ == '__main__':
     out_dir = str(argvs[1])
     if not os.path.exists(out_dir):
         error_exit(1, "output directory does not exists. [main]")
+    refresh = False
+    if len(argvs) > 2:
+        if str(argvs[2]) != refresh_flag:
+            error_exit(1, "mode is incorrect. [main]")
+        refresh = True
     debug_print("end checking argments.")
 
-    # URLからデータ取得
-    debug_print("start scraping.")
-    try:
-        data = urllib.request.urlopen(url)
-        soup = BeautifulSoup(data, 'html.parser')
-    except:
-        # Webページのスクレイピングに失敗した場合は、1度だけリトライ
-        try:
-            warn_print("failed scraping.")
-            warn_print("retry scraping.")
-            time.sleep(1)
-            data = urllib.request.urlopen(url)
-            soup = BeautifulSoup(data, 'html.parser')
-        except:
-            error_exit(2, "function error. trace: "
-                       + traceback.format_exc()
-                       + " [urllib.request.urlopen/BeautifulSoup]")
-    debug_print("end scraping.")
-
-    # データフレームへ変換
-    debug_print("start making pref data.")
     try:
-        # 地域名・地域コードのデータフレーム
-        pref_DF = pd.DataFrame()
-        for li in soup.find_all("area"):
-            tmp1 = li.get("alt")
-            tmp2 = str(re.split('prec_no=', str(li.get("href")))[1])
-            tmp3 = re.split("&", tmp2)[0]
-            tmp_DF = pd.DataFrame([tmp1, tmp3])
-            pref_DF = pd.concat([pref_DF, tmp_DF.T])
-        pref_DF = pref_DF.reset_index(drop=True)
-    except:
-        error_exit(2, "function error. trace: "
-                   + traceback.format_exc() + " [main]")
-    debug_print("end making pref data.")
-
-    # 各観測所の情報を結合
-    debug_print("start making detail data.")
-    area_DF = pd.DataFrame()
-    for i in range(len(pref_DF)):
-        tmp_pref = pref_DF.ix[i, 0]
-        tmp_prec_no = pref_DF.ix[i, 1]
-
-        url = url1 + str(tmp_prec_no) + url2
-        data = urllib.request.urlopen(url)
-        soup2 = BeautifulSoup(data, 'html.parser')
-
-        tmp_area_DF = pd.DataFrame()
-        for li in soup2.find_all("area",):
-            tmp_area = li.get("alt")
-            tmp = str(re.split('block_no=', str(li.get("href")))[1])
-            tmp_BN = re.split("&", tmp)[0]
-            try:
-                tmp_pos1 = int(re.split("\'\,\'", li.get(key))[4])
-                tmp_pos2 = float(re.split("\'\,\'", li.get(key))[5])
-                tmp_pos3 = int(re.split("\'\,\'", li.get(key))[6])
-                tmp_pos4 = float(re.split("\'\,\'", li.get(key))[7])
-                tmp_pos5 = float(re.split("\'\,\'", li.get(key))[8])
-                tmp_type = re.split("\'\,\'", li.get(key))[0].split("\'")[1]
-                tmp0 = re.split("\'\,\'", li.get(key))[9]
-                tmp1 = re.split("\'\,\'", li.get(key))[10]
-                tmp2 = re.split("\'\,\'", li.get(key))[11]
-                tmp3 = re.split("\'\,\'", li.get(key))[12]
-                tmp4 = re.split("\'\,\'", li.get(key))[13]
-                tmp5 = re.split("\'\,\'", li.get(key))[14]
-                tmp6 = re.split("\'\,\'", li.get(key))[15]
-                tmp7 = re.split("\'\,\'", li.get(key))[16]
-            except:
-                continue
-            ido = tmp_pos1 + tmp_pos2/60.0
-            keido = tmp_pos3 + tmp_pos4/60.0
-            tmp_DF = pd.DataFrame([tmp_pref, tmp_area, tmp_prec_no, tmp_BN,
-                                   (ido, keido), tmp_pos5, tmp_type, tmp0,
-                                   tmp1, tmp2, tmp3, tmp4,
-                                   str(tmp5)+"/"+str(tmp6)+"/"+str(tmp7)])
-            tmp_area_DF = pd.concat([tmp_area_DF, tmp_DF.T])
-
-        area_DF = pd.concat([area_DF, tmp_area_DF])
-
-        # スクレイピング先のサーバに負荷をかけないように念のため
-        time.sleep(1)
-    debug_print("end making detail data.")
-
-    # データ整形、加工
-    debug_print("start processing data.")
-    try:
-        area_DF = area_DF.drop_duplicates()
-        area_DF.columns = ["pref", "area", "proc_no", "block_no",
-                           "緯度_経度", "標高", "ObservatoryType", "雨",
-                           "風", "気温", "日射", "雪", "観測終了日"]
-        area_DF.index = range(len(area_DF))
-
-        area_DF2 = area_DF[area_DF["気温"] == "1"].copy()
-        area_DF2 = area_DF2[area_DF2["観測終了日"] == "9999/99/99"]
-        area_DF2.index = range(len(area_DF2))
-    except:
-        error_exit(2, "function error. trace: "
-                   + traceback.format_exc() + " [main]")
-    debug_print("end processing data.")
-
-    # pickleファイルの出力
-    debug_print('start output file.')
-    try:
-        out_file1 = out_dir + "/area_data_all.pickle"
-        out_file2 = out_dir + "/area_data_temp_valid.pickle"
-
-        with open(out_file1, 'wb') as f:
-            pickle.dump(area_DF, f)
-        with open(out_file2, 'wb') as f:
-            pickle.dump(area_DF2[area_DF2.columns[0:7]], f)
+        make_area_data(out_dir, refresh)
     except:
         error_exit(2, "function error. trace: "
-                   + traceback.format_exc() + " [pickle.dump]")
+                   + traceback.format_exc() + " [make_area_data]")
 
-    debug_print('end output file.')
     debug_print("end process.")
     os.remove(logfile)
 
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 処理の段階(ステージ)毎の所要時間・件数の計測
+#              - Metrics.timer: ステージの回数・合計時間・最大時間を記録する
+#                (with文で使用)
+#              - Metrics.add: 件数(リトライ回数、バイト数など)を加算する
+#              - start_run: コマンドの開始時に呼び出し、終了時(sys.exitを含む)
+#                に計測結果を環境変数で指定したファイルに出力する
+#              ステージ名(weather_get.py等で使用)
+#                geocode: 郵便番号から緯度経度、nearest: 最寄りの観測所の探索、
+#                schema_check: ページの形式のチェック、fetch: ページの取得、
+#                parse: ページの表の読み込み、clean: データ整形、
+#                write: ファイルへの出力
+# environment:
+#   WEATHER_METRICS: 計測結果の出力先のパス(未指定の場合は出力しない)
+#                    拡張子が".prom"の場合はPrometheusのテキスト形式で上書き、
+#                    それ以外はJSON(1行1項目)で追記
+#   WEATHER_PROFILE: cProfileの結果の出力先のパス(未指定の場合は計測しない)
+#   WEATHER_TRACEMALLOC: tracemallocで記録するメモリ割当の上位件数
+#                        (未指定の場合は計測しない)。最大使用量とともに
+#                        WEATHER_METRICSの出力に含める
+
+# --基本モジュール--
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# 変数定義
+metric_prefix = "weather_"
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()  # ステージ名: [回数, 合計秒, 最大秒]
+        self.counters = OrderedDict()  # 名前: 値
+        self.gauges = OrderedDict()  # 名前: 値
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            tmp = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            tmp[0] = tmp[0] + 1
+            tmp[1] = tmp[1] + seconds
+            tmp[2] = max(tmp[2], seconds)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def records(self):
+        # 戻り値: 計測結果のdictのリスト
+        with self.lock:
+            out = [OrderedDict([("stage", stage), ("count", tmp[0]),
+                                ("seconds", round(tmp[1], 6)),
+                                ("max_seconds", round(tmp[2], 6))])
+                   for stage, tmp in self.stages.items()]
+            out = out + [OrderedDict([("counter", name), ("value", value)])
+                         for name, value in self.counters.items()]
+            out = out + [OrderedDict([("gauge", name), ("value", value)])
+                         for name, value in self.gauges.items()]
+        return out
+
+    def write_json_lines(self, path, cmd, extra=None):
+        # 1行1項目で追記する(コマンド名・プロセスID・時刻を付ける)
+        head = OrderedDict([("time", time.strftime("%Y-%m-%d %H:%M:%S")),
+                            ("cmd", cmd), ("pid", os.getpid())])
+        with open(path, "a", encoding="utf-8") as f:
+            for record in self.records() + (extra or []):
+                tmp = OrderedDict(head)
+                tmp.update(record)
+                f.write(json.dumps(tmp, ensure_ascii=False) + "\n")
+
+    def prometheus_text(self, cmd):
+        # 戻り値: Prometheusのテキスト形式の文字列
+        label = 'cmd="' + cmd + '"'
+        families = OrderedDict()  # 名前: (種類, [(ラベル, 値), ...])
+
+        def add_sample(name, kind, tmp_label, value):
+            families.setdefault(metric_prefix + name,
+                                (kind, []))[1].append((tmp_label, value))
+
+        with self.lock:
+            for stage, tmp in self.stages.items():
+                tmp_label = label + ',stage="' + stage + '"'
+                add_sample("stage_seconds_total", "counter", tmp_label,
+                           tmp[1])
+                add_sample("stage_count_total", "counter", tmp_label, tmp[0])
+                add_sample("stage_seconds_max", "gauge", tmp_label, tmp[2])
+            for name, value in self.counters.items():
+                add_sample(name + "_total", "counter", label, value)
+            for name, value in self.gauges.items():
+                add_sample(name, "gauge", label, value)
+        lines = []
+        for name, (kind, samples) in families.items():
+            lines.append("# TYPE " + name + " " + kind)
+            lines.extend(name + "{" + tmp_label + "} " + repr(value)
+                         for tmp_label, value in samples)
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, cmd):
+        # node_exporterのtextfile collectorで読めるように、一時ファイルに
+        # 書き込んでから名前を変更する
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text(cmd))
+        os.replace(path + ".tmp", path)
+
+
+# プロセス全体で共有する計測結果
+_default_metrics = Metrics()
+
+
+def get_metrics():
+    return _default_metrics
+
+
+def start_run(cmd):
+    # 環境変数の設定に応じて、cProfile・tracemallocを開始し、終了時に
+    # 計測結果を出力する
+    profile = None
+    if os.environ.get("WEATHER_PROFILE", "") != "":
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    top_cnt = int(os.environ.get("WEATHER_TRACEMALLOC", "0") or "0")
+    if top_cnt > 0:
+        import tracemalloc
+        tracemalloc.start()
+    atexit.register(finish_run, cmd, profile, top_cnt)
+
+
+def finish_run(cmd, profile=None, top_cnt=0):
+    metrics = get_metrics()
+    extra = []
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(os.environ["WEATHER_PROFILE"])
+    if top_cnt > 0:
+        import tracemalloc
+        metrics.set_gauge("tracemalloc_peak_bytes",
+                          tracemalloc.get_traced_memory()[1])
+        stats = tracemalloc.take_snapshot().statistics("lineno")
+        extra = [OrderedDict([("allocation", str(stat.traceback)),
+                              ("bytes", stat.size), ("count", stat.count)])
+                 for stat in stats[0:top_cnt]]
+        tracemalloc.stop()
+    path = os.environ.get("WEATHER_METRICS", "")
+    if path == "":
+        return
+    if path.endswith(".prom"):
+        metrics.write_prometheus(path, cmd)
+    else:
+        metrics.write_json_lines(path, cmd, extra)
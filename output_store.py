@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 取得した気象データを、型付きの列指向ファイル(Parquet/Feather)
+#              として、観測所・年・月毎に分割して保存する
+#              <root>/set=<列セット>/prec_no=<>/block_no=<>/year=<>/month=<>/
+#                  part-<書き込み時刻>.<parquet|feather>
+#              - append: 新しい日のデータを、既存のファイルを書き換えずに追加
+#                (同じ日時のデータが複数ある場合は、後から追加した方を優先)
+#              - read: 期間を指定して読み込む(年・月のディレクトリと日時の
+#                条件で、必要なファイル・行グループだけを読む)
+#              - 各列の型を観測所毎に_schema.jsonに記録し、全てのファイルを
+#                同じ型で書き込み・読み込みする(風向・天気の列は、値が全て
+#                空欄の月も文字列とする)
+#              - 取得済みの日付の範囲を観測所毎に_coverage.jsonに記録し、
+#                missing_rangesで未取得の日付の範囲を返す
+#                (直近recent_days日以内の日付は、気象庁側で更新される可能性
+#                があるため、取得済みとしない)
+#              - 直近の日付は、取得した時刻と合わせて暫定の範囲として
+#                _provisional.jsonに記録する。取得からprovisional_hours時間
+#                以内はmissing_rangesで取得済みとして扱い(保存先のデータを
+#                使用する)、weather_prefetch.pyが取得し直して置き換える
+#              ※pyarrowが必要
+# environment:
+#   WEATHER_STORE: 保存先ディレクトリ(未指定の場合は保存しない)
+#   WEATHER_STORE_FORMAT: "parquet"(既定値)または"feather"
+#   WEATHER_STORE_PROVISIONAL_HOURS: 直近の日付のデータを使用する時間
+#                                    既定値は24(夜間の取得の間隔)
+
+# --基本モジュール--
+import numpy as np
+import pandas as pd
+import datetime
+import json
+import os
+import time
+from collections import OrderedDict
+
+from page_layouts import text_cols
+
+
+# 変数定義
+time_col = "日時"
+coverage_name = "_coverage.json"
+provisional_name = "_provisional.json"
+schema_name = "_schema.json"
+# 列の型(_schema.jsonに記録する名前)
+column_types = ["timestamp", "float64", "string", "uint8"]
+# 品質情報(jma_parserのFLAG_*)の列名の接頭辞
+flag_prefix = "flag_"
+default_recent_days = 2
+default_provisional_hours = 24.0
+store_formats = {"parquet": "parquet", "feather": "ipc"}
+
+
+# 関数定義
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required for the output store.")
+    return pyarrow
+
+
+def arrow_type(pa, type_name):
+    return {"timestamp": pa.timestamp("ns"), "float64": pa.float64(),
+            "string": pa.string(), "uint8": pa.uint8()}[type_name]
+
+
+def column_type(col, values, known=None):
+    # 列の型(column_types)を決める
+    # known(記録済みの型)がある場合はそれを使う。ただし、数値の列に数値で
+    # ない値が追加された場合は文字列とする(以前のファイルは読み込み時に
+    # 文字列に変換する)
+    col = str(col)
+    if col == time_col:
+        return "timestamp"
+    if col.startswith(flag_prefix):
+        return "uint8"
+    if col in text_cols:
+        return "string"
+    if values.dtype.kind in "biuf":
+        return "float64" if known is None else known
+    # weather_get.process_dataは風向・天気の列をobjectで返す(値が全て空欄
+    # の場合も)。数値の文字列だけの列は数値とする
+    values = values.replace("", np.nan).dropna()
+    try:
+        pd.to_numeric(values)
+    except (ValueError, TypeError):
+        return "string"
+    if (known is None) and (len(values) == 0):
+        return "string"
+    return "float64" if known is None else known
+
+
+def to_typed_frame(out_data, types=None):
+    # weather_get.process_data の結果を、types({列名: 型})の型に変換する
+    # typesを省略した場合は、列毎に型を決める(column_type)
+    typed = pd.DataFrame(index=range(len(out_data)))
+    for col in out_data.columns:
+        values = out_data[col].reset_index(drop=True)
+        type_name = column_type(col, values) if types is None \
+            else types[str(col)]
+        if type_name == "timestamp":
+            typed[str(col)] = pd.to_datetime(values).astype("datetime64[ns]")
+        elif type_name == "uint8":
+            typed[str(col)] = values.values.astype(np.uint8)
+        elif type_name == "string":
+            # 空欄はNone
+            typed[str(col)] = pd.Series(
+                [None if pd.isnull(v) or v == "" else str(v)
+                 for v in values], dtype=object)
+        else:
+            if values.dtype == object:
+                values = values.replace("", np.nan)
+            typed[str(col)] = pd.to_numeric(values).astype(np.float64)
+    return typed
+
+
+def to_date(x):
+    return pd.Timestamp(x).date()
+
+
+def write_json(path, data):
+    # 一時ファイルに書き込んでから名前を変更する
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def merge_ranges(ranges):
+    # 日付の範囲(両端を含む)のリストを、重なり・隣接をまとめて昇順で返す
+    out_ranges = []
+    for start, end in sorted(ranges):
+        if (len(out_ranges) > 0) and \
+                (start <= out_ranges[-1][1] + datetime.timedelta(days=1)):
+            if end > out_ranges[-1][1]:
+                out_ranges[-1] = (out_ranges[-1][0], end)
+        else:
+            out_ranges.append((start, end))
+    return out_ranges
+
+
+def subtract_ranges(start, end, ranges):
+    # [start, end]のうち、rangesに含まれない日付の範囲のリストを返す
+    out_ranges = []
+    tmp_start = start
+    for r_start, r_end in merge_ranges(ranges):
+        if r_end < tmp_start:
+            continue
+        if r_start > end:
+            break
+        if r_start > tmp_start:
+            out_ranges.append((tmp_start,
+                               r_start - datetime.timedelta(days=1)))
+        tmp_start = r_end + datetime.timedelta(days=1)
+    if tmp_start <= end:
+        out_ranges.append((tmp_start, end))
+    return out_ranges
+
+
+class OutputStore(object):
+
+    def __init__(self, root, fmt="parquet", recent_days=default_recent_days,
+                 provisional_hours=default_provisional_hours):
+        if fmt not in store_formats:
+            raise ValueError("unknown store format: " + str(fmt))
+        self.root = root
+        self.fmt = fmt
+        self.recent_days = recent_days
+        self.provisional_hours = provisional_hours
+
+    def coverage(self, set_name, prec_no, block_no):
+        # 取得済みの日付の範囲のリスト [(開始日, 終了日), ...]
+        path = os.path.join(self.station_dir(set_name, prec_no, block_no),
+                            coverage_name)
+        if not os.path.exists(path):
+            return []
+        with open(path, encoding="utf-8") as f:
+            return [(to_date(start), to_date(end))
+                    for start, end in json.load(f)]
+
+    def recent_border(self):
+        # この日付より後は直近の日付(取得済みとしない)
+        return datetime.date.today() - \
+            datetime.timedelta(days=self.recent_days + 1)
+
+    def provisional(self, set_name, prec_no, block_no):
+        # 暫定の範囲のリスト [(開始日, 終了日, 取得時刻(UNIX時刻)), ...]
+        # (直近の日付でなくなった範囲は除く)
+        path = os.path.join(self.station_dir(set_name, prec_no, block_no),
+                            provisional_name)
+        if not os.path.exists(path):
+            return []
+        border = self.recent_border()
+        with open(path, encoding="utf-8") as f:
+            return [(max(to_date(start), border + datetime.timedelta(
+                days=1)), to_date(end), fetched)
+                for start, end, fetched in json.load(f)
+                if to_date(end) > border]
+
+    def add_coverage(self, set_name, prec_no, block_no, start, end):
+        # 直近の日付は取得済みとせず、暫定の範囲として記録する
+        border = self.recent_border()
+        start, end = to_date(start), to_date(end)
+        base_dir = self.station_dir(set_name, prec_no, block_no)
+        os.makedirs(base_dir, exist_ok=True)
+        if start <= min(end, border):
+            ranges = merge_ranges(self.coverage(set_name, prec_no, block_no)
+                                  + [(start, min(end, border))])
+            write_json(os.path.join(base_dir, coverage_name),
+                       [[str(r_start), str(r_end)]
+                        for r_start, r_end in ranges])
+        p_start = max(start, border + datetime.timedelta(days=1))
+        if p_start <= end:
+            # 同じ日付の以前の暫定の範囲は、今回の取得時刻で置き換える
+            entries = []
+            for old_start, old_end, fetched in self.provisional(
+                    set_name, prec_no, block_no):
+                entries.extend(
+                    [str(r_start), str(r_end), fetched]
+                    for r_start, r_end in subtract_ranges(
+                        old_start, old_end, [(p_start, end)]))
+            entries.append([str(p_start), str(end), time.time()])
+            write_json(os.path.join(base_dir, provisional_name),
+                       sorted(entries))
+
+    def schema(self, set_name, prec_no, block_no):
+        # 記録済みの列の型 {列名: 型}(順序は追加した順)。無ければNone
+        path = os.path.join(self.station_dir(set_name, prec_no, block_no),
+                            schema_name)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return OrderedDict((col, type_name)
+                               for col, type_name in json.load(f))
+
+    def update_schema(self, set_name, prec_no, block_no, frame):
+        # frameの列の型を記録済みの型に加えて記録する。戻り値: {列名: 型}
+        known = self.schema(set_name, prec_no, block_no)
+        types = OrderedDict() if known is None else OrderedDict(known)
+        for col in frame.columns:
+            types[str(col)] = column_type(col, frame[col],
+                                          types.get(str(col)))
+        if types == known:
+            return types
+        base_dir = self.station_dir(set_name, prec_no, block_no)
+        os.makedirs(base_dir, exist_ok=True)
+        write_json(os.path.join(base_dir, schema_name), list(types.items()))
+        return types
+
+    def arrow_schema(self, pa, set_name, prec_no, block_no, dataset):
+        # 読み込み時の型(年・月のディレクトリの列を含む)
+        # _schema.jsonが無い場合(以前の保存先)は、各ファイルの型から、
+        # いずれかのファイルで文字列の列は文字列とする
+        types = self.schema(set_name, prec_no, block_no)
+        if types is not None:
+            fields = [(col, arrow_type(pa, type_name))
+                      for col, type_name in types.items()]
+        else:
+            tmp_fields = OrderedDict()
+            for fragment in dataset.get_fragments():
+                for field in fragment.physical_schema:
+                    if (field.name not in tmp_fields) or \
+                            pa.types.is_string(field.type) or \
+                            (field.name in text_cols):
+                        tmp_fields[field.name] = pa.string() \
+                            if field.name in text_cols else field.type
+            fields = list(tmp_fields.items())
+        return pa.schema(fields + [("year", pa.int32()),
+                                   ("month", pa.int32())])
+
+    def missing_ranges(self, set_name, prec_no, block_no, start, end,
+                       provisional=True):
+        # [start, end]のうち、未取得の日付の範囲のリスト
+        # provisional=Trueの場合は、取得からprovisional_hours時間以内の
+        # 暫定の範囲を取得済みとする(Falseの場合は取得し直す)
+        ranges = self.coverage(set_name, prec_no, block_no)
+        if provisional:
+            limit = time.time() - self.provisional_hours*3600
+            ranges = ranges + [
+                (p_start, p_end) for p_start, p_end, fetched
+                in self.provisional(set_name, prec_no, block_no)
+                if fetched >= limit]
+        return subtract_ranges(to_date(start), to_date(end), ranges)
+
+    def station_dir(self, set_name, prec_no, block_no):
+        return os.path.join(self.root, "set=" + str(set_name),
+                            "prec_no=" + str(prec_no),
+                            "block_no=" + str(block_no))
+
+    def append(self, set_name, prec_no, block_no, out_data, start=None,
+               end=None, flag_data=None):
+        # 年・月毎に新しいファイルを追加する。戻り値: 追加したファイルのリスト
+        # start、end(日付)を指定した場合は、その範囲を取得済みとして記録する
+        # flag_data(品質情報)を指定した場合は"flag_<列名>"の列(uint8)に保存
+        # 列の型は、記録済みの型(無ければこのデータ)から決める
+        pa = import_pyarrow()
+        if len(out_data) == 0:
+            if (start is not None) and (end is not None):
+                self.add_coverage(set_name, prec_no, block_no, start, end)
+            return []
+        frame = out_data.reset_index(drop=True)
+        if flag_data is not None:
+            frame = frame.copy()
+            for col in flag_data.columns:
+                frame[flag_prefix + str(col)] = \
+                    flag_data[col].values.astype(np.uint8)
+        types = self.update_schema(set_name, prec_no, block_no, frame)
+        typed = to_typed_frame(frame, types)
+        schema = pa.schema([(str(col), arrow_type(pa, types[str(col)]))
+                            for col in typed.columns])
+        base_dir = self.station_dir(set_name, prec_no, block_no)
+        stamp = "%020d" % time.time_ns() if hasattr(time, "time_ns") \
+            else "%020d" % int(time.time()*1e9)
+        files = []
+        keys = typed[time_col].dt.year*100 + typed[time_col].dt.month
+        for ym, part in typed.groupby(keys.values, sort=True):
+            part_dir = os.path.join(base_dir, "year=" + str(ym//100),
+                                    "month=" + str(ym % 100).zfill(2))
+            os.makedirs(part_dir, exist_ok=True)
+            path = os.path.join(part_dir, "part-" + stamp + "." + self.fmt)
+            table = pa.Table.from_pandas(part.reset_index(drop=True),
+                                         schema=schema, preserve_index=False)
+            # 途中で異常終了しても壊れたファイルを残さないように、一時
+            # ファイルに書き込んでから名前を変更する
+            tmp_path = path + ".tmp"
+            if self.fmt == "parquet":
+                pa.parquet.write_table(table, tmp_path)
+            else:
+                pa.feather.write_feather(table, tmp_path)
+            os.replace(tmp_path, path)
+            files.append(path)
+        # データを書き込んだ後に取得済みの範囲を記録する
+        if (start is not None) and (end is not None):
+            self.add_coverage(set_name, prec_no, block_no, start, end)
+        return files
+
+    def read(self, set_name, prec_no, block_no, start=None, end=None,
+             columns=None, with_flags=False):
+        # start、endは日時(両端を含む)。省略した場合は制限なし
+        # with_flags=Trueの場合は品質情報の列("flag_<列名>")も返す
+        pa = import_pyarrow()
+        base_dir = self.station_dir(set_name, prec_no, block_no)
+        if not os.path.exists(base_dir):
+            return pd.DataFrame()
+        dataset = pa.dataset.dataset(
+            base_dir, format=store_formats[self.fmt], partitioning="hive",
+            exclude_invalid_files=True)
+        # 最初のファイルの型ではなく、記録済みの型で全てのファイルを読む
+        # (ファイルに無い列は空欄)
+        dataset = pa.dataset.dataset(
+            base_dir, format=store_formats[self.fmt], partitioning="hive",
+            exclude_invalid_files=True,
+            schema=self.arrow_schema(pa, set_name, prec_no, block_no,
+                                     dataset))
+
+        cond = None
+        field = pa.dataset.field
+        if start is not None:
+            start = pd.Timestamp(start)
+            cond = (field("year") >= start.year) & \
+                (field(time_col) >= pa.scalar(start.to_pydatetime(),
+                                              pa.timestamp("ns")))
+        if end is not None:
+            end = pd.Timestamp(end)
+            tmp = (field("year") <= end.year) & \
+                (field(time_col) <= pa.scalar(end.to_pydatetime(),
+                                              pa.timestamp("ns")))
+            cond = tmp if cond is None else (cond & tmp)
+
+        names = dataset.schema.names
+        if columns is not None:
+            columns = [time_col] + [str(c) for c in columns
+                                    if str(c) != time_col]
+            if with_flags:
+                columns = columns + [flag_prefix + c for c in columns[1:]
+                                     if flag_prefix + c in names]
+        else:
+            columns = [name for name in names
+                       if (name not in ("year", "month")) and
+                       (with_flags or (not name.startswith(flag_prefix)))]
+        out_data = dataset.to_table(columns=columns,
+                                    filter=cond).to_pandas()
+        # 同じ日時が複数ある場合は後から追加したファイルを優先する
+        # (ファイルはパス順=書き込み順に読まれる)
+        out_data = out_data.drop_duplicates(time_col, keep="last")
+        out_data = out_data.sort_values(time_col, kind="mergesort")
+        return out_data.reset_index(drop=True)
+
+
+# 環境変数の設定で生成した保存先(未指定の場合はNone)
+def get_default_store():
+    root = os.environ.get("WEATHER_STORE", "")
+    if root == "":
+        return None
+    return OutputStore(
+        root, os.environ.get("WEATHER_STORE_FORMAT", "parquet"),
+        provisional_hours=float(os.environ.get(
+            "WEATHER_STORE_PROVISIONAL_HOURS", default_provisional_hours)))
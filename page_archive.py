@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象庁から取得した観測データのページ(HTML)を、圧縮して追記
+#              だけで保管する(ページの形式やデータ整形の処理を変更した場合に、
+#              取得し直さずにweather_reparse.pyで読み込み直すため)
+#              <root>/<ページ種別>/<prec_no>_<block_no>/<年>.pages
+#              - 観測所・年毎のファイルに、ページを1件ずつzlibで圧縮して
+#                追記する(既存の内容は書き換えない)
+#              - 索引(<root>/index.sqlite)に、キー(ページ種別, prec_no,
+#                block_no, 日付)毎の最新のページの位置を記録する
+#              - 前回と同じ内容のページは追記しない
+#              - 索引はページのファイルから作り直せる(rebuild_index)
+#              キーはpage_cacheと同じ(page_cache.page_key)
+# format:
+#   1件のページ: ヘッダ(record_header) + キー(JSON) + ページ(zlib)
+#   record_header: 識別子(b"WXPG")、キーの長さ、ページの長さ(uint32)
+#   キー: [ページ種別, prec_no, block_no, 日付, 取得時刻(UNIX時刻)]
+# environment:
+#   WEATHER_ARCHIVE: 保管先ディレクトリ(未指定の場合は保管しない)
+
+# --基本モジュール--
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+from page_cache import page_key
+
+
+# 変数定義
+index_name = "index.sqlite"
+shard_ext = ".pages"
+record_magic = b"WXPG"
+record_header = struct.Struct("<4sII")
+
+# 索引の1件(pathは保管先ディレクトリからの相対パス)
+ArchiveEntry = namedtuple("ArchiveEntry", [
+    "kind", "prec_no", "block_no", "date", "path", "offset", "size"])
+
+
+# 関数定義
+def shard_path(key):
+    # キーに対応するファイルの相対パス(観測所・年毎)
+    kind, prec_no, block_no, date = key
+    return os.path.join(kind, str(prec_no) + "_" + str(block_no),
+                        date[0:4] + shard_ext)
+
+
+def read_record(path, offset, size):
+    # 戻り値: (キー, ページ(bytes))
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(size)
+    magic, key_len, body_len = record_header.unpack_from(data)
+    if (magic != record_magic) or \
+            (record_header.size + key_len + body_len != size):
+        raise ValueError("broken archive record: " + path + " offset: "
+                         + str(offset))
+    key = json.loads(data[record_header.size:record_header.size + key_len]
+                     .decode("utf-8"))
+    return key, zlib.decompress(data[record_header.size + key_len:])
+
+
+def iter_records(path):
+    # ファイルの先頭から(位置, 長さ, キー)を返す
+    # 途中で壊れている(書き込み中に異常終了した)場合は、そこで終了する
+    offset = 0
+    with open(path, "rb") as f:
+        while True:
+            head = f.read(record_header.size)
+            if len(head) < record_header.size:
+                return
+            magic, key_len, body_len = record_header.unpack(head)
+            if magic != record_magic:
+                return
+            key = f.read(key_len)
+            f.seek(body_len, os.SEEK_CUR)
+            size = record_header.size + key_len + body_len
+            if (len(key) < key_len) or (f.tell() > os.fstat(f.fileno())
+                                        .st_size):
+                return
+            yield offset, size, json.loads(key.decode("utf-8"))
+            offset = offset + size
+
+
+class PageArchive(object):
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(root, index_name),
+                                    check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " kind TEXT, prec_no TEXT, block_no TEXT, date TEXT,"
+            " path TEXT, offset INTEGER, size INTEGER, crc INTEGER,"
+            " fetched REAL, PRIMARY KEY (kind, prec_no, block_no, date))")
+        self.conn.commit()
+
+    def put(self, url, body, tgt_date=None):
+        # ページを追記する。戻り値: 追記した場合True(前回と同じ内容はFalse)
+        key = page_key(url, tgt_date)
+        crc = zlib.crc32(body)
+        now = time.time()
+        key_data = json.dumps(list(key) + [now]).encode("utf-8")
+        data = zlib.compress(body)
+        record = record_header.pack(record_magic, len(key_data), len(data)) \
+            + key_data + data
+        rel_path = shard_path(key)
+        path = os.path.join(self.root, rel_path)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT crc FROM pages WHERE kind=? AND prec_no=?"
+                " AND block_no=? AND date=?", key).fetchone()
+            if (row is not None) and (row[0] == crc):
+                return False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # O_APPENDで1回で書き込む(複数のプロセスが同時に追記しても
+            # ページが混ざらないように)。位置は書き込んだ後の末尾から求める
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, record)
+                offset = os.lseek(fd, 0, os.SEEK_CUR) - len(record)
+            finally:
+                os.close(fd)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?,?,?,?,?,?,?,?,?)",
+                tuple(key) + (rel_path, offset, len(record), crc, now))
+            self.conn.commit()
+        return True
+
+    def get(self, key):
+        # キーの最新のページ(bytes)を返す。無ければNone
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, offset, size FROM pages WHERE kind=?"
+                " AND prec_no=? AND block_no=? AND date=?",
+                tuple(key)).fetchone()
+        if row is None:
+            return None
+        return read_record(os.path.join(self.root, row[0]), row[1],
+                           row[2])[1]
+
+    def shards(self, kinds=None):
+        # 戻り値: 保管しているページの(ページ種別, prec_no, block_no, 年)
+        #         のリスト(kindsを指定した場合は、そのページ種別のみ)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT kind, prec_no, block_no, substr(date, 1, 4)"
+                " FROM pages ORDER BY 1, 2, 3, 4").fetchall()
+        return [tuple(row) for row in rows
+                if (kinds is None) or (row[0] in kinds)]
+
+    def entries(self, kind, prec_no, block_no, start=None, end=None):
+        # 戻り値: 日付(文字列、両端を含む)の範囲のArchiveEntryのリスト
+        #         (日付順、pathは絶対パス)
+        sql = "SELECT kind, prec_no, block_no, date, path, offset, size" \
+            " FROM pages WHERE kind=? AND prec_no=? AND block_no=?"
+        params = [kind, str(prec_no), str(block_no)]
+        if start is not None:
+            sql = sql + " AND date>=?"
+            params.append(str(start)[0:10])
+        if end is not None:
+            sql = sql + " AND date<=?"
+            params.append(str(end)[0:10])
+        with self.lock:
+            rows = self.conn.execute(sql + " ORDER BY date",
+                                     params).fetchall()
+        return [ArchiveEntry(*(row[0:4] + (os.path.join(self.root, row[4]),)
+                               + row[5:7])) for row in rows]
+
+    def rebuild_index(self):
+        # ページのファイルを先頭から読んで索引を作り直す
+        # (同じキーのページが複数ある場合は、後から追記した方を使う)
+        # 戻り値: 索引に登録したページ数
+        with self.lock:
+            self.conn.execute("DELETE FROM pages")
+            for dir_path, _, names in sorted(os.walk(self.root)):
+                for name in sorted(names):
+                    if not name.endswith(shard_ext):
+                        continue
+                    path = os.path.join(dir_path, name)
+                    rel_path = os.path.relpath(path, self.root)
+                    for offset, size, key in iter_records(path):
+                        body = read_record(path, offset, size)[1]
+                        self.conn.execute(
+                            "INSERT OR REPLACE INTO pages"
+                            " VALUES (?,?,?,?,?,?,?,?,?)",
+                            tuple(key[0:4]) + (rel_path, offset, size,
+                                               zlib.crc32(body), key[4]))
+            self.conn.commit()
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# 環境変数の設定で生成した保管先(プロセス内で共有)
+_default_archive = []
+_default_lock = threading.Lock()
+
+
+def get_default_archive():
+    # WEATHER_ARCHIVEが未指定(空文字)の場合はNone(保管しない)を返す
+    with _default_lock:
+        if len(_default_archive) == 0:
+            root = os.environ.get("WEATHER_ARCHIVE", "")
+            _default_archive.append(None if root == "" else PageArchive(root))
+    return _default_archive[0]
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象庁の観測データのページ(HTML)をSQLiteに保存するキャッシュ
+#              キーは(ページ種別, prec_no, block_no, 日付)
+#              - 過去の日付のページは変更されないため、期限なしで保持する
+#              - 直近の日付(recent_days日以内)を含むページは、ttl秒で期限切れ
+#                (日毎の値のページは月末、月毎の値のページは年末までを含む)
+#              - 合計サイズがmax_bytesを超えた場合、最終参照が古い順に削除
+#                (合計サイズはputの度に加算し、上限を超えた時だけ集計し直す)
+#              - offline=True の場合はネットワークにアクセスせず、キャッシュ
+#                に無いページはCacheMissとする
+#              - 日付の無いページ(地域・観測所の一覧)は、URL毎に内容と
+#                ETag/Last-Modifiedを保存する(http_client.get_revalidated)
+# environment:
+#   WEATHER_CACHE: キャッシュファイルのパス(空文字の場合はキャッシュしない)
+#                  既定値は$XDG_CACHE_HOME/weather_data/
+#                  weather_page_cache.sqlite(XDG_CACHE_HOMEが未設定の場合は
+#                  ~/.cache/weather_data/weather_page_cache.sqlite)
+#   WEATHER_CACHE_OFFLINE: "1"の場合、キャッシュのみで処理する
+#   WEATHER_CACHE_MAX_MB: キャッシュの最大サイズ(MB) 既定値は1024
+#   WEATHER_CACHE_TTL: 直近の日付のページの有効期間(秒) 既定値は3600
+
+# --基本モジュール--
+import calendar
+import datetime
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit, parse_qs
+
+
+# 変数定義
+default_name = "weather_page_cache.sqlite"
+default_max_mb = 1024
+default_ttl = 3600
+default_recent_days = 2
+# 削除時は上限の9割まで減らす(削除が頻発しないように)
+evict_ratio = 0.9
+
+
+class CacheMiss(Exception):
+    '''offlineモードでキャッシュにページが無い場合の例外'''
+    pass
+
+
+# 関数定義
+def default_cache_dir():
+    # キャッシュ等を保存する既定のディレクトリ(実行したディレクトリに
+    # よらない)。$XDG_CACHE_HOME/weather_data または ~/.cache/weather_data
+    base_dir = os.environ.get("XDG_CACHE_HOME", "")
+    if base_dir == "":
+        base_dir = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base_dir, "weather_data")
+
+
+def page_key(url, tgt_date=None):
+    # 気象庁のURLからキー(ページ種別, prec_no, block_no, 日付)を生成する
+    # tgt_dateを省略した場合は、URLのyear/month/dayから日付を生成する
+    parts = urlsplit(url)
+    kind = os.path.splitext(os.path.basename(parts.path))[0]
+    query = parse_qs(parts.query)
+
+    def get_q(name, default=""):
+        return query.get(name, [default])[0]
+
+    if tgt_date is None:
+        tgt_date = datetime.date(int(get_q("year", "1")),
+                                 int(get_q("month", "1")),
+                                 int(get_q("day", "1")))
+    return kind, get_q("prec_no"), get_q("block_no"), str(tgt_date)[0:10]
+
+
+def page_last_date(key):
+    # ページに含まれる最後の日(文字列)
+    # 日毎の値(daily_*)のキーの日付は月の1日、月毎の値(monthly_*)は1月1日
+    kind, date_str = key[0], key[3]
+    year, month = int(date_str[0:4]), int(date_str[5:7])
+    if kind.startswith("daily"):
+        return str(datetime.date(year, month,
+                                 calendar.monthrange(year, month)[1]))
+    if kind.startswith("monthly"):
+        return str(datetime.date(year, 12, 31))
+    return date_str
+
+
+class PageCache(object):
+
+    def __init__(self, path, max_bytes=default_max_mb*1024*1024,
+                 ttl=default_ttl, recent_days=default_recent_days,
+                 offline=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.recent_days = recent_days
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " kind TEXT, prec_no TEXT, block_no TEXT, date TEXT,"
+            " body BLOB, size INTEGER, fetched REAL, accessed REAL,"
+            " PRIMARY KEY (kind, prec_no, block_no, date))")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS validated ("
+            " url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT,"
+            " body BLOB, fetched REAL)")
+        self.conn.commit()
+        # 合計サイズ(このプロセスで追加した分を加算する。他のプロセスが
+        # 追加した分は、evictで集計し直した時に反映する)
+        self.total = self.size()
+
+    def is_recent(self, key):
+        # 直近の日付を含むページは、気象庁側で更新される可能性がある
+        border = datetime.date.today() - \
+            datetime.timedelta(days=self.recent_days)
+        return page_last_date(key) >= str(border)
+
+    def get(self, key):
+        # キャッシュにあり、かつ期限内のページ(bytes)を返す。無ければNone
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT body, fetched FROM pages WHERE kind=? AND prec_no=?"
+                " AND block_no=? AND date=?", key).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if (not self.offline) and self.is_recent(key) \
+                    and (now - row[1] > self.ttl):
+                return None
+            self.conn.execute(
+                "UPDATE pages SET accessed=? WHERE kind=? AND prec_no=?"
+                " AND block_no=? AND date=?", (now,) + tuple(key))
+            self.conn.commit()
+        return zlib.decompress(row[0])
+
+    def put(self, key, body):
+        data = zlib.compress(body)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size FROM pages WHERE kind=? AND prec_no=?"
+                " AND block_no=? AND date=?", tuple(key)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?,?,?,?,?,?,?,?)",
+                tuple(key) + (sqlite3.Binary(data), len(data), now, now))
+            self.conn.commit()
+            self.total = self.total + len(data) - \
+                (0 if row is None else row[0])
+            over = self.total > self.max_bytes
+        if over:
+            self.evict()
+
+    def get_validated(self, url):
+        # 戻り値: (ETag, Last-Modified, ページ(bytes))。無ければNone
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, body FROM validated"
+                " WHERE url=?", (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], zlib.decompress(row[2])
+
+    def put_validated(self, url, etag, last_modified, body):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO validated VALUES (?,?,?,?,?)",
+                (url, etag, last_modified,
+                 sqlite3.Binary(zlib.compress(body)), time.time()))
+            self.conn.commit()
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def evict(self):
+        # 合計サイズが上限を超えた場合、最終参照が古いページから削除する
+        removed = 0
+        with self.lock:
+            total = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            self.total = total
+            if total <= self.max_bytes:
+                return 0
+            target = total - int(self.max_bytes*evict_ratio)
+            rows = self.conn.execute(
+                "SELECT kind, prec_no, block_no, date, size FROM pages"
+                " ORDER BY accessed").fetchall()
+            for row in rows:
+                if target <= 0:
+                    break
+                self.conn.execute(
+                    "DELETE FROM pages WHERE kind=? AND prec_no=?"
+                    " AND block_no=? AND date=?", row[0:4])
+                target = target - row[4]
+                self.total = self.total - row[4]
+                removed = removed + 1
+            self.conn.commit()
+        return removed
+
+    def fetch(self, url, fetch_func, tgt_date=None):
+        # キャッシュにあればそれを、無ければfetch_func(url)で取得して保存
+        # 戻り値: (ページ(bytes), ネットワークから取得した場合True)
+        key = page_key(url, tgt_date)
+        body = self.get(key)
+        if body is not None:
+            return body, False
+        if self.offline:
+            raise CacheMiss("page is not cached: " + str(key))
+        body = fetch_func(url)
+        self.put(key, body)
+        return body, True
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# 環境変数の設定で生成したキャッシュ(プロセス内で共有)
+_default_cache = []
+_default_lock = threading.Lock()
+
+
+def get_default_cache():
+    # WEATHER_CACHEが空文字の場合はNone(キャッシュしない)を返す
+    with _default_lock:
+        if len(_default_cache) == 0:
+            path = os.environ.get("WEATHER_CACHE")
+            if path is None:
+                path = os.path.join(default_cache_dir(), default_name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            cache = None
+            if path != "":
+                cache = PageCache(
+                    path,
+                    max_bytes=int(float(os.environ.get(
+                        "WEATHER_CACHE_MAX_MB", default_max_mb))*1024*1024),
+                    ttl=float(os.environ.get("WEATHER_CACHE_TTL",
+                                             default_ttl)),
+                    offline=os.environ.get("WEATHER_CACHE_OFFLINE",
+                                           "") == "1")
+            _default_cache.append(cache)
+    return _default_cache[0]
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象庁の気象データのページの形式(見出し行)の登録と判定
+#              取得した各ページの見出し行から形式を判定し、その形式の列を
+#              共通の列名(観測所の種別・データの単位毎)の順に並べ替える
+#              (形式を確認するためだけにページを取得する必要が無い)
+#              - match_layout: 表(jma_parser.HourlyTable)の形式を返す
+#              - align_tables: 複数の表を共通の列名の順にそろえる
+#                (形式によって無い列は空欄、品質情報はFLAG_NOT_OBSERVED)
+#              過去の形式のページがある場合は、layoutsに形式を追加する
+# layouts:
+#   (観測所の種別, データの単位): 形式(Layout)のリスト
+#   種別: "s"(気象台)、"a"(その他の観測所)
+#   単位: "hourly"(1時間毎)、"daily"(日毎)、"monthly"(月毎)
+
+# --基本モジュール--
+import numpy as np
+from collections import namedtuple
+
+from jma_parser import HourlyTable, FLAG_NOT_OBSERVED
+
+
+# 変数定義
+time_col = "日時"
+
+Layout = namedtuple("Layout", [
+    "name",        # 形式の名前
+    "family",      # (観測所の種別, データの単位)
+    "header",      # 見出し行(文字列のリストのリスト、空欄の列は含まない)
+    "columns",     # 各列(0列目の時・日・月を除く)の共通の列名
+])
+
+# 共通の列名((観測所の種別, データの単位)毎、0列目は"日時")
+canonical_cols = {
+    ("s", "hourly"): [
+        "日時", "気圧hPa_現地", "気圧hPa_海面", "降水量mm", "気温℃",
+        "露点温度℃", "蒸気圧hPa", "湿度％", "風速m／s", "風向", "日照時間h",
+        "全天日射量MJ／㎡", "雪cm_降雪", "雪cm_積雪", "天気", "雲量",
+        "視程km"],
+    ("a", "hourly"): [
+        "日時", "降水量mm", "気温℃", "風速m／s", "風向", "日照時間h",
+        "雪cm_降雪", "雪cm_積雪"],
+    ("s", "daily"): [
+        "日時", "気圧hPa_現地平均", "気圧hPa_海面平均", "降水量mm_合計",
+        "降水量mm_最大1時間", "降水量mm_最大10分間", "気温℃_平均",
+        "気温℃_最高", "気温℃_最低", "湿度％_平均", "湿度％_最小",
+        "風速m／s_平均", "風速m／s_最大", "風向_最大", "風速m／s_最大瞬間",
+        "風向_最大瞬間", "風向_最多", "日照時間h", "雪cm_降雪合計",
+        "雪cm_最深積雪", "天気概況_昼", "天気概況_夜"],
+    ("a", "daily"): [
+        "日時", "降水量mm_合計", "降水量mm_最大1時間", "降水量mm_最大10分間",
+        "気温℃_平均", "気温℃_最高", "気温℃_最低", "風速m／s_平均",
+        "風速m／s_最大", "風向_最大", "風速m／s_最大瞬間", "風向_最大瞬間",
+        "風向_最多", "日照時間h", "雪cm_降雪合計", "雪cm_最深積雪"],
+    ("s", "monthly"): [
+        "日時", "気圧hPa_現地平均", "気圧hPa_海面平均", "降水量mm_合計",
+        "降水量mm_日最大", "降水量mm_最大1時間", "降水量mm_最大10分間",
+        "気温℃_日平均", "気温℃_日最高平均", "気温℃_日最低平均",
+        "気温℃_最高", "気温℃_最低", "蒸気圧hPa_平均", "湿度％_平均",
+        "湿度％_最小", "風速m／s_平均", "風速m／s_最大", "風向_最大",
+        "風速m／s_最大瞬間", "風向_最大瞬間", "日照時間h",
+        "全天日射量MJ／㎡_平均", "雪cm_降雪合計", "雪cm_日降雪最大",
+        "雪cm_最深積雪", "雲量_平均"],
+    ("a", "monthly"): [
+        "日時", "降水量mm_合計", "降水量mm_日最大", "降水量mm_最大1時間",
+        "降水量mm_最大10分間", "気温℃_日平均", "気温℃_日最高平均",
+        "気温℃_日最低平均", "気温℃_最高", "気温℃_最低", "風速m／s_平均",
+        "風速m／s_最大", "風向_最大", "風速m／s_最大瞬間", "風向_最大瞬間",
+        "日照時間h", "雪cm_降雪合計", "雪cm_日降雪最大", "雪cm_最深積雪"],
+}
+
+# 数値でない値(風向・天気)の列。値が全て空欄の場合も文字列の列とする
+text_cols = frozenset([
+    "風向", "天気", "風向_最大", "風向_最大瞬間", "風向_最多", "天気概況_昼",
+    "天気概況_夜"])
+
+# 2018/2時点の形式(列は共通の列名と同じ順)
+layouts = {
+    ("s", "hourly"): [Layout("s_hourly_2018", ("s", "hourly"), [
+        ['時', '気圧(hPa)', '降水量(mm)', '気温(℃)', '露点温度(℃)',
+         '蒸気圧(hPa)', '湿度(％)', '風向・風速(m/s)', '日照時間(h)',
+         '全天日射量(MJ/㎡)', '雪(cm)', '天気', '雲量', '視程(km)'],
+        ['現地', '海面', '風速', '風向', '降雪', '積雪']],
+        canonical_cols[("s", "hourly")][1:])],
+    ("a", "hourly"): [Layout("a_hourly_2018", ("a", "hourly"), [
+        ['時', '降水量(mm)', '気温(℃)', '風速・風向(m/s)', '日照時間(h)',
+         '雪(cm)'],
+        ['風速', '風向', '降雪', '積雪']],
+        canonical_cols[("a", "hourly")][1:])],
+    ("s", "daily"): [Layout("s_daily_2018", ("s", "daily"), [
+        ['日', '気圧(hPa)', '降水量(mm)', '気温(℃)', '湿度(％)',
+         '風向・風速(m/s)', '日照時間(h)', '雪(cm)', '天気概況'],
+        ['現地', '海面', '合計', '最大', '平均', '最高', '最低', '平均',
+         '最小', '平均風速', '最大風速', '最大瞬間風速', '最多風向', '降雪',
+         '最深積雪', '昼(06:00-18:00)', '夜(18:00-翌日06:00)'],
+        ['平均', '平均', '1時間', '10分間', '風速', '風向', '風速', '風向',
+         '合計', '値']],
+        canonical_cols[("s", "daily")][1:])],
+    ("a", "daily"): [Layout("a_daily_2018", ("a", "daily"), [
+        ['日', '降水量(mm)', '気温(℃)', '風向・風速(m/s)', '日照時間(h)',
+         '雪(cm)'],
+        ['合計', '最大', '平均', '最高', '最低', '平均風速', '最大風速',
+         '最大瞬間風速', '最多風向', '降雪', '最深積雪'],
+        ['1時間', '10分間', '風速', '風向', '風速', '風向', '合計', '値']],
+        canonical_cols[("a", "daily")][1:])],
+    ("s", "monthly"): [Layout("s_monthly_2018", ("s", "monthly"), [
+        ['月', '気圧(hPa)', '降水量(mm)', '気温(℃)', '蒸気圧(hPa)',
+         '湿度(％)', '風向・風速(m/s)', '日照時間(h)', '全天日射量(MJ/㎡)',
+         '雪(cm)', '雲量'],
+        ['現地', '海面', '合計', '最大', '平均', '最高', '最低', '平均',
+         '平均', '最小', '平均風速', '最大風速', '最大瞬間風速', '平均',
+         '降雪合計', '日降雪最大', '最深積雪', '平均'],
+        ['平均', '平均', '日', '1時間', '10分間', '日平均', '日最高',
+         '日最低', '風速', '風向', '風速', '風向']],
+        canonical_cols[("s", "monthly")][1:])],
+    ("a", "monthly"): [Layout("a_monthly_2018", ("a", "monthly"), [
+        ['月', '降水量(mm)', '気温(℃)', '風向・風速(m/s)', '日照時間(h)',
+         '雪(cm)'],
+        ['合計', '最大', '平均', '最高', '最低', '平均風速', '最大風速',
+         '最大瞬間風速', '降雪合計', '日降雪最大', '最深積雪'],
+        ['日', '1時間', '10分間', '日平均', '日最高', '日最低', '風速',
+         '風向', '風速', '風向']],
+        canonical_cols[("a", "monthly")][1:])],
+}
+
+
+# 関数定義
+def layout_key(header, ncols):
+    # 見出し行と列数(0列目を含む)から、形式を探すためのキー
+    return tuple(tuple(row) for row in header), ncols
+
+
+# キー: 形式(全ての形式から作る)
+_layout_index = {}
+
+
+def register_layout(layout):
+    # 形式を追加する(同じ見出し行・列数の形式は置き換える)
+    if layout.family not in canonical_cols:
+        raise ValueError("layout family unexpected: " + str(layout.family))
+    unknown = set(layout.columns) - set(canonical_cols[layout.family])
+    if len(unknown) > 0:
+        raise ValueError("columns are not canonical: " + str(sorted(unknown)))
+    family_layouts = layouts.setdefault(layout.family, [])
+    if layout not in family_layouts:
+        family_layouts.append(layout)
+    _layout_index[layout_key(layout.header, len(layout.columns) + 1)] = \
+        layout
+
+
+for _family_layouts in list(layouts.values()):
+    for _layout in _family_layouts:
+        register_layout(_layout)
+
+
+def match_layout(table):
+    # 戻り値: 表の形式(Layout)。登録されていない形式の場合はNone
+    if table.header is None:
+        return None
+    return _layout_index.get(layout_key(table.header, table.text.shape[1]))
+
+
+def to_canonical(table, layout, names):
+    # 表の列をnames(共通の列名、"日時"を除く)の順に並べ替える
+    if list(layout.columns) == list(names):
+        return table
+    pos = dict((col, j) for j, col in enumerate(layout.columns))
+    nrows = len(table.hours)
+    values = np.full((nrows, len(names)), np.nan, dtype=np.float64)
+    flags = np.full((nrows, len(names)), FLAG_NOT_OBSERVED, dtype=np.uint8)
+    text = np.full((nrows, len(names) + 1), "", dtype=object)
+    text[:, 0] = table.text[:, 0]
+    for k, col in enumerate(names):
+        j = pos.get(col)
+        if j is None:
+            continue
+        values[:, k] = table.values[:, j]
+        flags[:, k] = table.flags[:, j]
+        text[:, k + 1] = table.text[:, j + 1]
+    return HourlyTable(table.header, table.hours, values, flags, text)
+
+
+def align_tables(tables, names=None):
+    # tables: HourlyTableのリスト(取得できなかった日の表を含む)
+    # names: 共通の列名("日時"を除く)。省略時は最初の形式の共通の列名
+    # 戻り値: (列をそろえた表のリスト, 列名のリスト, 形式が不明な表の番号)
+    #         形式が不明な表は、列数がnamesと同じ場合のみ列の順が同じと
+    #         みなして残し、それ以外の場合はNoneを返す
+    matched = [match_layout(table) for table in tables]
+    unknown = [i for i, (table, layout) in enumerate(zip(tables, matched))
+               if (table.header is not None) and (layout is None)]
+    if names is None:
+        known = [layout for layout in matched if layout is not None]
+        if len(known) == 0:
+            return None
+        names = canonical_cols[known[0].family][1:]
+    for i in unknown:
+        if tables[i].text.shape[1] != len(names) + 1:
+            return None
+    out_tables = [table if layout is None
+                  else to_canonical(table, layout, names)
+                  for table, layout in zip(tables, matched)]
+    return out_tables, list(names), unknown
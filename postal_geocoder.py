@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 郵便番号から緯度経度を求める索引(オフライン版)
+#              日本郵便の郵便番号データ(KEN_ALL.CSV)と、位置(重心)の表から
+#              郵便番号順に並べた配列(NumPyの.npy形式)を生成する
+#              検索は二分探索で行い、見つからない場合は weather_get.py の
+#              heartrails API 呼び出しと同じ順序で郵便番号を変えて探す
+#              1. 下4桁を全て"0"にする
+#              2. 上3桁を"1"ずつ減らしていく(最大20回失敗するまで繰り返す)
+# arguments:
+#   argvs[1]: KEN_ALL.CSVのパス(Shift_JIS、ヘッダ無し)
+#   argvs[2]: 位置の表(CSV)のパス
+#             1行に「コード,緯度,経度」を記載。コードは郵便番号(数字7桁)か、
+#             全国地方公共団体コード(数字5桁、KEN_ALL.CSVの1列目)
+#             郵便番号の位置が無い場合は、市区町村の位置を使用する
+#   argvs[3]: 出力先ディレクトリ
+# output:
+#   post_num_latlng.npy: 郵便番号・緯度・経度の配列(郵便番号順)
+# environment:
+#   WEATHER_POSTAL_INDEX: weather_get.pyが使用する索引のパス
+#                         既定値は"post_num_latlng.npy"(カレントディレクトリ)
+#                         ファイルが無い場合はheartrails APIを使用する
+
+# --基本モジュール--
+import numpy as np
+import csv
+import os
+import sys
+
+
+# 変数定義
+index_name = "post_num_latlng.npy"
+index_dtype = np.dtype([("post", "<i4"), ("lat", "<f8"), ("lng", "<f8")])
+max_retry = 20
+
+
+# 関数定義
+def post_num_candidates(post_num, max_cnt=max_retry):
+    # 検索する郵便番号を順に返す
+    # 1. 下4桁を全て"0"にする
+    # 2. 上3桁を"1"ずつ減らしていく(上3桁が"000"になるか、max_cnt件まで)
+    tmp_post_num = post_num
+    post_num1 = tmp_post_num[0:3]
+    post_num2 = tmp_post_num[3:7]
+    for _ in range(max_cnt):
+        yield tmp_post_num
+        if post_num1 == "000":
+            return
+        if post_num2 == "0000":
+            tmp_post_num = str(int(post_num1)-1).zfill(3) + str(post_num2)
+            post_num1 = tmp_post_num[0:3]
+        else:
+            tmp_post_num = post_num1 + "0000"
+            post_num2 = "0000"
+
+
+class PostalGeocoder(object):
+
+    def __init__(self, table):
+        # table: index_dtypeの配列(郵便番号順に並んでいること)
+        self.table = table
+        self.post = table["post"]
+
+    def __len__(self):
+        return len(self.table)
+
+    def find(self, post_num):
+        # 郵便番号の行番号を返す。無い場合は-1
+        code = int(post_num)
+        i = int(np.searchsorted(self.post, code))
+        if (i < len(self.post)) and (self.post[i] == code):
+            return i
+        return -1
+
+    def lookup(self, post_num):
+        # 戻り値: (実際に見つかった郵便番号, 緯度, 経度)
+        # 見つからない場合はKeyError
+        for tmp_post_num in post_num_candidates(post_num):
+            i = self.find(tmp_post_num)
+            if i >= 0:
+                return (tmp_post_num, float(self.table["lat"][i]),
+                        float(self.table["lng"][i]))
+        raise KeyError("post_num not found: " + str(post_num))
+
+
+def read_centroids(centroid_file):
+    # 戻り値: {コード: (緯度, 経度)}
+    centroids = {}
+    with open(centroid_file, encoding="utf-8-sig") as f:
+        for row in csv.reader(f):
+            if (len(row) < 3) or (not row[0].strip().isdigit()):
+                continue  # ヘッダ行・空行
+            centroids[row[0].strip()] = (float(row[1]), float(row[2]))
+    return centroids
+
+
+def build_table(ken_all_file, centroid_file):
+    centroids = read_centroids(centroid_file)
+    # 同じ郵便番号の複数行(町域違い)は、位置の平均とする
+    sums = {}
+    with open(ken_all_file, encoding="cp932") as f:
+        for row in csv.reader(f):
+            post_num = row[2].strip()
+            pos = centroids.get(post_num)
+            if pos is None:
+                pos = centroids.get(row[0].strip().zfill(5)[0:5])
+            if pos is None:
+                continue
+            tmp = sums.setdefault(int(post_num), [0.0, 0.0, 0])
+            tmp[0] = tmp[0] + pos[0]
+            tmp[1] = tmp[1] + pos[1]
+            tmp[2] = tmp[2] + 1
+
+    table = np.empty(len(sums), dtype=index_dtype)
+    for i, code in enumerate(sorted(sums)):
+        lat_sum, lng_sum, cnt = sums[code]
+        table[i] = (code, lat_sum/cnt, lng_sum/cnt)
+    return table
+
+
+def save_table(table, path):
+    np.save(path, table)
+
+
+def load_table(path):
+    # ファイルをメモリマップして読み込む(全体を読み込まない)
+    table = np.load(path, mmap_mode="r")
+    if table.dtype != index_dtype:
+        raise ValueError("unexpected index format: " + str(table.dtype))
+    return table
+
+
+# 読み込み済みの索引(プロセス内で共有)
+_geocoder_cache = {}
+
+
+def load_postal_geocoder(path=None):
+    # 索引ファイルが無い場合はNoneを返す
+    if path is None:
+        path = os.environ.get("WEATHER_POSTAL_INDEX", index_name)
+    if (path == "") or (not os.path.exists(path)):
+        return None
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _geocoder_cache:
+        _geocoder_cache.clear()
+        _geocoder_cache[key] = PostalGeocoder(load_table(path))
+    return _geocoder_cache[key]
+
+
+# main処理
+if __name__ == '__main__':
+
+    # ログ用
+    import traceback
+    from logging import getLogger, StreamHandler, FileHandler, INFO, WARN
+    import datetime
+    cmd = "postal_geocoder"
+    pid = str(os.getpid())
+    logfile = "/tmp/"+cmd+"_"+pid+".log"
+    logger = getLogger(cmd)
+    Fhandler = FileHandler(logfile)
+    Fhandler.setLevel(INFO)
+    logger.addHandler(Fhandler)
+    Shandler = StreamHandler()
+    Shandler.setLevel(WARN)
+    logger.addHandler(Shandler)
+    logger.setLevel(INFO)
+
+    # 引数取得
+    argvs = sys.argv
+    arg_str = ' '.join(map(str, argvs))
+
+    # ログ関数生成
+    def error_exit(code, msg):
+        d = datetime.datetime.today()
+        logger.error(d.strftime("%Y-%m-%d %H:%M:%S")+" ERROR "+cmd+" - "
+                     + str(msg)+" command: "+arg_str)
+        logfile2 = \
+            "/var/log/"+cmd+"_"+d.strftime("%Y%m%d%H%M%S")+"_"+pid+".log"
+        os.rename(logfile, logfile2)
+        sys.exit(code)
+
+    def debug_print(msg):
+        d = datetime.datetime.today()
+        logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                    + str(msg)+" command: "+arg_str)
+
+    debug_print("start process.")
+
+    # 引数チェック
+    debug_print("start checking argments.")
+    if len(argvs) <= 3:
+        error_exit(1, "number of args is less than expected. [main]")
+
+    ken_all_file = str(argvs[1])
+    centroid_file = str(argvs[2])
+    out_dir = str(argvs[3])
+    if not os.path.exists(out_dir):
+        error_exit(1, "output directory does not exists. [main]")
+    debug_print("end checking argments.")
+
+    # 索引の生成
+    debug_print("start making index.")
+    try:
+        table = build_table(ken_all_file, centroid_file)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [build_table]")
+    if len(table) == 0:
+        error_exit(2, "no post_num has a position. [main]")
+    debug_print("end making index. post_nums: " + str(len(table)))
+
+    # 索引ファイルの出力
+    debug_print('start output file.')
+    try:
+        save_table(table, out_dir + "/" + index_name)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [np.save]")
+    debug_print('end output file.')
+
+    debug_print("end process.")
+    os.remove(logfile)
+
+    sys.exit(0)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 観測所毎に、気象データを要求された回数を日毎に記録する(SQLite)
+#              weather_prefetch.pyで、最近の要求が多い観測所から先に取得する
+#              ために使用する
+#              - record: 観測所の当日の要求回数を加算する
+#              - scores: 直近window_days日の観測所毎の(要求回数, 最終要求日)
+# environment:
+#   WEATHER_DEMAND: 記録ファイルのパス(空文字の場合は記録しない)
+#                   既定値はページのキャッシュと同じディレクトリ
+#                   (page_cache.default_cache_dir)のweather_demand.sqlite
+
+# --基本モジュール--
+import datetime
+import os
+import sqlite3
+import threading
+
+from page_cache import default_cache_dir
+
+
+# 変数定義
+default_name = "weather_demand.sqlite"
+default_window_days = 14
+
+
+class DemandLog(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # 複数のコマンドが同時に記録するため、ロックの待ち時間を長くする
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS demand ("
+            " prec_no TEXT, block_no TEXT, day TEXT, count INTEGER,"
+            " PRIMARY KEY (prec_no, block_no, day))")
+        self.conn.commit()
+
+    def record(self, prec_no, block_no, count=1, day=None):
+        if day is None:
+            day = datetime.date.today()
+        key = (str(prec_no), str(block_no), str(day)[0:10])
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO demand VALUES (?,?,?,0)", key)
+            self.conn.execute(
+                "UPDATE demand SET count=count+? WHERE prec_no=?"
+                " AND block_no=? AND day=?", (count,) + key)
+            self.conn.commit()
+
+    def scores(self, window_days=default_window_days, today=None):
+        # 戻り値: {(prec_no, block_no): (要求回数, 最終要求日)}
+        if today is None:
+            today = datetime.date.today()
+        border = today - datetime.timedelta(days=window_days - 1)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT prec_no, block_no, SUM(count), MAX(day) FROM demand"
+                " WHERE day>=? GROUP BY prec_no, block_no",
+                (str(border),)).fetchall()
+        return dict(((row[0], row[1]), (row[2], row[3])) for row in rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# 環境変数の設定で生成した記録(プロセス内で共有)
+_default_demand = []
+_default_lock = threading.Lock()
+
+
+def get_default_demand():
+    # WEATHER_DEMANDが空文字の場合はNone(記録しない)を返す
+    with _default_lock:
+        if len(_default_demand) == 0:
+            path = os.environ.get("WEATHER_DEMAND")
+            if path is None:
+                path = os.path.join(default_cache_dir(), default_name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            _default_demand.append(None if path == "" else DemandLog(path))
+    return _default_demand[0]
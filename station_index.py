@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象台・観測所の位置を単位球面上のxyz座標(NumPy配列)として
+#              保持し、最寄り(k近傍)の気象台をベクトル演算で探索する
+# usage:
+#   index = load_station_index('area_data_temp_valid.reg')
+#   dist, idx = index.query(35.68, 139.76, k=3)       # 1地点
+#   dist, idx = index.query(lat_array, lng_array)     # 複数地点を一括
+#   row = index.nearest(35.68, 139.76)                # 最寄りの1件(Series)
+
+# --基本モジュール--
+import numpy as np
+import os
+import pickle
+
+from station_registry import read_registry, registry_file
+
+
+# 変数定義
+earth_rad = 6378.137
+# 一度に計算する問い合わせ地点数(地点数×観測所数の行列のメモリを抑えるため)
+query_chunk = 1024
+
+
+# 関数定義
+def latlng_to_xyz_array(lat, lng):
+    rlat = np.radians(np.asarray(lat, dtype=np.float64))
+    rlng = np.radians(np.asarray(lng, dtype=np.float64))
+    coslat = np.cos(rlat)
+    return np.stack([coslat*np.cos(rlng), coslat*np.sin(rlng),
+                     np.sin(rlat)], axis=-1)
+
+
+def check_point(lat, lng):
+    # nearest/nearest_kは1地点のみ(複数地点はqueryで一括して探索する)
+    if (np.ndim(lat) != 0) or (np.ndim(lng) != 0):
+        raise ValueError("lat/lng must be scalars. use query for multiple"
+                         " points")
+
+
+class StationIndex(object):
+    '''
+    気象台データ(area_data_temp_validの内容)から構築する探索用索引
+    距離は大円距離(km)
+    '''
+
+    def __init__(self, area_DF, radious=earth_rad):
+        self.area_DF = area_DF.reset_index(drop=True)
+        latlng = np.array([tuple(v) for v in self.area_DF["緯度_経度"]],
+                          dtype=np.float64).reshape(-1, 2)
+        self.lat = latlng[:, 0]
+        self.lng = latlng[:, 1]
+        self.xyz = latlng_to_xyz_array(self.lat, self.lng)
+        self.radious = radious
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def query(self, lat, lng, k=1):
+        # 戻り値: (距離[km], 行番号) の組。
+        #         スカラーで指定した場合は長さkの配列、配列で指定した場合は
+        #         (地点数, k)の配列を返す。近い順に並ぶ
+        scalar = np.ndim(lat) == 0 and np.ndim(lng) == 0
+        tgt_xyz = latlng_to_xyz_array(np.atleast_1d(lat),
+                                      np.atleast_1d(lng)).reshape(-1, 3)
+        k = min(int(k), len(self.xyz))
+        if k < 1:
+            raise ValueError("k must be 1 or more: " + str(k))
+
+        n = len(tgt_xyz)
+        out_idx = np.empty((n, k), dtype=np.intp)
+        out_dot = np.empty((n, k), dtype=np.float64)
+        rows = np.arange(min(n, query_chunk))[:, None]
+        for i in range(0, n, query_chunk):
+            # 内積が大きいほど近い(大円距離はacos(内積)に比例)
+            dot = tgt_xyz[i:i+query_chunk].dot(self.xyz.T)
+            m = len(dot)
+            if k < dot.shape[1]:
+                part = np.argpartition(-dot, k-1, axis=1)[:, :k]
+            else:
+                part = np.tile(np.arange(dot.shape[1]), (m, 1))
+            part_dot = dot[rows[:m], part]
+            order = np.argsort(-part_dot, axis=1, kind="stable")
+            out_idx[i:i+m] = part[rows[:m], order]
+            out_dot[i:i+m] = part_dot[rows[:m], order]
+
+        out_dist = np.arccos(np.clip(out_dot, -1.0, 1.0))*self.radious
+        if scalar:
+            return out_dist[0], out_idx[0]
+        return out_dist, out_idx
+
+    def nearest(self, lat, lng):
+        # 最寄りの気象台の行(Series)を返す。dist列に距離(km)を付与
+        check_point(lat, lng)
+        dist, idx = self.query(lat, lng, k=1)
+        row = self.area_DF.iloc[int(idx[0])].copy()
+        row["dist"] = dist[0]
+        return row
+
+    def nearest_k(self, lat, lng, k):
+        # 近い順にk件の気象台をDataFrameで返す。dist列に距離(km)を付与
+        check_point(lat, lng)
+        dist, idx = self.query(lat, lng, k=k)
+        out_DF = self.area_DF.iloc[idx].copy()
+        out_DF["dist"] = dist
+        return out_DF
+
+
+# 読み込み済みの索引(ファイルパスと更新時刻をキーに保持)
+_index_cache = {}
+
+
+def load_station_index(path=registry_file):
+    # 同一プロセス内では、ファイルが更新されない限り一度だけ構築する
+    # 拡張子が".pickle"の場合は、以前の形式(pickle)として読み込む
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _index_cache:
+        if path.endswith(".pickle"):
+            with open(path, 'rb') as f:
+                area_DF = pickle.load(f)
+        else:
+            area_DF = read_registry(path).to_frame()
+        _index_cache.clear()
+        _index_cache[key] = StationIndex(area_DF)
+    return _index_cache[key]
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象台・観測所の一覧(area_data_temp_valid)を、Python・pandas
+#              のバージョンに依存しない形式で保存・読み込みする
+#              (pickleの代わりに使用する)
+#              - write_registry: DataFrameから登録ファイル(.reg)を出力する
+#              - read_registry: 登録ファイルを読み込む(pandasは使用せず、
+#                行の配列はメモリマップする)
+#              - ensure_registry: 登録ファイルが無く、pickleファイルがある
+#                場合は変換する(気象庁のサイトにはアクセスしない)
+# format:
+#   先頭8バイト: 識別子(b"WXREG\0\0\0")
+#   続く4バイト: ヘッダの長さ(リトルエンディアンのuint32)
+#   ヘッダ: JSON(UTF-8)。8バイト境界まで空白で埋める
+#     schema_version: 形式のバージョン(一致しない場合は読み込まない)
+#     build_date: 生成日時、rows: 行数、strings: 文字列の表
+#     version: 一覧の版(make_area_dataで生成する毎に1ずつ増やす)
+#   行の配列: row_dtypeの固定長のレコード
+#     pref、area、proc_no、block_no: 文字列の表の番号(同じ文字列は1つ)
+#     lat、lng: 緯度・経度、elevation: 標高(m)
+#     type: 観測所の種別(b"s": 気象台、b"a": その他の観測所)
+
+# --基本モジュール--
+import numpy as np
+import datetime
+import json
+import os
+import pickle
+import struct
+
+
+# 変数定義
+registry_file = "area_data_temp_valid.reg"
+pickle_file = "area_data_temp_valid.pickle"
+schema_version = 1
+magic = b"WXREG\0\0\0"
+string_cols = ["pref", "area", "proc_no", "block_no"]
+# DataFrameにした場合の列(make_area_dataの出力と同じ)
+frame_cols = ["pref", "area", "proc_no", "block_no", "緯度_経度", "標高",
+              "ObservatoryType"]
+row_dtype = np.dtype([("pref", "<i4"), ("area", "<i4"), ("proc_no", "<i4"),
+                      ("block_no", "<i4"), ("lat", "<f8"), ("lng", "<f8"),
+                      ("elevation", "<f8"), ("type", "S1")])
+
+
+class RegistryVersionError(ValueError):
+    # 登録ファイルの形式のバージョンが異なる、または登録ファイルでない
+    pass
+
+
+class Registry(object):
+
+    def __init__(self, header, rows):
+        self.header = header
+        self.rows = rows
+        self.strings = header["strings"]
+        self.build_date = header["build_date"]
+        self.version = header.get("version", 0)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def lat(self):
+        return self.rows["lat"]
+
+    @property
+    def lng(self):
+        return self.rows["lng"]
+
+    def text(self, col):
+        # 文字列の列(string_cols)の値のリスト
+        strings = self.strings
+        return [strings[i] for i in self.rows[col].tolist()]
+
+    def types(self):
+        return [value.decode("ascii") for value in self.rows["type"].tolist()]
+
+    def to_frame(self):
+        # make_area_dataの出力と同じ列のDataFrame
+        import pandas as pd
+        area_DF = pd.DataFrame({col: self.text(col) for col in string_cols})
+        area_DF["緯度_経度"] = list(zip(self.lat.tolist(), self.lng.tolist()))
+        area_DF["標高"] = self.rows["elevation"].astype(np.float64)
+        area_DF["ObservatoryType"] = self.types()
+        return area_DF[frame_cols]
+
+
+# 関数定義
+def write_registry(path, area_DF, build_date=None, version=0):
+    # area_DF: make_area_dataの出力(frame_colsの列を持つDataFrame)
+    # version: 一覧の版
+    # 一時ファイルに書き込んでから名前を変更する
+    strings = []
+    string_ids = {}
+    rows = np.zeros(len(area_DF), dtype=row_dtype)
+    for col in string_cols:
+        ids = []
+        for value in area_DF[col].tolist():
+            value = str(value)
+            if value not in string_ids:
+                string_ids[value] = len(strings)
+                strings.append(value)
+            ids.append(string_ids[value])
+        rows[col] = ids
+    latlng = np.array([tuple(v) for v in area_DF["緯度_経度"]],
+                      dtype=np.float64).reshape(-1, 2)
+    rows["lat"] = latlng[:, 0]
+    rows["lng"] = latlng[:, 1]
+    rows["elevation"] = np.asarray(area_DF["標高"], dtype=np.float64)
+    rows["type"] = [str(v).encode("ascii")
+                    for v in area_DF["ObservatoryType"]]
+    if build_date is None:
+        build_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    header = json.dumps({"schema_version": schema_version,
+                         "build_date": build_date, "version": version,
+                         "rows": len(rows), "strings": strings},
+                        ensure_ascii=False).encode("utf-8")
+    header = header + b" "*(-(len(magic) + 4 + len(header)) % 8)
+    with open(path + ".tmp", "wb") as f:
+        f.write(magic)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(rows.tobytes())
+    os.replace(path + ".tmp", path)
+
+
+def read_registry(path=registry_file):
+    # 戻り値: Registry
+    # 形式のバージョンが異なる場合はRegistryVersionError(生成し直さない)
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise RegistryVersionError("not a registry file: " + path)
+        size = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(size).decode("utf-8"))
+    if header.get("schema_version") != schema_version:
+        raise RegistryVersionError(
+            "registry schema version " + str(header.get("schema_version"))
+            + " is not supported (expected " + str(schema_version)
+            + "). run make_area_data.py to rebuild: " + path)
+    offset = len(magic) + 4 + size
+    if header["rows"] == 0:
+        rows = np.zeros(0, dtype=row_dtype)
+    else:
+        rows = np.memmap(path, dtype=row_dtype, mode="r", offset=offset,
+                         shape=(header["rows"],))
+    return Registry(header, rows)
+
+
+def ensure_registry(path=registry_file):
+    # 登録ファイルを読み込む。無い場合は、同じディレクトリのpickleファイル
+    # から変換する(どちらも無い場合はFileNotFoundError)
+    if not os.path.exists(path):
+        tmp_pickle = os.path.join(os.path.dirname(path), pickle_file)
+        if not os.path.exists(tmp_pickle):
+            raise FileNotFoundError("registry file not found: " + path)
+        with open(tmp_pickle, "rb") as f:
+            area_DF = pickle.load(f)
+        write_registry(path, area_DF)
+    return read_registry(path)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# discription: テストからリポジトリ直下のモジュールをimportするための設定
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    # weather_bench.pyの代替サーバを起動し、weather_getの取得先にする
+    # (リクエスト数の制限・キャッシュ・ページの保管・要求回数の記録は
+    # 使用しない)
+    import fetch_engine
+    import page_archive
+    import page_cache
+    import station_demand
+    import weather_bench
+    import weather_get
+
+    server = weather_bench.start_stand_in()
+    monkeypatch.setattr(page_cache, "_default_cache", [None])
+    monkeypatch.setattr(page_archive, "_default_archive", [None])
+    monkeypatch.setattr(station_demand, "_default_demand", [None])
+    monkeypatch.setattr(fetch_engine, "_default_bucket",
+                        [fetch_engine.TokenBucket(1000000.0, 1000)])
+    for key, url1 in list(weather_get.type_params.items()):
+        monkeypatch.setitem(weather_get.type_params, key, url1.replace(
+            weather_get.jma_url, server.jma_url()))
+    monkeypatch.setattr(weather_get, "url2", weather_get.url2.replace(
+        weather_get.geo_url, server.geo_url()))
+    # 郵便番号の索引は使用せず、代替サーバのAPIで位置を取得する
+    monkeypatch.setenv("WEATHER_POSTAL_INDEX", "")
+    yield server
+    server.shutdown()
+    server.server_close()
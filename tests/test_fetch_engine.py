@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# discription: fetch_engine.pyのテスト(並行取得の順序・重複取得の防止・
+#              リトライ・ホスト毎の要求の停止)
+
+import threading
+import time
+from urllib.error import HTTPError
+
+import pytest
+
+import http_client
+from fetch_engine import fetch_map, Coalescer, RetryPolicy, \
+    CircuitBreaker, CircuitOpen
+
+
+def http_error(code):
+    return HTTPError("http://example.com/", code, "HTTP status " + str(code),
+                     None, None)
+
+
+def test_fetch_map_keeps_order():
+    # 後の要素ほど早く終わっても、結果は入力の順序で返す
+    def func(item):
+        time.sleep(0.01*(5 - item))
+        return item*2
+    assert fetch_map(func, range(6), workers=4) == [0, 2, 4, 6, 8, 10]
+    assert fetch_map(func, [3], workers=4) == [6]
+
+
+def test_fetch_map_raises_error():
+    def func(item):
+        if item == 2:
+            raise ValueError("failed")
+        return item
+    with pytest.raises(ValueError):
+        fetch_map(func, range(4), workers=4)
+
+
+def test_coalescer_runs_once():
+    coalescer = Coalescer()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def func():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "page"
+
+    def worker():
+        results.append(coalescer.call("key", func))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == [1]
+    assert results == ["page"]*4
+    # 完了後は新たに実行する
+    assert coalescer.call("key", lambda: "new") == "new"
+
+
+def test_coalescer_shares_error():
+    coalescer = Coalescer()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def func():
+        started.set()
+        release.wait(5)
+        raise ValueError("failed")
+
+    def worker():
+        try:
+            coalescer.call("key", func)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    threads[0].start()
+    started.wait(5)
+    threads[1].start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 2
+    assert errors[0] is errors[1]
+
+
+def test_retry_policy():
+    retries = []
+    results = [http_error(503), OSError("reset"), "page"]
+
+    def func():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def on_retry(retry_cnt, err, wait, url):
+        retries.append((retry_cnt, type(err), url))
+        assert 0 <= wait <= 0.01*(2**(retry_cnt - 1))
+
+    policy = RetryPolicy(tries=3, base=0.01, max_wait=1.0)
+    assert policy.call("http://example.com/a", func, on_retry) == "page"
+    assert retries == [(1, HTTPError, "http://example.com/a"),
+                       (2, OSError, "http://example.com/a")]
+
+
+def test_retry_policy_gives_up():
+    calls = []
+
+    def func():
+        calls.append(1)
+        raise http_error(503)
+
+    with pytest.raises(HTTPError):
+        RetryPolicy(tries=3, base=0.001).call("http://example.com/", func)
+    assert len(calls) == 3
+
+    # 404等はリトライしない
+    calls[:] = []
+
+    def not_found():
+        calls.append(1)
+        raise http_error(404)
+
+    with pytest.raises(HTTPError):
+        RetryPolicy(tries=3, base=0.001).call("http://example.com/",
+                                              not_found)
+    assert len(calls) == 1
+
+
+def test_retry_policy_with_stand_in(stand_in):
+    url = stand_in.jma_url() + "obd/stats/etrn/view/hourly_s1.php?" \
+        "prec_no=44&block_no=47662&year=2017&month=1&day=1&view=p1"
+    policy = RetryPolicy(tries=3, base=0.001)
+    stand_in.reset_counts()
+    stand_in.error_rate = 1.0
+    with pytest.raises(HTTPError):
+        policy.call(url, lambda: http_client.get(url))
+    assert stand_in.reset_counts() == {"error": 3}
+    stand_in.error_rate = 0.0
+    assert len(policy.call(url, lambda: http_client.get(url))) > 0
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failures=2, reset=0.05)
+    breaker.record("host", False)
+    breaker.check("host")
+    breaker.record("host", False)
+    with pytest.raises(CircuitOpen) as e:
+        breaker.check("host")
+    assert 0 < e.value.remaining <= 0.05
+    # 他のホストには影響しない
+    breaker.check("other")
+
+    # reset秒後は1件だけ要求を通し、成功したら元に戻す
+    time.sleep(0.06)
+    breaker.check("host")
+    with pytest.raises(CircuitOpen):
+        breaker.check("host")
+    breaker.record("host", True)
+    breaker.check("host")
+    breaker.check("host")
+
+
+def test_retry_policy_opens_circuit():
+    breaker = CircuitBreaker(failures=2, reset=60.0)
+    policy = RetryPolicy(tries=2, base=0.001, max_wait=0.01,
+                         breaker=breaker)
+
+    def fail():
+        raise http_error(503)
+
+    with pytest.raises(HTTPError):
+        policy.call("http://example.com/a", fail)
+    # 要求を止めている間は、funcを呼ばずにCircuitOpenとする
+    calls = []
+    with pytest.raises(CircuitOpen):
+        policy.call("http://example.com/b", lambda: calls.append(1))
+    assert calls == []
+
+    # 404はサーバが応答しているため、失敗として数えない
+    def not_found():
+        raise http_error(404)
+
+    breaker = CircuitBreaker(failures=2, reset=60.0)
+    policy = RetryPolicy(tries=2, base=0.001, breaker=breaker)
+    for _ in range(3):
+        with pytest.raises(HTTPError):
+            policy.call("http://example.com/a", not_found)
+    breaker.check("example.com")
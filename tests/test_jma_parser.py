@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# discription: jma_parser.pyのテスト(品質情報の記号が付いた値)
+
+import numpy as np
+
+import weather_get as wg
+from jma_parser import parse_hourly, stack_hourly, decode_cell, FLAG_OK, \
+    FLAG_QUASI, FLAG_INSUFFICIENT, FLAG_TEXT, FLAG_MISSING
+
+
+def make_page(rows):
+    # 見出し行と、rows(各行のセルの文字列のリスト)の表のページ
+    body = '<table id="tablefix1" class="data2_s">' \
+        + "<tr><th>時</th><th>気温(℃)</th><th>風向</th></tr>"
+    for row in rows:
+        body = body + "<tr>" + "".join("<td>" + cell + "</td>"
+                                       for cell in row) + "</tr>"
+    return "<html><body>" + body + "</table></body></html>"
+
+
+def test_decode_cell():
+    assert decode_cell("12.3") == (12.3, FLAG_OK, "12.3")
+    assert decode_cell("12.3 )") == (12.3, FLAG_QUASI, "12.3")
+    assert decode_cell("北西")[1:] == (FLAG_TEXT, "北西")
+    assert decode_cell("北西 )")[1:] == (FLAG_QUASI, "北西")
+    assert decode_cell("晴]")[1:] == (FLAG_INSUFFICIENT, "晴")
+    assert np.isnan(decode_cell("北西 )")[0])
+    assert decode_cell("×")[1:] == (FLAG_MISSING, "×")
+
+
+def test_flagged_text_cell():
+    table = parse_hourly(make_page([["1", "5.0", "北西"],
+                                    ["2", "4.0 )", "北西 )"],
+                                    ["3", "3.0", "静穏 ]"]]))
+    assert table.text[:, 2].tolist() == ["北西", "北西", "静穏"]
+    assert table.flags[:, 1].tolist() == [FLAG_TEXT, FLAG_QUASI,
+                                          FLAG_INSUFFICIENT]
+
+    # 整形後も文字列と品質情報を両方残す
+    stack = stack_hourly([table], ["2017-01-01"])
+    out_data, flag_data = wg.process_data(stack, "20161231", "20170101",
+                                          "all")
+    assert out_data[2].tolist() == ["北西", "北西", "静穏"]
+    assert flag_data[2].tolist() == [FLAG_TEXT, FLAG_QUASI,
+                                     FLAG_INSUFFICIENT]
+    assert out_data[1].tolist() == [5.0, 4.0, 3.0]
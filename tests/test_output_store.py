@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# discription: output_store.pyのテスト(列の型が追加毎に変わらないこと)
+
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+import output_store  # noqa: E402
+from output_store import OutputStore  # noqa: E402
+
+
+def make_month(month, weather):
+    # weather_get.process_dataと同じ形(天気はobject、気温はfloat64)
+    times = pd.date_range("2017-%02d-01" % month, periods=3, freq="h")
+    out_data = pd.DataFrame({"日時": times.values.astype("datetime64[s]")})
+    out_data["気温℃"] = np.array([1.0, 2.0, np.nan])
+    out_data["天気"] = pd.Series(weather, dtype=object)
+    flag_data = pd.DataFrame({"気温℃": np.array([0, 0, 5], dtype=np.uint8),
+                              "天気": np.array([9, 9, 9], dtype=np.uint8)})
+    return out_data, flag_data
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "feather"])
+def test_blank_text_month_then_normal_month(tmp_path, fmt):
+    store = OutputStore(str(tmp_path), fmt)
+    jan, jan_flags = make_month(1, [np.nan, np.nan, np.nan])
+    feb, feb_flags = make_month(2, ["雨", np.nan, "晴"])
+    store.append("all", "44", "47662", jan, flag_data=jan_flags)
+    store.append("all", "44", "47662", feb, flag_data=feb_flags)
+
+    out_data = store.read("all", "44", "47662", with_flags=True)
+    assert len(out_data) == 6
+    assert out_data["天気"].iloc[0:3].isnull().all()
+    assert out_data["天気"].iloc[[3, 5]].tolist() == ["雨", "晴"]
+    assert pd.isnull(out_data["天気"].iloc[4])
+    assert out_data["気温℃"].dtype == np.float64
+    assert out_data["flag_気温℃"].tolist() == [0, 0, 5, 0, 0, 5]
+    assert store.schema("all", "44", "47662")["天気"] == "string"
+
+    # 期間を指定した読み込み(2月のみ)
+    feb_data = store.read("all", "44", "47662", start="2017-02-01",
+                          end="2017-02-28")
+    assert feb_data["天気"].iloc[[0, 2]].tolist() == ["雨", "晴"]
+
+
+def test_legacy_store_without_schema(tmp_path):
+    # _schema.jsonが無い保存先で、空欄の月が数値の型で保存されている場合
+    pa = output_store.import_pyarrow()
+    store = OutputStore(str(tmp_path))
+    base_dir = store.station_dir("all", "44", "47662")
+    for month, weather in [(1, pa.array([None, None, None], pa.float64())),
+                           (2, pa.array(["雨", None, "晴"]))]:
+        part_dir = tmp_path.joinpath(base_dir, "year=2017",
+                                     "month=%02d" % month)
+        part_dir.mkdir(parents=True)
+        times = pd.date_range("2017-%02d-01" % month, periods=3, freq="h")
+        table = pa.table({"日時": pa.array(times.values.astype(
+            "datetime64[ns]")), "天気": weather})
+        pa.parquet.write_table(table, str(part_dir / "part-0.parquet"))
+
+    out_data = store.read("all", "44", "47662")
+    assert out_data["天気"].iloc[0:3].isnull().all()
+    assert out_data["天気"].iloc[[3, 5]].tolist() == ["雨", "晴"]
+
+
+def test_provisional_coverage(tmp_path):
+    # 直近2日は暫定の範囲(取得からprovisional_hours時間以内は取得済み)
+    today = datetime.date.today()
+    start = today - datetime.timedelta(days=5)
+    end = today - datetime.timedelta(days=1)
+    store = OutputStore(str(tmp_path))
+    store.add_coverage("all", "44", "47662", start, end)
+    assert store.coverage("all", "44", "47662") == [
+        (start, today - datetime.timedelta(days=3))]
+    assert store.missing_ranges("all", "44", "47662", start, end) == []
+    assert store.missing_ranges("all", "44", "47662", start, end,
+                                provisional=False) == [
+        (today - datetime.timedelta(days=2), end)]
+    expired = OutputStore(str(tmp_path), provisional_hours=0)
+    assert expired.missing_ranges("all", "44", "47662", start, end) == [
+        (today - datetime.timedelta(days=2), end)]
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# discription: page_cache.pyのテスト(直近の日付を含むページの期限切れ)
+
+import datetime
+import os
+
+from page_cache import PageCache, page_key, page_last_date
+
+
+jma_url = "http://www.data.jma.go.jp/obd/stats/etrn/view/"
+
+
+def daily_url(tgt_date):
+    return jma_url + "daily_s1.php?prec_no=44&block_no=47662&year=" \
+        + str(tgt_date.year) + "&month=" + str(tgt_date.month) \
+        + "&day=&view=p1"
+
+
+def monthly_url(tgt_date):
+    return jma_url + "monthly_s1.php?prec_no=44&block_no=47662&year=" \
+        + str(tgt_date.year) + "&month=&day=&view=p1"
+
+
+def hourly_url(tgt_date):
+    return jma_url + "hourly_s1.php?prec_no=44&block_no=47662&year=" \
+        + str(tgt_date.year) + "&month=" + str(tgt_date.month) + "&day=" \
+        + str(tgt_date.day) + "&view=p1"
+
+
+def test_page_last_date():
+    tgt_date = datetime.date(2016, 2, 10)
+    assert page_key(daily_url(tgt_date))[3] == "2016-02-01"
+    assert page_last_date(page_key(daily_url(tgt_date))) == "2016-02-29"
+    assert page_key(monthly_url(tgt_date))[3] == "2016-01-01"
+    assert page_last_date(page_key(monthly_url(tgt_date))) == "2016-12-31"
+    assert page_last_date(page_key(hourly_url(tgt_date))) == "2016-02-10"
+
+
+def test_is_recent(tmp_path):
+    cache = PageCache(str(tmp_path / "cache.sqlite"))
+    today = datetime.date.today()
+    old = datetime.date(today.year - 3, 6, 15)
+    assert cache.is_recent(page_key(daily_url(today)))
+    assert cache.is_recent(page_key(monthly_url(today)))
+    assert cache.is_recent(page_key(hourly_url(today)))
+    assert not cache.is_recent(page_key(daily_url(old)))
+    assert not cache.is_recent(page_key(monthly_url(old)))
+    assert not cache.is_recent(page_key(hourly_url(old)))
+    cache.close()
+
+
+def test_current_month_pages_expire(tmp_path):
+    # 当月の日毎の値・当年の月毎の値のページは、ttl秒で期限切れ
+    cache = PageCache(str(tmp_path / "cache.sqlite"), ttl=-1)
+    today = datetime.date.today()
+    old = datetime.date(today.year - 3, 6, 15)
+    for url in [daily_url(today), monthly_url(today)]:
+        cache.put(page_key(url), b"page")
+        assert cache.get(page_key(url)) is None
+    for url in [daily_url(old), monthly_url(old)]:
+        cache.put(page_key(url), b"page")
+        assert cache.get(page_key(url)) == b"page"
+    cache.close()
+
+
+def test_evict_keeps_size_under_limit(tmp_path):
+    cache = PageCache(str(tmp_path / "cache.sqlite"), max_bytes=10000)
+    old = datetime.date(2015, 1, 1)
+    for i in range(30):
+        url = hourly_url(old + datetime.timedelta(days=i))
+        cache.put(page_key(url), os.urandom(1000))
+    assert cache.size() <= 10000
+    assert cache.total == cache.size()
+    # 最近追加したページは残る
+    assert cache.get(page_key(hourly_url(old + datetime.timedelta(
+        days=29)))) is not None
+    cache.close()
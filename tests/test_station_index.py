@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# discription: station_index.pyのテスト(1地点・複数地点の探索)
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from station_index import StationIndex
+
+
+def make_index():
+    area_DF = pd.DataFrame({
+        "area": ["東京", "横浜", "千葉"],
+        "緯度_経度": [(35.69, 139.75), (35.44, 139.65), (35.60, 140.10)]})
+    return StationIndex(area_DF)
+
+
+def test_nearest_k():
+    out_DF = make_index().nearest_k(35.45, 139.64, 2)
+    assert out_DF["area"].tolist() == ["横浜", "東京"]
+    assert out_DF["dist"].is_monotonic_increasing
+
+
+def test_query_batch():
+    dist, idx = make_index().query(np.array([35.45, 35.61]),
+                                   np.array([139.64, 140.11]), k=2)
+    assert idx.shape == (2, 2)
+    assert idx[:, 0].tolist() == [1, 2]
+
+
+def test_nearest_k_rejects_batch():
+    index = make_index()
+    with pytest.raises(ValueError):
+        index.nearest_k(np.array([35.45, 35.61]), np.array([139.64, 140.11]),
+                        2)
+    with pytest.raises(ValueError):
+        index.nearest([35.45], [139.64])
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# discription: weather_agg.pyのテスト(保存先の品質情報・終了日の24時)
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+import weather_agg  # noqa: E402
+from jma_parser import FLAG_OK, FLAG_QUASI  # noqa: E402
+from output_store import OutputStore  # noqa: E402
+
+
+def store_days(store, start, end, quasi_hours=()):
+    # weather_get.update_storeと同じく、開始日0時〜終了日24時(翌日0時)を
+    # 保存する
+    times = pd.date_range(start, pd.Timestamp(end) + pd.Timedelta(days=1),
+                          freq="h")
+    out_data = pd.DataFrame({"日時": times.values.astype("datetime64[s]")})
+    out_data["気温℃"] = np.arange(len(times), dtype=np.float64)
+    out_data["降水量mm"] = np.zeros(len(times))
+    flags = np.zeros(len(times), dtype=np.uint8)
+    flags[np.isin(times, pd.DatetimeIndex(quasi_hours))] = FLAG_QUASI
+    flag_data = pd.DataFrame({"気温℃": flags,
+                              "降水量mm": np.zeros(len(times), np.uint8)})
+    store.append("all", "44", "47662", out_data, start, end,
+                 flag_data=flag_data)
+
+
+def test_last_day_has_24_hours(tmp_path):
+    store = OutputStore(str(tmp_path))
+    store_days(store, "2017-01-01", "2017-01-03")
+    out_data, flag_data = weather_agg.read_store_hourly(
+        store, "all", "44", "47662", "20170101", "20170103")
+    assert out_data["日時"].iloc[0] == pd.Timestamp("2017-01-01 01:00")
+    assert out_data["日時"].iloc[-1] == pd.Timestamp("2017-01-04 00:00")
+
+    agg_data, agg_flags = weather_agg.aggregate(
+        {"44_47662": out_data}, "daily", {"44_47662": flag_data})
+    assert agg_data["日時"].tolist() == list(
+        pd.date_range("2017-01-01", "2017-01-03"))
+    assert (agg_flags["気温℃_平均"] == FLAG_OK).all()
+    # 3日は3日1時(値49)〜4日0時(値72)の平均
+    assert agg_data["気温℃_平均"].iloc[-1] == np.mean(np.arange(49, 73))
+
+
+def test_store_flags_are_used(tmp_path):
+    store = OutputStore(str(tmp_path))
+    store_days(store, "2017-01-01", "2017-01-02",
+               quasi_hours=["2017-01-02 05:00"])
+    out_data, flag_data = weather_agg.read_store_hourly(
+        store, "all", "44", "47662", "20170101", "20170102")
+    assert list(flag_data.columns) == ["気温℃", "降水量mm"]
+
+    agg_flags = weather_agg.aggregate(
+        {"44_47662": out_data}, "daily", {"44_47662": flag_data})[1]
+    assert agg_flags["気温℃_平均"].tolist() == [FLAG_OK, FLAG_QUASI]
+    assert agg_flags["降水量mm_合計"].tolist() == [FLAG_OK, FLAG_OK]
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# discription: weather_get.pyのテスト(保存先への区間毎の追加・取得できなかった
+#              日の再取得・異常終了後の再開)
+
+import datetime
+
+import pytest
+
+pytest.importorskip("pyarrow")
+import weather_get as wg  # noqa: E402
+from output_store import OutputStore  # noqa: E402
+
+
+station = ("44", "47662")
+
+
+def station_url():
+    return wg.make_url_str(wg.type_params[("s", "hourly")], *station)
+
+
+def update(store, start, end):
+    return wg.update_store(store, "all", station[0], station[1],
+                           station_url(), wg.datetime_parser(start),
+                           wg.datetime_parser(end), "all", 1, chunk_days=3)
+
+
+def test_update_store_by_chunk(stand_in, tmp_path, monkeypatch):
+    store = OutputStore(str(tmp_path))
+    read_day_hourly = wg.read_day_hourly
+
+    def fail_on_8th(url_str, tgt_datetime, resolution="hourly"):
+        if tgt_datetime.day == 8:
+            raise RuntimeError("stopped")
+        return read_day_hourly(url_str, tgt_datetime, resolution)
+
+    # 3つ目の区間(7日〜9日)で異常終了しても、前の区間は取得済みとなる
+    monkeypatch.setattr(wg, "read_day_hourly", fail_on_8th)
+    with pytest.raises(RuntimeError):
+        update(store, "20170101", "20170109")
+    assert store.coverage("all", *station) == [
+        (datetime.date(2017, 1, 1), datetime.date(2017, 1, 6))]
+
+    # 再実行時は続きの区間(と、その前日のページ)だけを取得する
+    monkeypatch.setattr(wg, "read_day_hourly", read_day_hourly)
+    stand_in.reset_counts()
+    assert update(store, "20170101", "20170109") == 3
+    assert stand_in.reset_counts() == {"hourly_s1": 4}
+    out_data = wg.read_store_range(store, "all", station[0], station[1],
+                                   "20170101", "20170109")
+    assert len(out_data) == 9*24
+    assert out_data["日時"].is_monotonic_increasing
+
+
+def write_csv(out_file, start, end):
+    return wg.write_weather_csv(out_file, station_url(),
+                                wg.datetime_parser(start),
+                                wg.datetime_parser(end), "all", 1)
+
+
+def read_text(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def fail_on(monkeypatch, day, err):
+    # day日のページの取得をerrで失敗させる
+    read_day_hourly = wg.read_day_hourly
+
+    def read_day(url_str, tgt_datetime, resolution="hourly"):
+        if tgt_datetime.day == day:
+            raise err
+        return read_day_hourly(url_str, tgt_datetime, resolution)
+    monkeypatch.setattr(wg, "read_day_hourly", read_day)
+    return read_day_hourly
+
+
+def test_refill_gaps(stand_in, tmp_path, monkeypatch):
+    expected = str(tmp_path / "expected.csv")
+    write_csv(expected, "20170101", "20170109")
+
+    # 取得できなかった日(5日)は空欄で出力し、".gaps"に記録する
+    out_file = str(tmp_path / "out.csv")
+    read_day_hourly = fail_on(monkeypatch, 5, OSError("reset"))
+    assert write_csv(out_file, "20170101", "20170109") == 9
+    assert wg.read_gaps(out_file)[0] == ["2017-01-05"]
+    lines = read_text(out_file).splitlines()
+    assert len(lines) == len(read_text(expected).splitlines())
+    # 1行目は見出し、2行目は1日0時
+    assert lines[4*24 + 2].split(",")[1:] == \
+        [""]*(len(lines[0].split(",")) - 1)
+
+    # 5日のページ(5日1時〜6日0時の行)だけを取得し直す
+    monkeypatch.setattr(wg, "read_day_hourly", read_day_hourly)
+    stand_in.reset_counts()
+    assert wg.refill_gaps(out_file, station_url(), "all", 1) == 0
+    assert stand_in.reset_counts() == {"hourly_s1": 3}
+    assert read_text(out_file) == read_text(expected)
+    assert wg.read_gaps(out_file) is None
+
+
+def test_journal_resume(stand_in, tmp_path, monkeypatch):
+    monkeypatch.setenv("WEATHER_CHUNK_DAYS", "3")
+    expected = str(tmp_path / "expected.csv")
+    write_csv(expected, "20170101", "20170109")
+
+    # 3つ目の区間(7日〜9日)で異常終了した場合は、6日までを記録する
+    out_file = str(tmp_path / "out.csv")
+    read_day_hourly = fail_on(monkeypatch, 8, RuntimeError("stopped"))
+    with pytest.raises(RuntimeError):
+        write_csv(out_file, "20170101", "20170109")
+    assert wg.read_journal(out_file + ".journal")[0] == \
+        wg.datetime_parser("20170106")
+    assert not (tmp_path / "out.csv").exists()
+
+    # 再実行時は7日(と、その前日のページ)から取得する
+    monkeypatch.setattr(wg, "read_day_hourly", read_day_hourly)
+    stand_in.reset_counts()
+    assert write_csv(out_file, "20170101", "20170109") == 3
+    assert stand_in.reset_counts() == {"hourly_s1": 4}
+    assert read_text(out_file) == read_text(expected)
+    assert not (tmp_path / "out.csv.part").exists()
+    assert not (tmp_path / "out.csv.journal").exists()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# discription: weather_prefetch.pyのテスト(直近の日付の暫定の範囲)
+
+import datetime
+
+import pytest
+
+pytest.importorskip("pyarrow")
+import weather_get as wg  # noqa: E402
+import weather_prefetch  # noqa: E402
+from output_store import OutputStore  # noqa: E402
+
+
+station = ("44", "47662", "s")
+
+
+def recent_period():
+    # 前日までの3日間(前日・前々日は直近の日付)
+    end = wg.datetime_parser(str(datetime.date.today()
+                                 - datetime.timedelta(days=1)))
+    return end - datetime.timedelta(days=2), end
+
+
+def prefetch(store, start, end):
+    return weather_prefetch.prefetch_station(
+        store, station, "all", 1, 1, start, end,
+        weather_prefetch.PageBudget(0))
+
+
+def test_same_day_read_after_prefetch(stand_in, tmp_path):
+    store = OutputStore(str(tmp_path))
+    start, end = recent_period()
+    assert prefetch(store, start, end)[0] == "fetched"
+    assert stand_in.reset_counts().get("hourly_s1", 0) > 0
+    # 昼間の実行(weather_get.pyと同じ処理)は気象庁のサイトにアクセスしない
+    set_name = wg.store_set_name("all", 1)
+    url_str = wg.make_url_str(wg.type_params[("s", "hourly")], *station[0:2])
+    assert wg.update_store(store, set_name, station[0], station[1], url_str,
+                           start, end, "all", 1) == 0
+    out_data = wg.read_store_range(store, set_name, station[0], station[1],
+                                   start, end)
+    assert len(out_data) == 72
+    assert stand_in.reset_counts() == {}
+
+
+def test_prefetch_refreshes_provisional_days(stand_in, tmp_path):
+    store = OutputStore(str(tmp_path))
+    start, end = recent_period()
+    prefetch(store, start, end)
+    stand_in.reset_counts()
+    fetched = store.provisional("all", station[0], station[1])[0][2]
+    # 次回の実行では、直近の日付(前日・前々日と、その前日のページ)を取得
+    # し直し、取得時刻を更新する
+    assert prefetch(store, start, end)[0] == "fetched"
+    assert stand_in.reset_counts() == {"hourly_s1": 3}
+    assert store.provisional("all", station[0], station[1])[0][2] > fetched
+    assert store.missing_ranges("all", station[0], station[1], start,
+                                end) == []
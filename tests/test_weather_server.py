@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# discription: weather_server.pyのテスト(郵便番号の検索のエラー)
+
+from urllib.error import HTTPError
+
+import pytest
+
+import fetch_engine
+import weather_get as wg
+import weather_server
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    # 郵便番号を変えて検索し直す前の待ち時間を省く
+    monkeypatch.setattr(wg.time, "sleep", lambda sec: None)
+
+
+def nearest(post_num):
+    return weather_server.query_nearest({"postal": [post_num]})
+
+
+def test_nearest_postal(stand_in, no_sleep):
+    # 位置の無い郵便番号は、下4桁を"0"にした番号で検索する
+    assert nearest("1000099")["post_num"] == "1000000"
+
+
+def test_unknown_postal_is_404(stand_in, no_sleep):
+    with pytest.raises(weather_server.QueryError) as e:
+        nearest("0010001")
+    assert e.value.status == 404
+
+
+def test_geocoder_failure_is_not_404(stand_in, no_sleep, monkeypatch):
+    # APIの通信の失敗は、郵便番号が無いとはしない(502)
+    monkeypatch.setattr(fetch_engine, "_default_retry",
+                        [fetch_engine.RetryPolicy(tries=1)])
+    stand_in.error_rate = 1.0
+    with pytest.raises(HTTPError):
+        nearest("1000000")
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 1時間毎の気象データ(保存先(output_store.py)に保存したデータ)
+#              から、日毎・月毎の集計値を求める
+#              - 気温: 平均・最高・最低、降水量: 合計
+#              - 暖房度日・冷房度日(日平均気温と基準温度の差の合計)
+#              日の区切りは気象庁と同じく1時〜24時("0時"は前日の24時)
+#              月毎の値は日毎の値から求める(平均気温は日平均気温の平均)
+#              複数の気象台のデータを1回の集計(groupby)でまとめて処理する
+#              保存先の品質情報の列("flag_<列名>")を集計値の品質情報に反映する
+# flags:
+#   集計値の品質情報は、jma_parserのFLAG_*で返す
+#   FLAG_OK: 全ての時間(日)の値がある
+#   FLAG_QUASI: 値の無い時間(日)が2割以下、または準正常値を含む
+#   FLAG_INSUFFICIENT: 値の無い時間(日)が2割を超える、または資料不足値を含む
+#   FLAG_MISSING: 値が1つも無い(値はNaN)
+# arguments:
+#   argvs[1]: 集計の単位("daily"、"monthly")
+#   argvs[2]: 出力ファイルのパス
+#   argvs[3]: 開始日(YYYYMMDD)
+#   argvs[4]: 終了日(YYYYMMDD)
+#   argvs[5]: 保存先の列セット("all"、列番号) ※output_store.pyと同じ
+#             "all"は「気温℃」「降水量mm」列を使用し、列番号は、その列を
+#             気温として使用する
+#   argvs[6]以降: 気象台("<prec_no>,<block_no>")
+# environment:
+#   WEATHER_STORE: 保存先ディレクトリ(必須) ※output_store.pyと同じ
+#   WEATHER_STORE_FORMAT: 保存先の形式 ※output_store.pyと同じ
+#   WEATHER_HDD_BASE: 暖房度日の基準温度(℃) 既定値は18.0
+#   WEATHER_CDD_BASE: 冷房度日の基準温度(℃) 既定値は24.0
+# output:
+#   1行1気象台・1日(1か月)のCSV
+#   "station"("<prec_no>_<block_no>")、"日時"、集計値の列、
+#   集計値毎の品質情報の列("flag_<列名>")
+
+# --基本モジュール--
+import pandas as pd
+import numpy as np
+import os
+import sys
+
+from jma_parser import FLAG_OK, FLAG_QUASI, FLAG_INSUFFICIENT, FLAG_MISSING
+from metrics import get_metrics, start_run
+from output_store import OutputStore
+
+# ログ用
+import traceback
+from logging import getLogger, StreamHandler, FileHandler, INFO, WARN
+import datetime
+cmd = "weather_agg"
+pid = str(os.getpid())
+logfile = "/tmp/"+cmd+"_"+pid+".log"
+logger = getLogger(cmd)
+logger.setLevel(INFO)
+arg_str = ' '.join(map(str, sys.argv))
+
+
+def setup_logger():
+    # コマンドとして実行する場合のみログファイルを作成する
+    Fhandler = FileHandler(logfile)
+    Fhandler.setLevel(INFO)
+    logger.addHandler(Fhandler)
+    Shandler = StreamHandler()
+    Shandler.setLevel(WARN)
+    logger.addHandler(Shandler)
+
+
+def warn_print(msg):
+    d = datetime.datetime.today()
+    logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+def debug_print(msg):
+    d = datetime.datetime.today()
+    logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+# 変数定義
+time_col = "日時"
+station_col = "station"
+flag_prefix = "flag_"
+freqs = ["daily", "monthly"]
+# 入力の列名(weather_get.pyの"all"モードの出力)
+temp_col = "気温℃"
+precip_col = "降水量mm"
+# 出力の列名
+agg_cols = ["気温℃_平均", "気温℃_最高", "気温℃_最低", "降水量mm_合計",
+            "暖房度日", "冷房度日"]
+default_hdd_base = 18.0
+default_cdd_base = 24.0
+# 値の無い時間(日)の割合がこれ以下の場合は準正常値
+quasi_ratio = 0.2
+
+
+# 関数定義
+def find_cols(out_data):
+    # 戻り値: (気温の列名, 降水量の列名) 無い場合はNone
+    cols = [col for col in out_data.columns if col != time_col]
+    tmp_temp = temp_col if temp_col in cols else None
+    tmp_precip = precip_col if precip_col in cols else None
+    if (tmp_temp is None) and (tmp_precip is None) and (len(cols) == 1):
+        # 列番号指定の出力は、その列を気温とする
+        tmp_temp = cols[0]
+    return tmp_temp, tmp_precip
+
+
+def count_flags(count, expected, quality):
+    # 値のある件数と、期待される件数から品質情報を求める
+    # quality: 入力の品質情報(準正常値・資料不足値を含む場合)の最大値
+    flags = np.where(count >= expected, FLAG_OK,
+                     np.where(count >= expected*(1.0 - quasi_ratio),
+                              FLAG_QUASI, FLAG_INSUFFICIENT))
+    flags = np.maximum(flags, quality)
+    return np.where(count == 0, FLAG_MISSING, flags).astype(np.uint8)
+
+
+def input_quality(flags, valid):
+    # 値のある時間の品質情報のうち、準正常値・資料不足値のもの(他は0)
+    flags = np.asarray(flags, dtype=np.uint8)
+    return np.where(valid & ((flags == FLAG_QUASI) |
+                             (flags == FLAG_INSUFFICIENT)), flags, 0)
+
+
+def stack_stations(frames, flag_frames=None):
+    # 気象台毎のDataFrameを、1つの配列の組にまとめる
+    # 戻り値: (気象台名のリスト, dict(列名: 配列))
+    names = []
+    parts = []
+    for code, (name, out_data) in enumerate(frames.items()):
+        tmp_temp, tmp_precip = find_cols(out_data)
+        if (tmp_temp is None) and (tmp_precip is None):
+            raise ValueError("temperature/precipitation column is not found: "
+                             + str(name))
+        n = len(out_data)
+        flag_data = None if flag_frames is None else flag_frames.get(name)
+        part = {"code": np.full(n, code, dtype=np.int64)}
+        date_times = pd.to_datetime(out_data[time_col]).values
+        # 1時〜24時を同じ日とする("0時"は前日の24時)
+        part["day"] = (date_times - np.timedelta64(1, "h")) \
+            .astype("datetime64[D]")
+        # 期間の最初の"0時"(前日の24時)だけの日は除く
+        first = date_times.min().astype("datetime64[D]") if n > 0 else None
+        part["keep"] = part["day"] >= first if n > 0 \
+            else np.empty(0, dtype=bool)
+        for key, col in (("t", tmp_temp), ("p", tmp_precip)):
+            if col is None:
+                values = np.full(n, np.nan)
+            else:
+                values = pd.to_numeric(out_data[col], errors="coerce") \
+                    .values.astype(np.float64)
+            part[key] = values
+            if (flag_data is not None) and (col in flag_data.columns):
+                part[key + "q"] = input_quality(flag_data[col].values,
+                                                ~np.isnan(values))
+            else:
+                part[key + "q"] = np.zeros(n, dtype=np.uint8)
+        names.append(name)
+        parts.append(part)
+    keys = ["code", "day", "keep", "t", "tq", "p", "pq"]
+    stacked = {key: np.concatenate([part[key] for part in parts])
+               if len(parts) > 0 else np.empty(0) for key in keys}
+    keep = stacked.pop("keep").astype(bool)
+    return names, {key: values[keep] for key, values in stacked.items()}
+
+
+def aggregate_daily(stacked, hdd_base, cdd_base):
+    # 戻り値: 1行1気象台・1日のDataFrame(集計値・品質情報・件数)
+    hourly = pd.DataFrame(stacked)
+    group = hourly.groupby(["code", "day"], sort=True)
+    daily = pd.DataFrame({
+        "t_mean": group["t"].mean(), "t_max": group["t"].max(),
+        "t_min": group["t"].min(), "t_n": group["t"].count(),
+        "tq": group["tq"].max(),
+        "p_sum": group["p"].sum(min_count=1), "p_n": group["p"].count(),
+        "pq": group["pq"].max()}).reset_index()
+    daily["t_flag"] = count_flags(daily["t_n"].values, 24,
+                                  daily["tq"].values)
+    daily["p_flag"] = count_flags(daily["p_n"].values, 24,
+                                  daily["pq"].values)
+    daily["hdd"] = np.clip(hdd_base - daily["t_mean"].values, 0, None)
+    daily["cdd"] = np.clip(daily["t_mean"].values - cdd_base, 0, None)
+    return daily
+
+
+def aggregate_monthly(daily):
+    # 日毎の値から月毎の値を求める
+    # 戻り値: 1行1気象台・1か月のDataFrame(aggregate_dailyと同じ列)
+    tmp = daily.copy()
+    tmp["month"] = tmp["day"].values.astype("datetime64[M]")
+    # 値の無い日は件数に含めない。日の品質情報は月の品質情報に反映する
+    tmp["t_ok"] = tmp["t_mean"].notnull()
+    tmp["p_ok"] = tmp["p_sum"].notnull()
+    tmp["tq"] = np.where(tmp["t_ok"], np.minimum(tmp["t_flag"],
+                                                 FLAG_INSUFFICIENT), 0)
+    tmp["pq"] = np.where(tmp["p_ok"], np.minimum(tmp["p_flag"],
+                                                 FLAG_INSUFFICIENT), 0)
+    group = tmp.groupby(["code", "month"], sort=True)
+    monthly = pd.DataFrame({
+        "t_mean": group["t_mean"].mean(), "t_max": group["t_max"].max(),
+        "t_min": group["t_min"].min(), "t_n": group["t_ok"].sum(),
+        "tq": group["tq"].max(),
+        "p_sum": group["p_sum"].sum(min_count=1), "p_n": group["p_ok"].sum(),
+        "pq": group["pq"].max(),
+        "hdd": group["hdd"].sum(min_count=1),
+        "cdd": group["cdd"].sum(min_count=1)}).reset_index()
+    months = monthly["month"].values.astype("datetime64[M]")
+    days = ((months + 1).astype("datetime64[D]")
+            - months.astype("datetime64[D]")).astype(np.int64)
+    monthly["t_flag"] = count_flags(monthly["t_n"].values, days,
+                                    monthly["tq"].values)
+    monthly["p_flag"] = count_flags(monthly["p_n"].values, days,
+                                    monthly["pq"].values)
+    return monthly.rename(columns={"month": "day"})
+
+
+def aggregate(frames, freq="daily", flag_frames=None, hdd_base=None,
+              cdd_base=None):
+    # frames: {気象台名: 1時間毎の気象データ(weather_get.process_dataの形式
+    #         またはCSVを読み込んだDataFrame)}
+    # freq: "daily"または"monthly"
+    # flag_frames: {気象台名: 品質情報} 省略時は値の有無だけで判定する
+    # 戻り値: (集計値, 品質情報)
+    #   集計値: "station"、"日時"と集計値の列(agg_cols)
+    #   品質情報: 集計値の列毎の品質情報
+    if freq not in freqs:
+        raise ValueError("freq unexpected: " + str(freq))
+    if hdd_base is None:
+        hdd_base = float(os.environ.get("WEATHER_HDD_BASE",
+                                        default_hdd_base))
+    if cdd_base is None:
+        cdd_base = float(os.environ.get("WEATHER_CDD_BASE",
+                                        default_cdd_base))
+    with get_metrics().timer("aggregate"):
+        names, stacked = stack_stations(frames, flag_frames)
+        agg = aggregate_daily(stacked, hdd_base, cdd_base)
+        if freq == "monthly":
+            agg = aggregate_monthly(agg)
+
+    agg_data = pd.DataFrame({
+        station_col: np.array(names, dtype=object)[
+            agg["code"].values.astype(np.int64)],
+        time_col: agg["day"].values.astype("datetime64[s]")})
+    flag_data = pd.DataFrame(index=agg_data.index)
+    for col, value_key, flag_key in zip(
+            agg_cols, ["t_mean", "t_max", "t_min", "p_sum", "hdd", "cdd"],
+            ["t_flag", "t_flag", "t_flag", "p_flag", "t_flag", "t_flag"]):
+        agg_data[col] = agg[value_key].values.astype(np.float64)
+        flag_data[col] = agg[flag_key].values
+    get_metrics().add("aggregate_rows", len(agg_data))
+    return agg_data, flag_data
+
+
+def day_bounds(start_date, end_date):
+    # 開始日〜終了日を集計する1時間毎のデータの範囲
+    # 戻り値: (開始日の1時, 終了日の24時(翌日の0時))
+    start_dt = pd.Timestamp(str(start_date)).normalize()
+    end_dt = pd.Timestamp(str(end_date)).normalize()
+    return start_dt + pd.Timedelta(hours=1), end_dt + pd.Timedelta(days=1)
+
+
+def read_store_hourly(store, set_name, prec_no, block_no, start_date,
+                      end_date):
+    # 保存先から1時間毎の気象データと品質情報を読み込む
+    # 戻り値: (気象データ, 品質情報(列名から"flag_"を除いたもの))
+    start_dt, end_dt = day_bounds(start_date, end_date)
+    with get_metrics().timer("store_read"):
+        tmp_data = store.read(set_name, prec_no, block_no, start_dt, end_dt,
+                              with_flags=True)
+    if len(tmp_data) == 0:
+        raise ValueError("data is not stored: " + str(prec_no) + ", "
+                         + str(block_no))
+    flag_cols = [col for col in tmp_data.columns
+                 if str(col).startswith(flag_prefix)]
+    flag_data = tmp_data[flag_cols].rename(
+        columns=lambda col: col[len(flag_prefix):])
+    return tmp_data.drop(columns=flag_cols), flag_data
+
+
+def write_agg_csv(out_file, agg_data, flag_data):
+    # 品質情報は"flag_<列名>"の列として出力する
+    out_data = agg_data.copy()
+    for col in flag_data.columns:
+        out_data[flag_prefix + str(col)] = flag_data[col].values
+    with get_metrics().timer("write"):
+        out_data.to_csv(out_file + ".tmp", index=False)
+        os.replace(out_file + ".tmp", out_file)
+
+
+# main処理
+if __name__ == '__main__':
+
+    setup_logger()
+    start_run(cmd)
+
+    # 引数取得
+    argvs = sys.argv
+
+    # ログ関数生成
+    def error_exit(code, msg):
+        d = datetime.datetime.today()
+        logger.error(d.strftime("%Y-%m-%d %H:%M:%S")+" ERROR "+cmd+" - "
+                     + str(msg)+" command: "+arg_str)
+        logfile2 = \
+            "/var/log/"+cmd+"_"+d.strftime("%Y%m%d%H%M%S")+"_"+pid+".log"
+        os.rename(logfile, logfile2)
+        sys.exit(code)
+
+    debug_print("start process.")
+
+    # 引数チェック
+    debug_print("start checking argments.")
+    if len(argvs) <= 6:
+        error_exit(1, "number of args is less than expected. [main]")
+
+    try:
+        freq = str(argvs[1])
+        out_file = str(argvs[2])
+        start_date = datetime.datetime.strptime(str(argvs[3]), "%Y%m%d")
+        end_date = datetime.datetime.strptime(str(argvs[4]), "%Y%m%d")
+        set_name = str(argvs[5])
+        stations = [tuple(str(x).split(",")) for x in argvs[6:]]
+    except:
+        error_exit(1, "args are incorrect. [main]")
+    if freq not in freqs:
+        error_exit(1, "freq is incorrect. [main]")
+    if start_date > end_date:
+        error_exit(1, "start date is later than end date. [main]")
+    for station in stations:
+        if len(station) != 2:
+            error_exit(1, "station is incorrect: " + ",".join(station)
+                       + ". [main]")
+    store_dir = os.environ.get("WEATHER_STORE", "")
+    if store_dir == "":
+        error_exit(1, "WEATHER_STORE is not specified. [main]")
+    debug_print("end checking argments.")
+
+    debug_print("start reading store.")
+    frames = {}
+    flag_frames = {}
+    try:
+        store = OutputStore(store_dir,
+                            os.environ.get("WEATHER_STORE_FORMAT", "parquet"))
+        for prec_no, block_no in stations:
+            name = prec_no + "_" + block_no
+            frames[name], flag_frames[name] = read_store_hourly(
+                store, set_name, prec_no, block_no, start_date, end_date)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [read_store_hourly]")
+    debug_print("end reading store. stations: " + str(len(frames)))
+
+    debug_print("start aggregating data.")
+    try:
+        agg_data, flag_data = aggregate(frames, freq, flag_frames)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [aggregate]")
+    debug_print("end aggregating data. rows: " + str(len(agg_data)))
+
+    debug_print("start output file.")
+    try:
+        write_agg_csv(out_file, agg_data, flag_data)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [to_csv]")
+    debug_print("end output file.")
+
+    debug_print("end process.")
+    os.remove(logfile)
+
+    sys.exit(0)
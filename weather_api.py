@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 他のプログラムからimportして使用するための関数
+#              (weather_get.py をコマンドとして実行し、出力されたCSVを読み
+#              直す代わりに、同じプロセス内で観測所の検索・気象データの取得
+#              を行う)
+#              - load_registry: 観測所の一覧(area_data_temp_valid.reg)
+#              - nearest_station: 緯度経度から近い順にk件の観測所
+#              - station_for_post_num: 郵便番号から最寄りの観測所
+#              - find_station: block_noから観測所
+#              - iter_hourly: 観測所・期間を指定して、1時間単位の気象データ
+#                を日毎または月毎のDataFrame(型付き)で順に返す
+#              - aggregate_stations: 複数の観測所・期間を指定して、日毎または
+#                月毎の集計値(weather_agg.aggregate)を返す
+#              ※エラー時はsys.exitせずに例外を送出する
+# usage:
+#   import weather_api
+#   station = weather_api.station_for_post_num("1000001")
+#   for chunk in weather_api.iter_hourly(station, "20170101", "20171231",
+#                                        chunk="month"):
+#       ...
+
+# --基本モジュール--
+import os
+
+import pandas as pd
+
+import weather_get as wg
+import weather_agg
+from station_index import load_station_index
+from station_registry import ensure_registry, registry_file
+
+
+# 変数定義
+registry_path = registry_file
+
+
+# 関数定義
+def load_registry(path=registry_path):
+    # 観測所の一覧(DataFrame)を返す
+    # 登録ファイルが無い場合は、pickleファイルから変換する
+    # どちらも無い場合のみ make_area_data で生成する(時間がかかる)
+    # 形式のバージョンが異なる場合は生成し直さずに RegistryVersionError
+    try:
+        ensure_registry(path)
+    except FileNotFoundError:
+        import make_area_data as area_data_maker
+        area_data_maker.make_area_data(os.path.dirname(path) or ".")
+    return load_station_index(path).area_DF.copy()
+
+
+def nearest_station(lat, lng, k=1, path=registry_path):
+    # 戻り値: 近い順にk件の観測所(DataFrame、"dist"列は距離km)
+    load_registry(path)
+    return load_station_index(path).nearest_k(lat, lng, k)
+
+
+def station_for_post_num(post_num, path=registry_path):
+    # 戻り値: 最寄りの観測所(Series)
+    #         "post_num"は実際に位置を取得できた郵便番号
+    tmp_post_num, tgt_lat, tgt_lng = wg.geocode_retry(str(post_num))
+    station = nearest_station(tgt_lat, tgt_lng, 1, path).iloc[0].copy()
+    station["post_num"] = tmp_post_num
+    return station
+
+
+def find_station(block_no, proc_no=None, path=registry_path):
+    # 戻り値: 観測所(Series)。見つからない場合はKeyError
+    # 同じ観測所が複数の地域に登録されている場合は、proc_no(省略時は最初)
+    load_registry(path)
+    area_DF = load_station_index(path).area_DF
+    mask = area_DF["block_no"] == str(block_no)
+    if proc_no is not None:
+        mask = mask & (area_DF["proc_no"] == str(proc_no))
+    if not mask.any():
+        raise KeyError("station not found: " + str(block_no))
+    return area_DF[mask].iloc[0].copy()
+
+
+def iter_hourly(station, start, end, mode="all", chunk="day",
+                with_flags=False, day_end=False):
+    # station: nearest_station等で取得した観測所(Series/dict)
+    #          proc_no、block_no、ObservatoryTypeを使用する
+    # start, end: 開始日・終了日(YYYYMMDD、datetime等)
+    # mode: "all"(全ての列)、または列番号(0始まり、時間が0列目)
+    # chunk: "day"、"month"、または日数
+    # day_end: Trueの場合は、各区間の終了日の"24時"(翌日の0時)の行も返す
+    #          (次の区間の最初の行と同じ日時になる)
+    # 戻り値: 区間毎の気象データ(weather_get.process_dataの形式)
+    #         with_flags=Trueの場合は (気象データ, 品質情報)
+    start_datetime = wg.datetime_parser(str(start))
+    end_datetime = wg.datetime_parser(str(end))
+    if start_datetime > end_datetime:
+        raise ValueError("start is later than end: " + str(start) + ", "
+                         + str(end))
+    if chunk == "day":
+        chunk_days = 1
+    elif chunk == "month":
+        chunk_days = "month"
+    else:
+        chunk_days = int(chunk)
+
+    mode_flag = "all" if mode == "all" else "col"
+    tgt_col, url1 = wg.get_type_params(station["ObservatoryType"], mode,
+                                       mode)
+    url_str = wg.make_url_str(url1, station["proc_no"], station["block_no"])
+    wg.record_demand(station["proc_no"], station["block_no"])
+
+    for tmp_start, tmp_end, stack in wg.iter_weather_data(
+            url_str, start_datetime, end_datetime, mode_flag, tgt_col,
+            chunk_days):
+        out_data, flag_data = wg.process_data(
+            stack, str(tmp_start)[0:10], str(tmp_end)[0:10], mode_flag,
+            day_end=day_end)
+        if with_flags:
+            yield out_data, flag_data
+        else:
+            yield out_data
+
+
+def aggregate_stations(stations, start, end, freq="daily", chunk="month"):
+    # stations: 観測所(Series/dict)のリスト
+    # freq: "daily"または"monthly"
+    # 戻り値: (集計値, 品質情報) weather_agg.aggregateと同じ形式
+    #         観測所名は "<block_no>_<area>"
+    frames = {}
+    flag_frames = {}
+    for station in stations:
+        name = str(station["block_no"]) + "_" + str(station["area"])
+        # 終了日は1時〜24時(翌日の0時)で集計するため、"24時"の行も取得
+        # する(区間の境界で重なる行は1つにする)
+        chunks = list(iter_hourly(station, start, end, chunk=chunk,
+                                  with_flags=True, day_end=True))
+        out_data = pd.concat([tmp[0] for tmp in chunks], ignore_index=True)
+        keep = ~out_data[weather_agg.time_col].duplicated(keep="last").values
+        frames[name] = out_data[keep].reset_index(drop=True)
+        flag_frames[name] = pd.concat(
+            [tmp[1] for tmp in chunks], ignore_index=True)[keep] \
+            .reset_index(drop=True)
+    return weather_agg.aggregate(frames, freq, flag_frames)
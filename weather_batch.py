@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 複数の郵便番号・期間(ジョブ)をまとめて処理し、最寄りの観測所
+#              から気象データ(1時間単位)を取得する
+#              同じ観測所(prec_no/block_no)に対応するジョブは、重なる・隣接
+#              する期間をまとめて1回だけ取得し、各ジョブの期間を切り出して
+#              出力する
+# arguments:
+#   argvs[1]: ジョブファイルのパス
+#             1行1ジョブで「郵便番号,開始日(YYYYMMDD),終了日(YYYYMMDD)」
+#             空行と"#"で始まる行は無視する
+#             "check"モード時は開始日、終了日は省略可
+#   argvs[2]: モードフラグ("check"、"all"、列番号) ※weather_get.pyと同じ
+#   argvs[3]: 出力先ディレクトリのパス
+#   argvs[4]: 読込開始行番号 "check"モード時は不要  ※2018/2現在は"2"で固定
+#             ※見出し行はページ毎に形式(page_layouts.py)から判定するため、
+#             値は使用しない
+#   argvs[5]: 取得するデータの単位("hourly"、"daily"、"monthly")
+#             省略時は"hourly" ※weather_get.pyと同じ
+# output:
+#   ジョブ毎に weather_get.py と同じ名前・内容のファイルを出力する
+#   (取得できなかった日がある場合の".gaps"ファイル・再実行時の再取得も
+#   weather_get.pyと同じ)
+
+# --基本モジュール--
+import os
+import sys
+
+import pandas as pd
+
+import weather_get as wg
+from output_store import get_default_store, merge_ranges
+from metrics import start_run
+
+# ログ用
+import traceback
+from logging import getLogger, StreamHandler, FileHandler, INFO, WARN
+import datetime
+cmd = "weather_batch"
+pid = str(os.getpid())
+logfile = "/tmp/"+cmd+"_"+pid+".log"
+logger = getLogger(cmd)
+Fhandler = FileHandler(logfile)
+Fhandler.setLevel(INFO)
+logger.addHandler(Fhandler)
+Shandler = StreamHandler()
+Shandler.setLevel(WARN)
+logger.addHandler(Shandler)
+logger.setLevel(INFO)
+# weather_get側の関数が出力するログも同じファイルに出力する
+wg.logger.addHandler(Fhandler)
+wg.logger.addHandler(Shandler)
+
+
+# 関数定義
+def read_jobs(job_file, mode_flag):
+    # 戻り値: (行番号, 項目のリスト) のリスト
+    # 項目の数はcheck_jobでチェックする
+    jobs = []
+    with open(job_file, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if (line == "") or line.startswith("#"):
+                continue
+            items = [x.strip() for x in line.split(",")]
+            if mode_flag == "check":
+                items = (items + ["20170101", "20170131"])[0:3]
+            jobs.append((line_no, items))
+    return jobs
+
+
+def check_job(items):
+    # ジョブの内容が不正な場合はValueErrorとする
+    # 戻り値: (郵便番号, 開始日, 終了日, 開始日時, 終了日時)
+    if len(items) != 3:
+        raise ValueError("number of items is incorrect: " + str(len(items)))
+    post_num, start_date, end_date = items
+    if (len(post_num) != 7) or (not post_num.isdigit()):
+        raise ValueError("post_num is incorrect: " + post_num)
+    return (post_num, start_date, end_date, wg.datetime_parser(start_date),
+            wg.datetime_parser(end_date))
+
+
+# main処理
+if __name__ == '__main__':
+
+    start_run(cmd)
+
+    # 引数取得
+    argvs = sys.argv
+    arg_str = ' '.join(map(str, argvs))
+
+    # ログ関数生成
+    def error_exit(code, msg):
+        d = datetime.datetime.today()
+        logger.error(d.strftime("%Y-%m-%d %H:%M:%S")+" ERROR "+cmd+" - "
+                     + str(msg)+" command: "+arg_str)
+        logfile2 = \
+            "/var/log/"+cmd+"_"+d.strftime("%Y%m%d%H%M%S")+"_"+pid+".log"
+        os.rename(logfile, logfile2)
+        sys.exit(code)
+
+    def warn_print(msg):
+        d = datetime.datetime.today()
+        logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
+                    + str(msg)+" command: "+arg_str)
+
+    def debug_print(msg):
+        d = datetime.datetime.today()
+        logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                    + str(msg)+" command: "+arg_str)
+
+    # 引数チェック
+    debug_print("start process.")
+
+    debug_print("start checking argments.")
+    if len(argvs) <= 3:
+        error_exit(1, "number of args is less than expected. [main]")
+
+    try:
+        job_file = str(argvs[1])
+        mode_flag = str(argvs[2])
+        out_dir = str(argvs[3])
+        start_row = 2
+        tgt_col_s = 1
+        tgt_col_a = 1
+        resolution = "hourly"
+        if mode_flag != "check":
+            start_row = int(argvs[4])
+            if len(argvs) > 5:
+                resolution = str(argvs[5])
+            if mode_flag != "all":
+                tgt_col_s = int(str(mode_flag).split(",")[0])
+                tgt_col_a = int(str(mode_flag).split(",")[1])
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [str/int]")
+
+    # 出力先ディレクトリが存在することのチェック
+    if not os.path.exists(out_dir):
+        error_exit(1, "output directory does not exists. [main]")
+
+    # 読込開始行番号が1以上であることのチェック
+    if start_row < 1:
+        error_exit(1, "start_row is less than 1. [main]")
+
+    # 取得するデータの単位のチェック
+    if resolution not in wg.resolutions:
+        error_exit(1, "resolution is incorrect. [main]")
+
+    try:
+        jobs = read_jobs(job_file, mode_flag)
+    except:
+        error_exit(1, "failed to read job file. trace: "
+                   + traceback.format_exc() + " [read_jobs]")
+    debug_print("end checking argments. jobs: " + str(len(jobs)))
+
+    # 不正なジョブ、取得に失敗したジョブは警告を出して次のジョブへ進み、
+    # 最後に件数をまとめて異常終了とする
+    err_cnt = 0
+
+    # 郵便番号データの取得(同じ郵便番号は1回だけ問い合わせる)
+    debug_print("start getting post_num data.")
+    post_data = {}
+    valid_jobs = []
+    for line_no, items in jobs:
+        try:
+            post_num, start_date, end_date, start_datetime, end_datetime = \
+                check_job(items)
+        except:
+            warn_print("job is incorrect. line: " + str(line_no) + ", "
+                       + str(sys.exc_info()[1]))
+            err_cnt = err_cnt + 1
+            continue
+        if post_num not in post_data:
+            try:
+                post_data[post_num] = wg.Observatory_get_retry(post_num)
+            except:
+                warn_print("failed to get post num data: " + post_num
+                           + " trace: " + traceback.format_exc())
+                post_data[post_num] = None
+        if post_data[post_num] is None:
+            err_cnt = err_cnt + 1
+            continue
+        valid_jobs.append((post_num, start_date, end_date,
+                           start_datetime, end_datetime))
+    debug_print("end getting post_num data. post_nums: "
+                + str(len(post_data)))
+
+    # checkモードなら、郵便番号毎に県名、市町村名を出力して終了
+    if mode_flag == "check":
+        debug_print("start output file.")
+        for post_num, _, _, _, _ in valid_jobs:
+            tmp_post_num, nearest_pref, nearest_area = \
+                post_data[post_num][0:3]
+            try:
+                outDF = pd.DataFrame([tmp_post_num, nearest_pref,
+                                      nearest_area])
+                outDF.to_csv(out_dir + "/" + post_num + ".csv",
+                             index=False, header=False)
+            except:
+                warn_print("failed to output file. trace: "
+                           + traceback.format_exc() + " [DataFrame/to_csv]")
+                err_cnt = err_cnt + 1
+        debug_print("end output file.")
+
+    else:
+        def write_jobs_by_chunk(url_str, tgt_col, range_start, range_end,
+                                range_jobs, gaps):
+            # 期間(range_start - range_end)を区間毎に取得し、区間と重なる
+            # 部分をジョブ毎に out_file + ".part" に追記する
+            written = set()
+            for chunk_start, chunk_end, stack in wg.iter_weather_data(
+                    url_str, range_start, range_end, mode_flag, tgt_col,
+                    gaps=gaps, resolution=resolution):
+                for out_file, _, _, start_datetime, end_datetime \
+                        in range_jobs:
+                    tmp_start = max(start_datetime, chunk_start)
+                    tmp_end = min(end_datetime, chunk_end)
+                    if tmp_start > tmp_end:
+                        continue
+                    tmp_data = wg.process_data(
+                        stack, str(tmp_start)[0:10], str(tmp_end)[0:10],
+                        mode_flag, resolution)[0]
+                    with wg.metrics.timer("write"):
+                        tmp_data.to_csv(
+                            out_file + ".part",
+                            mode="a" if out_file in written else "w",
+                            header=out_file not in written, index=False)
+                    written.add(out_file)
+
+        def output_range(store, tgt_proc_no, tgt_block_no, url1, tgt_col,
+                         range_start, range_end, range_jobs):
+            # 期間(range_start - range_end)を1回だけ取得し、期間に含まれる
+            # ジョブ毎に出力する
+            # 戻り値: 失敗したジョブの数
+            debug_print("start getting weather data. tgt_proc_no: "
+                        + str(tgt_proc_no) + ", tgt_block_no: "
+                        + str(tgt_block_no) + ", jobs: "
+                        + str(len(range_jobs)) + ", period: "
+                        + str(range_start)[0:10] + " - "
+                        + str(range_end)[0:10])
+            url_str = wg.make_url_str(url1, tgt_proc_no, tgt_block_no)
+            # 保存先(WEATHER_STORE)の指定がある場合は、保存先に無い日付だけを
+            # 取得し、ジョブ毎に保存先から出力する
+            gaps = []
+            if store is not None:
+                set_name = wg.store_set_name(mode_flag, tgt_col, resolution)
+                try:
+                    day_cnt = wg.update_store(
+                        store, set_name, tgt_proc_no, tgt_block_no, url_str,
+                        range_start, range_end, mode_flag, tgt_col, gaps,
+                        resolution)
+                except:
+                    warn_print("failed to get weather data. trace: "
+                               + traceback.format_exc() + " [update_store]")
+                    return len(range_jobs)
+                debug_print("end getting weather data. fetched days: "
+                            + str(day_cnt))
+            else:
+                # 区間(iter_weather_data)毎に取得し、期間が重なるジョブの
+                # ファイル(".part")に追記する(メモリ使用量は区間の分だけ)
+                try:
+                    write_jobs_by_chunk(url_str, tgt_col, range_start,
+                                        range_end, range_jobs, gaps)
+                except:
+                    warn_print("failed to get weather data. trace: "
+                               + traceback.format_exc()
+                               + " [write_jobs_by_chunk]")
+                    for job in range_jobs:
+                        if os.path.exists(job[0] + ".part"):
+                            os.remove(job[0] + ".part")
+                    return len(range_jobs)
+                debug_print("end getting weather data.")
+
+            # ジョブ毎に出力
+            job_err_cnt = 0
+            for out_file, start_date, end_date, start_datetime, \
+                    end_datetime in range_jobs:
+                try:
+                    if store is not None:
+                        tmp_data = wg.read_store_range(
+                            store, set_name, tgt_proc_no, tgt_block_no,
+                            start_datetime, end_datetime, resolution)
+                        with wg.metrics.timer("write"):
+                            tmp_data.to_csv(out_file, index=False)
+                    else:
+                        os.replace(out_file + ".part", out_file)
+                    wg.write_gaps(out_file, gaps, start_datetime,
+                                  end_datetime, resolution)
+                except:
+                    warn_print("failed to output file. trace: "
+                               + traceback.format_exc() + " [to_csv]")
+                    job_err_cnt = job_err_cnt + 1
+                    continue
+                debug_print("output file: " + out_file)
+            return job_err_cnt
+
+        # 観測所毎にジョブをまとめる
+        station_jobs = {}
+        for job in valid_jobs:
+            tgt_proc_no, tgt_block_no = post_data[job[0]][3:5]
+            station_jobs.setdefault((tgt_proc_no, tgt_block_no),
+                                    []).append(job)
+        debug_print("stations: " + str(len(station_jobs)))
+        store = get_default_store()
+
+        for (tgt_proc_no, tgt_block_no), tmp_jobs in station_jobs.items():
+            nearest_pref, nearest_area = post_data[tmp_jobs[0][0]][1:3]
+            tgt_type = post_data[tmp_jobs[0][0]][5]
+            try:
+                tgt_col, url1 = wg.get_type_params(tgt_type, tgt_col_s,
+                                                   tgt_col_a, resolution)
+            except ValueError:
+                warn_print("internal error, ObservatoryType unexpected: "
+                           + str(tgt_type) + ". [main]")
+                err_cnt = err_cnt + len(tmp_jobs)
+                continue
+            wg.record_demand(tgt_proc_no, tgt_block_no, len(tmp_jobs))
+
+            # 結果ファイルが既に存在するジョブはスキップ
+            out_jobs = []
+            for post_num, start_date, end_date, start_datetime, \
+                    end_datetime in tmp_jobs:
+                out_file = wg.make_out_file(out_dir, nearest_pref,
+                                            nearest_area, mode_flag, tgt_col,
+                                            start_date, end_date, resolution)
+                if os.path.exists(out_file):
+                    warn_print("output file already exists: " + out_file)
+                    if wg.read_gaps(out_file) is None:
+                        continue
+                    # 前回取得できなかった日だけを取得し直す
+                    try:
+                        url_str = wg.make_url_str(url1, tgt_proc_no,
+                                                  tgt_block_no)
+                        gap_cnt = wg.refill_gaps(out_file, url_str,
+                                                 mode_flag, tgt_col,
+                                                 resolution)
+                    except:
+                        warn_print("failed to refill weather data. trace: "
+                                   + traceback.format_exc()
+                                   + " [refill_gaps]")
+                        err_cnt = err_cnt + 1
+                        continue
+                    debug_print("refilled file: " + out_file
+                                + ", remaining days: " + str(gap_cnt))
+                    continue
+                # 同じ出力ファイルのジョブ(同じ気象台・期間の別の郵便番号)
+                # は1回だけ出力する
+                if out_file in [job[0] for job in out_jobs]:
+                    continue
+                out_jobs.append((out_file, start_date, end_date,
+                                 start_datetime, end_datetime))
+            if len(out_jobs) == 0:
+                continue
+
+            # 重なる・隣接する期間をまとめ、まとめた期間毎に1回だけ取得する
+            # (離れた期間の間の日付は取得しない)
+            for range_start, range_end in merge_ranges(
+                    [(job[3], job[4]) for job in out_jobs]):
+                range_jobs = [job for job in out_jobs
+                              if range_start <= job[3] <= range_end]
+                err_cnt = err_cnt + output_range(
+                    store, tgt_proc_no, tgt_block_no, url1, tgt_col,
+                    range_start, range_end, range_jobs)
+
+    if err_cnt > 0:
+        error_exit(2, "number of failed jobs: " + str(err_cnt) + ". [main]")
+
+    debug_print("end process.")
+    os.remove(logfile)
+
+    sys.exit(0)
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象庁・heartrailsのサイトにアクセスせずに、各コマンドの性能を
+#              測定する
+#              ローカルに代替のHTTPサーバを起動し、bench_fixtures配下の記録済
+#              みのページ(1時間毎・日毎・月毎の値のページ、郵便番号の位置)と、
+#              area_data_temp_valid.regから生成した地域・観測所の一覧の
+#              ページを返す。各コマンドは環境変数 WEATHER_JMA_URL、
+#              WEATHER_GEO_URL で代替のサーバを参照する
+#              代替のサーバはkeep-alive・gzip・ETag(If-None-Match)に対応
+#              シナリオ:
+#              - registry: 気象台の一覧生成(make_area_data.py)
+#              - single: 1つの気象台の複数年の取得(weather_get.py "all")
+#              - daily/monthly: singleと同じ期間の日毎・月毎の値の取得
+#              - batch: 多数の郵便番号の一括取得(weather_batch.py)
+#              - check: 郵便番号毎の"check"モード(weather_get.py)
+# arguments:
+#   argvs[1]: シナリオ("all"、またはカンマ区切りのシナリオ名)
+#   argvs[2]: 代替サーバの応答の遅延(ミリ秒) 省略時は0
+#   argvs[3]: 代替サーバがエラー(503)を返す割合(0〜1) 省略時は0
+#   argvs[4]: 結果を追記するファイル(JSON、1行1シナリオ) 省略時は出力しない
+# output:
+#   シナリオ毎に以下を標準出力に出力する
+#   pages: 代替サーバが返したページ数、pages_per_sec: 1秒あたりのページ数、
+#   cpu_ms_per_page: 1ページあたりのCPU時間(コマンド側、ミリ秒)、
+#   peak_rss_mb: コマンドの最大メモリ使用量(MB)、
+#   latency_mean_sec/latency_max_sec: コマンド1回の所要時間(秒)
+
+# --基本モジュール--
+import csv
+import gzip
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+
+import station_registry
+
+
+# 変数定義
+base_dir = os.path.dirname(os.path.abspath(__file__))
+fixture_dir = os.path.join(base_dir, "bench_fixtures")
+registry_file = os.path.join(base_dir, station_registry.registry_file)
+scenario_names = ["registry", "single", "daily", "monthly", "batch",
+                  "check"]
+# singleシナリオの郵便番号・期間
+single_post_num = "1000001"
+single_period = ("20150101", "20171231")
+# batchシナリオの期間(郵便番号はpostal.csvの全て+位置の無い郵便番号)
+batch_period = ("20170101", "20170131")
+batch_unknown_post_num = "1000099"
+# 測定中のコマンドに設定する環境変数
+# (リクエスト数の制限・キャッシュ・保存先・ページの保管・要求回数の記録・
+# 郵便番号の索引を使用しない)
+bench_env = {
+    "WEATHER_RATE": "1000000",
+    "WEATHER_BURST": "1000",
+    "WEATHER_CACHE": "",
+    "WEATHER_STORE": "",
+    "WEATHER_ARCHIVE": "",
+    "WEATHER_DEMAND": "",
+    "WEATHER_POSTAL_INDEX": "",
+}
+
+
+# 関数定義
+def read_postal_fixture(path=None):
+    # 戻り値: {郵便番号: (都道府県名, 市区町村名, 緯度, 経度)}
+    if path is None:
+        path = os.path.join(fixture_dir, "postal.csv")
+    postal = {}
+    with open(path, encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            postal[row["post_num"]] = (row["prefecture"], row["city"],
+                                       float(row["lat"]), float(row["lng"]))
+    return postal
+
+
+def read_page_fixtures():
+    pages = {}
+    for kind in ("hourly_s1", "hourly_a1", "daily_s1", "daily_a1",
+                 "monthly_s1", "monthly_a1"):
+        with open(os.path.join(fixture_dir, kind + ".html"),
+                  encoding="utf-8") as f:
+            pages[kind] = f.read().encode("utf-8")
+    return pages
+
+
+def to_deg_min(x):
+    deg = int(x)
+    return str(deg), "%.1f" % ((x - deg)*60.0)
+
+
+def render_pref_list(registry):
+    # 地域の一覧のページ(prefecture00.php)
+    areas = []
+    for pref, prec_no in registry[["pref", "proc_no"]].drop_duplicates() \
+            .itertuples(index=False):
+        areas.append('<area shape="rect" alt="' + escape(pref)
+                     + '" coords="0,0,10,10" href="prefecture.php?prec_no='
+                     + str(prec_no) + '&block_no=&year=&month=&day=&view=">')
+    return ('<html><body><map name="point">\n' + "\n".join(areas)
+            + '\n</map></body></html>').encode("utf-8")
+
+
+def render_pref_page(registry, prec_no):
+    # 地域毎の観測所の一覧のページ(prefecture.php)
+    # 実際のページと同様に、各観測所を2回(地図と一覧)含める
+    areas = []
+    for rec in registry[registry["proc_no"] == prec_no].itertuples(
+            index=False):
+        lat, lng = rec[4]
+        items = [rec.ObservatoryType, rec.block_no, rec.area, ""] \
+            + list(to_deg_min(lat)) + list(to_deg_min(lng)) \
+            + [str(rec[5]), "1", "1", "1", "1", "1", "9999", "99", "99",
+               "", "", "", "", ""]
+        area = ('<area shape="rect" alt="' + escape(rec.area)
+                + '" coords="0,0,10,10" href="../index.php?prec_no='
+                + str(prec_no) + '&block_no=' + str(rec.block_no)
+                + '&year=&month=&day=&view=" onmouseover="javascript:'
+                + "viewPoint('" + "','".join(items) + "');\">")
+        areas.extend([area, area])
+    return ('<html><body><map name="point">\n' + "\n".join(areas)
+            + '\n</map></body></html>').encode("utf-8")
+
+
+def render_geo(postal, post_num):
+    # heartrails APIの応答(XML)
+    if post_num not in postal:
+        body = "<error>Postal code does not exist.</error>"
+    else:
+        pref, city, lat, lng = postal[post_num]
+        body = ("<location><city>" + escape(city) + "</city><town></town>"
+                + "<x>" + str(lng) + "</x><y>" + str(lat) + "</y>"
+                + "<prefecture>" + escape(pref) + "</prefecture>"
+                + "<postal>" + post_num + "</postal></location>")
+    return ('<?xml version="1.0" encoding="UTF-8"?><response>' + body
+            + "</response>").encode("utf-8")
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    # 気象庁・heartrailsの代替サーバ
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0):
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.registry = station_registry.read_registry(registry_file) \
+            .to_frame()
+        self.postal = read_postal_fixture()
+        self.pages = read_page_fixtures()
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset_counts(self):
+        with self.lock:
+            counts = self.counts
+            self.counts = {}
+        return counts
+
+    def is_error(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def jma_url(self):
+        return "http://%s:%d/obd/stats/etrn/" % self.server_address[0:2]
+
+    def geo_url(self):
+        return "http://%s:%d/api/xml" % self.server_address[0:2]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # keep-aliveに対応する(応答には常にContent-Lengthを付ける)
+    # ヘッダと内容を別々に書き込むため、Nagleアルゴリズムを無効にする
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        kind = os.path.splitext(os.path.basename(url.path))[0]
+        if server.latency > 0:
+            time.sleep(server.latency)
+        if server.is_error():
+            server.count("error")
+            self.send_error(503)
+            return
+        if kind == "prefecture00":
+            body = render_pref_list(server.registry)
+        elif kind == "prefecture":
+            body = render_pref_page(server.registry,
+                                    query.get("prec_no", [""])[0])
+        elif kind in server.pages:
+            body = server.pages[kind]
+        elif url.path.endswith("/api/xml"):
+            body = render_geo(server.postal, query.get("postal", [""])[0])
+        else:
+            server.count("error")
+            self.send_error(404)
+            return
+        server.count(kind)
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            server.count("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=UTF-8")
+        self.send_header("ETag", etag)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, 6)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_stand_in(latency=0.0, error_rate=0.0):
+    server = StandInServer(("127.0.0.1", 0), latency, error_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run_command(args, env, work_dir, log):
+    # コマンドを実行し、(終了コード, 所要時間, CPU時間, 最大メモリ(KB))を返す
+    start = time.monotonic()
+    proc = subprocess.Popen([sys.executable] + args, env=env, cwd=work_dir,
+                            stdout=log, stderr=log)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    return (proc.returncode, time.monotonic() - start,
+            usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+
+
+def scenario_commands(name, work_dir, postal):
+    # シナリオのコマンド(引数)のリスト
+    out_dir = os.path.join(work_dir, "out")
+
+    def script(file_name):
+        return os.path.join(base_dir, file_name)
+
+    if name == "registry":
+        return [[script("make_area_data.py"), work_dir]]
+    if name == "single":
+        return [[script("weather_get.py"), single_post_num, "all", out_dir,
+                 single_period[0], single_period[1], "2"]]
+    if name in ("daily", "monthly"):
+        return [[script("weather_get.py"), single_post_num, "all", out_dir,
+                 single_period[0], single_period[1], "3", name]]
+    if name == "batch":
+        job_file = os.path.join(work_dir, "jobs.csv")
+        with open(job_file, "w", encoding="utf-8") as f:
+            for post_num in sorted(postal) + [batch_unknown_post_num]:
+                f.write(post_num + "," + batch_period[0] + ","
+                        + batch_period[1] + "\n")
+        return [[script("weather_batch.py"), job_file, "4,2", out_dir, "2"]]
+    if name == "check":
+        return [[script("weather_get.py"), post_num, "check", out_dir]
+                for post_num in sorted(postal)]
+    raise ValueError("unknown scenario: " + str(name))
+
+
+def run_scenario(name, server, work_dir):
+    env = dict(os.environ)
+    env.update(bench_env)
+    env["WEATHER_JMA_URL"] = server.jma_url()
+    env["WEATHER_GEO_URL"] = server.geo_url()
+    out_dir = os.path.join(work_dir, "out")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+
+    commands = scenario_commands(name, work_dir, server.postal)
+    server.reset_counts()
+    failed = 0
+    walls = []
+    cpu = 0.0
+    max_rss = 0
+    start = time.monotonic()
+    with open(os.path.join(work_dir, name + ".log"), "a") as log:
+        for args in commands:
+            code, wall, tmp_cpu, rss = run_command(args, env, work_dir, log)
+            failed = failed + (code != 0)
+            walls.append(wall)
+            cpu = cpu + tmp_cpu
+            max_rss = max(max_rss, rss)
+    total = time.monotonic() - start
+    counts = server.reset_counts()
+    errors = counts.pop("error", 0)
+    counts.pop("not_modified", 0)
+    pages = sum(counts.values())
+    return OrderedDict([
+        ("scenario", name),
+        ("commands", len(commands)),
+        ("failed", failed),
+        ("pages", pages),
+        ("server_errors", errors),
+        ("wall_sec", round(total, 3)),
+        ("pages_per_sec", round(pages/total, 2) if total > 0 else None),
+        ("cpu_ms_per_page",
+         round(cpu*1000.0/pages, 3) if pages > 0 else None),
+        ("peak_rss_mb", round(max_rss/1024.0, 1)),
+        ("latency_mean_sec", round(sum(walls)/len(walls), 3)),
+        ("latency_max_sec", round(max(walls), 3)),
+    ])
+
+
+def run_bench(names, latency=0.0, error_rate=0.0):
+    # 戻り値: シナリオ毎の結果(dict)のリスト
+    server = start_stand_in(latency, error_rate)
+    work_dir = tempfile.mkdtemp(prefix="weather_bench_")
+    try:
+        # 気象台の一覧は、registryシナリオを実行しない場合も必要
+        shutil.copy(registry_file, work_dir)
+        return [run_scenario(name, server, work_dir) for name in names]
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# main処理
+if __name__ == '__main__':
+
+    # ログ用
+    import traceback
+    from logging import getLogger, StreamHandler, FileHandler, INFO, WARN
+    import datetime
+    cmd = "weather_bench"
+    pid = str(os.getpid())
+    logfile = "/tmp/"+cmd+"_"+pid+".log"
+    logger = getLogger(cmd)
+    Fhandler = FileHandler(logfile)
+    Fhandler.setLevel(INFO)
+    logger.addHandler(Fhandler)
+    Shandler = StreamHandler()
+    Shandler.setLevel(WARN)
+    logger.addHandler(Shandler)
+    logger.setLevel(INFO)
+
+    # 引数取得
+    argvs = sys.argv
+    arg_str = ' '.join(map(str, argvs))
+
+    # ログ関数生成
+    def error_exit(code, msg):
+        d = datetime.datetime.today()
+        logger.error(d.strftime("%Y-%m-%d %H:%M:%S")+" ERROR "+cmd+" - "
+                     + str(msg)+" command: "+arg_str)
+        logfile2 = \
+            "/var/log/"+cmd+"_"+d.strftime("%Y%m%d%H%M%S")+"_"+pid+".log"
+        os.rename(logfile, logfile2)
+        sys.exit(code)
+
+    def debug_print(msg):
+        d = datetime.datetime.today()
+        logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                    + str(msg)+" command: "+arg_str)
+
+    debug_print("start process.")
+
+    # 引数チェック
+    debug_print("start checking argments.")
+    if len(argvs) <= 1:
+        error_exit(1, "number of args is less than expected. [main]")
+
+    try:
+        names = scenario_names if argvs[1] == "all" \
+            else str(argvs[1]).split(",")
+        latency = float(argvs[2])/1000.0 if len(argvs) > 2 else 0.0
+        error_rate = float(argvs[3]) if len(argvs) > 3 else 0.0
+        result_file = str(argvs[4]) if len(argvs) > 4 else None
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [str/float]")
+    for name in names:
+        if name not in scenario_names:
+            error_exit(1, "unknown scenario: " + name + ". [main]")
+    debug_print("end checking argments.")
+
+    debug_print("start benchmark.")
+    try:
+        results = run_bench(names, latency, error_rate)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [run_bench]")
+    debug_print("end benchmark.")
+
+    for result in results:
+        print(" ".join(key + "=" + str(value)
+                       for key, value in result.items()))
+    if result_file is not None:
+        try:
+            with open(result_file, "a", encoding="utf-8") as f:
+                for result in results:
+                    f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        except:
+            error_exit(2, "function error. trace: "
+                       + traceback.format_exc() + " [write]")
+
+    debug_print("end process.")
+    os.remove(logfile)
+
+    sys.exit(0)
@@ -13,32 +13,61 @@
 #   argvs[4]: 開始日(YYYYMMDD) "check"モード時は不要
 #   argvs[5]: 終了日(YYYYMMDD) "check"モード時は不要
 #   argvs[6]: 読込開始行番号 "check"モード時は不要  ※2018/2現在は"2"で固定
+#             (日毎・月毎の場合は"3") ※見出し行はページ毎に形式
+#             (page_layouts.py)から判定するため、値は使用しない
+#   argvs[7]: 取得するデータの単位 省略時は"hourly"
+#             "hourly": 1時間毎の値(1日1ページ)
+#             "daily": 日毎の値(1か月1ページ)
+#             "monthly": 月毎の値(1年1ページ)
+#             ※列番号は、それぞれのページの表の列番号を指定する
 # output:
 #   - "check"モード指定時
 #     ファイル名：郵便番号.csv
 #     内容：最寄りの気象台の都道府県名、都市名（CSV）
 #   - "all"モード指定時
 #     ファイル名：都道府県名_都市名_開始日_終了日.csv
+#               (日毎・月毎の場合は 都道府県名_都市名_daily_... 等)
 #     内容：全気象データ（CSV）
 #   - 列番号を指定した場合
 #     ファイル名：都道府県名_都市名_開始日_終了日.csv
 #     内容：日時と指定した列番号のデータ（CSV）
+#   - 取得できなかった日がある場合(リトライしても失敗した場合)
+#     ファイル名：出力ファイル名 + ".gaps"
+#     内容：取得できなかった日付のリスト(JSON)。その日の値は空欄で出力し、
+#           同じ引数で再実行した時に、その日だけを取得して出力ファイルを
+#           更新する
 
 # --基本モジュール--
 import pandas as pd
 import numpy as np
+import json
 import os
 import sys
 
 import time
+import calendar
 import dateutil.parser  # 変数の時間型への変換で使用
 from dateutil.relativedelta import relativedelta
 
-import urllib.request
-import pickle
 
 import xml.etree.ElementTree as ET
-from math import sin, cos, acos, radians
+
+from station_index import load_station_index
+from station_registry import ensure_registry, registry_file, \
+    RegistryVersionError
+from postal_geocoder import load_postal_geocoder, post_num_candidates
+from page_cache import get_default_cache, CacheMiss
+from page_archive import get_default_archive
+from station_demand import get_default_demand
+from fetch_engine import fetch_map, get_default_bucket, Coalescer, \
+    get_default_retry, is_retryable, check_failure_budget, CircuitOpen, \
+    FailureBudgetExceeded
+from jma_parser import parse_hourly, stack_hourly, gap_hourly, \
+    FLAG_MISSING, FLAG_TEXT, text_cells
+from page_layouts import align_tables, match_layout, text_cols
+from output_store import get_default_store, merge_ranges, subtract_ranges
+from metrics import get_metrics, start_run
+import http_client
 
 # ログ用
 import traceback
@@ -48,120 +77,766 @@ cmd = "weather_get"
 pid = str(os.getpid())
 logfile = "/tmp/"+cmd+"_"+pid+".log"
 logger = getLogger(cmd)
-Fhandler = FileHandler(logfile)
-Fhandler.setLevel(INFO)
-logger.addHandler(Fhandler)
-Shandler = StreamHandler()
-Shandler.setLevel(WARN)
-logger.addHandler(Shandler)
 logger.setLevel(INFO)
+arg_str = ' '.join(map(str, sys.argv))
 
 
-# 変数定義
-check_flag = True
-earth_rad = 6378.137
-url1_s = "http://www.data.jma.go.jp/obd/stats/etrn/view/hourly_s1.php?prec_no="
-url1_a = "http://www.data.jma.go.jp/obd/stats/etrn/view/hourly_a1.php?prec_no="
-url2 = "http://geoapi.heartrails.com/api/xml?method=searchByPostal&postal="
-# 2018/2時点のカラム名
-# # 気象台
-temp_col0_s = ['時', '気圧(hPa)', '降水量(mm)', '気温(℃)', '露点温度(℃)',
-               '蒸気圧(hPa)', '湿度(％)', '風向・風速(m/s)', '日照時間(h)',
-               '全天日射量(MJ/㎡)', '雪(cm)', '天気', '雲量', '視程(km)',
-               np.nan, np.nan, np.nan]
-temp_col1_s = ['現地', '海面', '風速', '風向', '降雪', '積雪',
-               np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan,
-               np.nan, np.nan, np.nan]
-template_s = pd.DataFrame([temp_col0_s, temp_col1_s])
-temp_cols_s = len(temp_col0_s)
-output_col_s = ["日時", "気圧hPa_現地", "気圧hPa_海面", "降水量mm",
-                "気温℃", "露点温度℃", "蒸気圧hPa", "湿度％",
-                "風速m／s", "風向", "日照時間h", "全天日射量MJ／㎡",
-                "雪cm_降雪", "雪cm_積雪", "天気", "雲量", "視程km"]
-
-# # その他の観測所
-temp_col0_a = ['時', '降水量(mm)', '気温(℃)', '風速・風向(m/s)',
-               '日照時間(h)', '雪(cm)', np.nan, np.nan]
-temp_col1_a = ['風速', '風向', '降雪', '積雪',
-               np.nan, np.nan, np.nan, np.nan]
-template_a = pd.DataFrame([temp_col0_a, temp_col1_a])
-temp_cols_a = len(temp_col0_a)
-output_col_a = ["日時", "降水量mm", "気温℃", "風速m／s", "風向",
-                "日照時間h", "雪cm_降雪", "雪cm_積雪"]
+def setup_logger():
+    # コマンドとして実行する場合のみログファイルを作成する
+    # (他のコマンドからimportした場合に/tmpにログファイルを残さないため)
+    Fhandler = FileHandler(logfile)
+    Fhandler.setLevel(INFO)
+    logger.addHandler(Fhandler)
+    Shandler = StreamHandler()
+    Shandler.setLevel(WARN)
+    logger.addHandler(Shandler)
 
 
-# 関数定義
-def latlng_to_xyz(lat, lng):
-    rlat, rlng = radians(lat), radians(lng)
-    coslat = cos(rlat)
-    return coslat*cos(rlng), coslat*sin(rlng), sin(rlat)
+def warn_print(msg):
+    d = datetime.datetime.today()
+    logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
 
 
-def dist_on_sphere(pos0, pos1, radious=earth_rad):
-    xyz0, xyz1 = latlng_to_xyz(*pos0), latlng_to_xyz(*pos1)
-    return acos(sum(x * y for x, y in zip(xyz0, xyz1)))*radious
+def debug_print(msg):
+    d = datetime.datetime.today()
+    logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
 
 
+# 変数定義
+# 1回に取得・出力する日数(WEATHER_CHUNK_DAYSで変更可能)
+default_chunk_days = 31
+# 取得中のページ(同じページの同時取得をまとめる)
+page_calls = Coalescer()
+# ステージ毎の所要時間・件数(metrics.py)
+metrics = get_metrics()
+# 気象庁・heartrailsのURL(ベンチマーク等で別のサーバを使用する場合は
+# 環境変数 WEATHER_JMA_URL、WEATHER_GEO_URL で変更)
+jma_url = os.environ.get("WEATHER_JMA_URL",
+                         "http://www.data.jma.go.jp/obd/stats/etrn/")
+geo_url = os.environ.get("WEATHER_GEO_URL",
+                         "http://geoapi.heartrails.com/api/xml")
+url1_s = jma_url + "view/hourly_s1.php?prec_no="
+url1_a = jma_url + "view/hourly_a1.php?prec_no="
+# 日毎の値(1か月分のページ)、月毎の値(1年分のページ)
+url1_s_daily = jma_url + "view/daily_s1.php?prec_no="
+url1_a_daily = jma_url + "view/daily_a1.php?prec_no="
+url1_s_monthly = jma_url + "view/monthly_s1.php?prec_no="
+url1_a_monthly = jma_url + "view/monthly_a1.php?prec_no="
+# 取得するデータの単位("hourly": 1時間毎、"daily": 日毎、"monthly": 月毎)
+resolutions = ["hourly", "daily", "monthly"]
+url2 = geo_url + "?method=searchByPostal&postal="
+# (ObservatoryType, 単位): url1
+# ページの形式(見出し行)と列名は page_layouts.py に登録する
+type_params = {
+    ("s", "hourly"): url1_s,
+    ("a", "hourly"): url1_a,
+    ("s", "daily"): url1_s_daily,
+    ("a", "daily"): url1_a_daily,
+    ("s", "monthly"): url1_s_monthly,
+    ("a", "monthly"): url1_a_monthly,
+}
+
+
+# 関数定義
 def datetime_parser(x):
     return dateutil.parser.parse(x)
 
 
-def datetime_parser_2(x):
-    return dateutil.parser.parse(x) + relativedelta(days=1)
+def get_post_num_latlng(post_num):
+    # 郵便番号から緯度経度の取得(heartrails API)
+    # 応答に位置が無い(存在しない郵便番号の)場合はKeyError
+    str_url2 = url2 + str(post_num)
+    XmlData = get_default_retry().call(
+        str_url2, lambda: http_client.get(str_url2), log_retry)
 
+    root = ET.fromstring(XmlData)
+    tgt_x = root.findtext(".//x")
+    tgt_y = root.findtext(".//y")
+    if (not tgt_x) or (not tgt_y):
+        raise KeyError("post_num not found: " + str(post_num))
 
-def del_symbol(x):
-    '''
-    try:
-        ret_x = int(str(x).replace(" ]", "").replace(" )", ""))
-    except:
-        ret_x = str(x).replace(" ]", "").replace(" )", "")
-    return ret_x
-    '''
-    return str(x).replace(" ]", "").replace(" )", "")
+    return float(tgt_y), float(tgt_x)
 
 
 def Observatory_get_main(post_num):
     # 郵便番号から緯度経度の取得
-    str_url2 = url2 + str(post_num)
-    req = urllib.request.Request(str_url2)
+    tgt_lat, tgt_lng = get_post_num_latlng(post_num)
 
-    with urllib.request.urlopen(req) as response:
-        XmlData = response.read()
-        response.close()
+    return Observatory_get_latlng(tgt_lat, tgt_lng)
 
-    root = ET.fromstring(XmlData)
-    tgt_x = root.findtext(".//x")
-    tgt_y = root.findtext(".//y")
 
+def Observatory_get_latlng(tgt_lat, tgt_lng):
     # 緯度経度から最も近い観測所を見つける
-    def dist_frm_tgt(val):
-        tgt_place = float(tgt_y), float(tgt_x)
-        return dist_on_sphere(tgt_place, val)
+    # (索引はプロセス内で一度だけ構築し、ベクトル演算で探索する)
+    with metrics.timer("nearest"):
+        station_index = load_station_index(registry_file)
+        nearest = station_index.nearest(tgt_lat, tgt_lng)
 
-    # 気象台データ（オブジェクトファイル）の読み込み
-    with open('area_data_temp_valid.pickle', 'rb') as f:
-        area_DF = pickle.load(f)
+    nearest_pref = nearest.pref
+    nearest_area = nearest.area
+    tgt_proc_no = nearest.proc_no
+    tgt_block_no = nearest.block_no
+    tgt_type = nearest.ObservatoryType
 
-    area_DF["dist"] = area_DF["緯度_経度"].apply(dist_frm_tgt)
+    return nearest_pref, nearest_area, tgt_proc_no, tgt_block_no, tgt_type
 
-    nearest_index = area_DF.sort_values("dist").head(1).index
 
-    nearest_pref = area_DF.ix[nearest_index].pref.values[0]
-    nearest_area = area_DF.ix[nearest_index].area.values[0]
-    tgt_proc_no = area_DF.ix[nearest_index].proc_no.values[0]
-    tgt_block_no = area_DF.ix[nearest_index].block_no.values[0]
-    tgt_type = area_DF.ix[nearest_index].ObservatoryType.values[0]
+def geocode_retry(post_num):
+    # 郵便番号データの取得に失敗した場合は、以下の様に番号を変えてretry
+    # 1. 下4桁を全て"0"にする
+    # 2. 上3桁を"1"ずつ減らしていく(最大20回失敗するまで繰り返す)
+    # 戻り値: (実際に取得できた郵便番号, 緯度, 経度)
+    # 郵便番号の索引(post_num_latlng.npy)がある場合は、APIを使用せずに
+    # 索引の中で同じ順序で探す
+    # 全ての番号が見つからない場合はKeyError(通信の失敗等があった場合は、
+    # 最後のその例外)
+    with metrics.timer("geocode"):
+        geocoder = load_postal_geocoder()
+        if geocoder is not None:
+            return geocoder.lookup(post_num)
+
+        candidates = list(post_num_candidates(post_num))
+        error = None
+        for i, tmp_post_num in enumerate(candidates):
+            try:
+                return (tmp_post_num,) + get_post_num_latlng(tmp_post_num)
+            except KeyError:
+                warn_print("post num not found: " + str(tmp_post_num))
+            except:
+                warn_print("failed to get post num data: "
+                           + str(tmp_post_num))
+                error = sys.exc_info()[1]
+            if i == len(candidates) - 1:
+                break
+            warn_print("retry getting post num data: "
+                       + str(candidates[i+1]))
+            metrics.add("geocode_retry")
+            time.sleep(1)
+        if error is not None:
+            raise error
+        raise KeyError("post_num not found: " + str(post_num))
+
+
+def Observatory_get_retry(post_num):
+    # 戻り値: 実際に取得できた郵便番号と Observatory_get_main の戻り値
+    tmp_post_num, tgt_lat, tgt_lng = geocode_retry(post_num)
+    return (tmp_post_num,) + Observatory_get_latlng(tgt_lat, tgt_lng)
+
+
+def get_type_params(tgt_type, tgt_col_s, tgt_col_a, resolution="hourly"):
+    # 最寄が気象台か、その他観測所かでurl、データ形式が異なるための、対応
+    # (resolutionは取得するデータの単位、resolutionsを参照)
+    # 戻り値: tgt_col, url1
+    if resolution not in resolutions:
+        raise ValueError("resolution unexpected: " + str(resolution))
+    if (tgt_type, resolution) not in type_params:
+        raise ValueError("ObservatoryType unexpected: " + str(tgt_type))
+    tgt_col = tgt_col_s if tgt_type == "s" else tgt_col_a
+    return tgt_col, type_params[(tgt_type, resolution)]
+
+
+def make_url_str(url1, tgt_proc_no, tgt_block_no):
+    # 気象データ取得用URLの基本部分生成
+    return url1 + str(tgt_proc_no) + "&block_no=" + str(tgt_block_no) + "&"
+
+
+def make_day_url(url_str, tgt_datetime, resolution="hourly"):
+    # 日毎の値は月、月毎の値は年を指定したページ
+    if resolution == "daily":
+        return url_str + 'year=' + str(tgt_datetime.year) + '&month='\
+                       + str(tgt_datetime.month) + '&day=&view=p1'
+    if resolution == "monthly":
+        return url_str + 'year=' + str(tgt_datetime.year) \
+                       + '&month=&day=&view=p1'
+    return url_str + 'year=' + str(tgt_datetime.year) + '&month='\
+                   + str(tgt_datetime.month) + '&day='\
+                   + str(tgt_datetime.day) + '&view=p1'
+
+
+def page_datetimes(start_datetime, end_datetime, resolution="hourly"):
+    # 期間のデータを含むページの日付のリスト
+    # 1時間毎: 前日〜終了日("24時"を翌日の"0時"にするため前日から)
+    # 日毎: 各月の1日、月毎: 各年の1月1日
+    if resolution == "daily":
+        tmp_datetime = start_datetime + relativedelta(day=1)
+        step = relativedelta(months=1)
+    elif resolution == "monthly":
+        tmp_datetime = start_datetime + relativedelta(month=1, day=1)
+        step = relativedelta(years=1)
+    else:
+        tmp_datetime = start_datetime - relativedelta(days=1)
+        step = relativedelta(days=1)
+    tgt_datetimes = []
+    while tmp_datetime <= end_datetime:
+        tgt_datetimes.append(tmp_datetime)
+        tmp_datetime = tmp_datetime + step
+    return tgt_datetimes
 
-    return nearest_pref, nearest_area, tgt_proc_no, tgt_block_no, tgt_type
+
+def make_out_file(out_dir, nearest_pref, nearest_area, mode_flag, tgt_col,
+                  start_date, end_date, resolution="hourly"):
+    # 日毎・月毎の場合は、都市名の後に"_daily"/"_monthly"を付ける
+    if resolution != "hourly":
+        nearest_area = nearest_area + "_" + resolution
+    if mode_flag == "all":
+        return out_dir + "/" + nearest_pref + "_" + nearest_area \
+               + "_all_" + start_date + "_" + end_date + ".csv"
+    return out_dir + "/" + nearest_pref + "_" + nearest_area \
+        + "_" + str(tgt_col) + "_" + start_date + "_" + end_date + ".csv"
+
+
+def log_retry(retry_cnt, err, wait, url):
+    # RetryPolicyのリトライ前に呼ばれる
+    # (気象庁のページのURLには、year/month/dayで対象の日付が含まれる)
+    if isinstance(err, CircuitOpen):
+        metrics.add("circuit_open")
+    warn_print("retry getting data (" + str(retry_cnt) + ") after "
+               + str(round(wait, 1)) + "s: " + repr(err) + " url: " + url)
+    metrics.add("fetch_retry")
+
+
+def fetch_url(url):
+    # スクレイピング先のサーバに負荷をかけないように、プロセス全体の
+    # リクエスト数の上限(既定値は1秒に1件)を守って取得する
+    # (接続は再利用し、gzipで圧縮された応答を受け取る)
+    # 通信に失敗した場合は、待ち時間を延ばしながらリトライする
+    def get_func():
+        with metrics.timer("rate_wait"):
+            get_default_bucket().acquire()
+        with metrics.timer("fetch"):
+            return http_client.get(url)
+
+    body = get_default_retry().call(url, get_func, log_retry)
+    metrics.add("fetch_pages")
+    metrics.add("fetch_bytes", len(body))
+    # 保管先(WEATHER_ARCHIVE)の指定がある場合は、取得したページを保管する
+    archive = get_default_archive()
+    if archive is not None:
+        with metrics.timer("archive"):
+            archive.put(url, body)
+    return body
+
+
+def fetch_page(url):
+    # ページ(bytes)を取得する。キャッシュにあるページはキャッシュから取得
+    # 同じページを複数のスレッドが同時に要求した場合は、1回だけ取得する
+    def fetch_func():
+        cache = get_default_cache()
+        if cache is None:
+            return fetch_url(url)
+        body, fetched = cache.fetch(url, fetch_url)
+        if not fetched:
+            metrics.add("cache_hits")
+        return body
+    return page_calls.call(url, fetch_func)
+
+
+def record_demand(tgt_proc_no, tgt_block_no, count=1):
+    # 観測所の要求回数を記録する(weather_prefetch.pyの優先順位に使用)
+    # 記録に失敗しても処理は続ける
+    demand = get_default_demand()
+    if demand is None:
+        return
+    try:
+        demand.record(tgt_proc_no, tgt_block_no, count)
+    except:
+        warn_print("failed to record demand. trace: "
+                   + traceback.format_exc())
+
+
+def store_set_name(mode_flag, tgt_col, resolution="hourly"):
+    # 列指向ファイルの保存先の列セット名("all"または列番号)
+    # 日毎・月毎の場合は"daily_"/"monthly_"を前に付ける
+    set_name = "all" if mode_flag == "all" else str(tgt_col)
+    if resolution != "hourly":
+        set_name = resolution + "_" + set_name
+    return set_name
+
+
+def update_store(store, set_name, tgt_proc_no, tgt_block_no, url_str,
+                 start_datetime, end_datetime, mode_flag, tgt_col, gaps=None,
+                 resolution="hourly", provisional=True, chunk_days=None):
+    # 保存先に無い日付の範囲だけを取得して、保存先に追加する
+    # 区間(iter_weather_dataのchunk_days)毎に保存し、取得済みとする
+    # (メモリ使用量は区間の分だけ。途中で異常終了した場合は、再実行時に
+    # 保存済みの区間の続きから取得する)
+    # 戻り値: 取得した日数
+    # gaps(リスト)を指定した場合は、取得できなかった日を追加する。その日
+    # (と翌日)は保存せず、取得済みとしない(次回の実行時に取得する)
+    # provisional=Falseの場合は、直近の日付(暫定の範囲)も取得し直す
+    missing = store.missing_ranges(set_name, tgt_proc_no, tgt_block_no,
+                                   start_datetime, end_datetime, provisional)
+    if len(missing) == 0:
+        return 0
+    day_cnt = 0
+    for tmp_start, tmp_end in missing:
+        debug_print("getting missing data of " + str(tmp_start) + " - "
+                    + str(tmp_end) + ".")
+        gap_cnt = 0 if gaps is None else len(gaps)
+        for chunk_start, chunk_end, stack in iter_weather_data(
+                url_str, datetime_parser(str(tmp_start)),
+                datetime_parser(str(tmp_end)), mode_flag, tgt_col,
+                chunk_days, gaps, resolution):
+            # 取得できなかった日は、前の区間の最終日の場合も次の区間の
+            # 先頭(0時の行)に影響する
+            tmp_gaps = [] if gaps is None else gaps[gap_cnt:]
+            for ok_start, ok_end in subtract_ranges(
+                    chunk_start.date(), chunk_end.date(),
+                    gap_ranges(tmp_gaps, resolution)):
+                # 終了日の"24時"も保存する(翌日を取得していなくても、
+                # weather_agg.pyで終了日を集計できるように)
+                out_data, flag_data = process_data(stack, str(ok_start),
+                                                   str(ok_end), mode_flag,
+                                                   resolution, day_end=True)
+                with metrics.timer("write"):
+                    store.append(set_name, tgt_proc_no, tgt_block_no,
+                                 out_data, ok_start, ok_end,
+                                 flag_data=flag_data)
+            day_cnt = day_cnt + (chunk_end - chunk_start).days + 1
+    return day_cnt
+
+
+def read_store_range(store, set_name, tgt_proc_no, tgt_block_no,
+                     start_datetime, end_datetime, resolution="hourly"):
+    # 保存先から開始日0時〜終了日23時のデータを読み込む
+    # (日毎・月毎の範囲はperiod_boundsを参照)
+    start_dt, end_dt = period_bounds(start_datetime, end_datetime,
+                                     resolution)
+    with metrics.timer("store_read"):
+        return store.read(set_name, tgt_proc_no, tgt_block_no,
+                          pd.Timestamp(start_dt), pd.Timestamp(end_dt))
+
+
+def read_day_hourly(url_str, tgt_datetime, resolution="hourly"):
+    # 通信の失敗はfetch_url内でリトライする
+    body = fetch_page(make_day_url(url_str, tgt_datetime, resolution))
+    # 表の読み込み(pandas.read_htmlより高速な専用の処理)
+    with metrics.timer("parse"):
+        return parse_hourly(body.decode("utf-8"))
+
+
+def read_day_or_gap(url_str, tgt_datetime, gaps=None, resolution="hourly"):
+    # リトライしても取得できなかった場合は、gaps(リスト)に日付を追加して、
+    # 値の無い表(jma_parser.gap_hourly)を返す
+    # gapsがNoneの場合、取得できなかった日数がWEATHER_FAILURE_BUDGETを
+    # 超えた場合、ページの形式の誤り等の場合は例外とする
+    try:
+        return read_day_hourly(url_str, tgt_datetime, resolution)
+    except CacheMiss:
+        raise
+    except Exception as e:
+        if (gaps is None) or \
+                not (is_retryable(e) or isinstance(e, CircuitOpen)):
+            raise
+        warn_print("failed to get data of " + str(tgt_datetime)[0:10]
+                   + ", left blank: " + repr(e))
+        gaps.append(str(tgt_datetime)[0:10])
+        metrics.add("gap_days")
+        check_failure_budget(gaps)
+        return gap_table(tgt_datetime, resolution)
+
+
+def gap_table(tgt_datetime, resolution="hourly"):
+    # 取得できなかったページの代わりの、値の無い表
+    # (日毎は月の日数、月毎は12か月分の行)
+    if resolution == "daily":
+        return gap_hourly(calendar.monthrange(tgt_datetime.year,
+                                              tgt_datetime.month)[1])
+    if resolution == "monthly":
+        return gap_hourly(12)
+    return gap_hourly()
+
+
+def check_layouts(tables):
+    # 戻り値: 各ページの形式(page_layouts.Layout、不明な場合はNone)のリスト
+    # 登録されていない形式のページがある場合は警告する(列の意味が登録され
+    # ている形式と同じかどうかを確認できないため)
+    matched = [match_layout(table) for table in tables]
+    for table, layout in zip(tables, matched):
+        if (table.header is not None) and (layout is None):
+            warn_print("page layout is not registered. cols:"
+                       + str(table.text.shape[1]) + ", header: "
+                       + str(table.header))
+            metrics.add("unknown_layouts")
+            break
+    return matched
+
+
+def layout_col_names(layout, cols):
+    # 列番号(1始まり)に対応する共通の列名(形式に無い列はNone)
+    return tuple(layout.columns[col-1] if col <= len(layout.columns)
+                 else None for col in cols)
+
+
+def stack_days(tables, days, cols):
+    # cols: None(全ての列)、列番号のリスト(列指定)、または列名のリスト
+    #       (前の区間と同じ列)
+    # 全ての列の場合は、各ページの見出し行から形式(page_layouts)を判定し、
+    # 共通の列名の順に並べる(HourlyStack.colsは列名)。形式が登録されて
+    # いないページがある場合は、列番号のまま並べる
+    # 列番号の場合は、形式によって列の意味が異なるページがあれば例外とする
+    # 全ての日が取得できなかった場合は、列数が決まらないため例外とする
+    if (cols is None) and all(table.header is None for table in tables):
+        raise FailureBudgetExceeded("failed to get data of " + days[0]
+                                    + " - " + days[-1] + ".")
+    tmp_time = time.perf_counter()
+    matched = check_layouts(tables)
+    if (cols is not None) and not isinstance(cols[0], str):
+        col_names = set(layout_col_names(layout, cols)
+                        for layout in matched if layout is not None)
+        metrics.observe("schema_check", time.perf_counter() - tmp_time)
+        if len(col_names) > 1:
+            raise ValueError("column " + str(cols) + " has different"
+                             + " meanings in page layouts: "
+                             + str(sorted(col_names, key=str)) + ". days: "
+                             + days[0] + " - " + days[-1])
+        stack = stack_hourly(tables, days, cols)
+        if len(col_names) == 0:
+            return stack
+        return stack._replace(text_cols=[name in text_cols
+                                         for name in col_names.pop()])
+    aligned = align_tables(tables, cols)
+    metrics.observe("schema_check", time.perf_counter() - tmp_time)
+    if aligned is None:
+        if cols is not None:
+            raise ValueError("page layout is different from previous pages."
+                             + " days: " + days[0] + " - " + days[-1])
+        return stack_hourly(tables, days, None)
+    tables, names = aligned[0:2]
+    stack = stack_hourly(tables, days, list(range(1, len(names) + 1)))
+    return stack._replace(cols=names,
+                          text_cols=[name in text_cols for name in names])
+
+
+def get_weather_data(url_str, start_datetime, end_datetime, mode_flag,
+                     tgt_col, gaps=None, resolution="hourly"):
+    # 指定された期間の気象データを取得処理
+    # 各日のページは並行して取得し、日付順に1つの配列(HourlyStack)にまとめる
+    # gaps(リスト)を指定した場合は、取得できなかった日を空欄として続け、
+    # その日付をgapsに追加する(read_day_or_gap)
+    # 日毎・月毎の場合は、各月・各年のページを取得する
+    tgt_datetimes = page_datetimes(start_datetime, end_datetime, resolution)
+
+    def get_day_data(tmp_datetime):
+        table = read_day_or_gap(url_str, tmp_datetime, gaps, resolution)
+        debug_print("getting data of "+str(tmp_datetime)[0:10]+" done.")
+        return table
+
+    tables = fetch_map(get_day_data, tgt_datetimes)
+    # 列指定の場合はtgt_colを抽出
+    cols = None if mode_flag == "all" else [tgt_col]
+    return stack_days(tables, [str(x)[0:10] for x in tgt_datetimes], cols)
+
+
+def iter_weather_data(url_str, start_datetime, end_datetime, mode_flag,
+                      tgt_col, chunk_days=None, gaps=None,
+                      resolution="hourly"):
+    # 期間をchunk_days日毎に区切って取得し、区間毎に
+    # (開始日, 終了日, HourlyStack) を返す(メモリ使用量は区間の分だけ)
+    # gapsはget_weather_dataと同じ
+    # chunk_daysに"month"を指定した場合は、月毎に区切る
+    # 各区間のHourlyStackは、"24時"を翌日の"0時"にするため前日の分を含む
+    # 日毎の場合は年毎、月毎の場合は全期間を1つの区間とする(chunk_daysは
+    # 使用しない。1ページが複数の区間にまたがらないように)
+    if chunk_days is None:
+        chunk_days = int(os.environ.get("WEATHER_CHUNK_DAYS",
+                                        default_chunk_days))
+    elif chunk_days != "month":
+        chunk_days = int(chunk_days)
+    cols = None if mode_flag == "all" else [tgt_col]
+
+    def get_day_data(tmp_datetime):
+        table = read_day_or_gap(url_str, tmp_datetime, gaps, resolution)
+        debug_print("getting data of "+str(tmp_datetime)[0:10]+" done.")
+        return table
+
+    prev = None  # 前の区間の最終日の (日付, 表)
+    tmp_start = start_datetime
+    while tmp_start <= end_datetime:
+        if resolution == "daily":
+            tmp_end = tmp_start + relativedelta(month=12, day=31)  # 年末
+        elif resolution == "monthly":
+            tmp_end = end_datetime
+        elif chunk_days == "month":
+            tmp_end = tmp_start + relativedelta(day=31)  # 月末
+        else:
+            tmp_end = tmp_start + relativedelta(days=chunk_days-1)
+        tmp_end = min(tmp_end, end_datetime)
+        if resolution != "hourly":
+            tgt_datetimes = page_datetimes(tmp_start, tmp_end, resolution)
+        elif prev is None:
+            tgt_datetimes = page_datetimes(tmp_start, tmp_end)  # 前日から
+        else:
+            # 前日の分は前の区間の表を使う
+            tgt_datetimes = page_datetimes(
+                tmp_start + relativedelta(days=1), tmp_end)
+        days = [str(x)[0:10] for x in tgt_datetimes]
+        tables = fetch_map(get_day_data, tgt_datetimes)
+        if prev is not None:
+            days = [prev[0]] + days
+            tables = [prev[1]] + tables
+        stack = stack_days(tables, days, cols)
+        if cols is None:
+            # 取得できなかった日の後も、同じ列数で出力する
+            cols = stack.cols
+        yield tmp_start, tmp_end, stack
+        if resolution == "hourly":
+            prev = (days[-1], tables[-1])
+        tmp_start = tmp_end + relativedelta(days=1)
+
+
+def read_journal(journal_file):
+    # 戻り値: (取得済みの最終日, 出力済みのファイルサイズ, 取得できなかった
+    #         日付のリスト)。無い場合はNone
+    if not os.path.exists(journal_file):
+        return None
+    with open(journal_file, encoding="utf-8") as f:
+        journal = json.load(f)
+    return datetime_parser(journal["last_date"]), int(journal["size"]), \
+        list(journal.get("gaps", []))
+
+
+def write_journal(journal_file, last_date, size, gaps=()):
+    with open(journal_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"last_date": str(last_date)[0:10], "size": size,
+                   "gaps": sorted(gaps)}, f)
+    os.replace(journal_file + ".tmp", journal_file)
+
+
+def read_gaps(out_file):
+    # 戻り値: (取得できなかった日付のリスト, 開始日, 終了日)
+    #         out_file + ".gaps" が無い場合はNone
+    gap_file = out_file + ".gaps"
+    if not os.path.exists(gap_file):
+        return None
+    with open(gap_file, encoding="utf-8") as f:
+        gap_data = json.load(f)
+    return list(gap_data["dates"]), datetime_parser(gap_data["start"]), \
+        datetime_parser(gap_data["end"])
+
+
+def write_gaps(out_file, gaps, start_datetime, end_datetime,
+               resolution="hourly"):
+    # 取得できなかった日付のうち、out_fileの期間に影響するものを
+    # out_file + ".gaps" に記録する。無い場合は削除する
+    # 戻り値: 記録した日付のリスト
+    gap_file = out_file + ".gaps"
+    first = start_datetime.date()
+    last = str(end_datetime)[0:10]
+    dates = [x for x in sorted(set(gaps))
+             if (gap_ranges([x], resolution)[0][1] >= first)
+             and (x <= last)]
+    if len(dates) == 0:
+        if os.path.exists(gap_file):
+            os.remove(gap_file)
+        return dates
+    warn_print("failed to get data of " + str(len(dates)) + " days, "
+               + "left blank: " + gap_file)
+    with open(gap_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"dates": dates, "start": str(start_datetime)[0:10],
+                   "end": last}, f)
+    os.replace(gap_file + ".tmp", gap_file)
+    return dates
+
+
+def gap_ranges(gaps, resolution="hourly"):
+    # 取得できなかった日Dは、D日(1〜23時)とD+1日(0時、D日の24時)に影響する
+    # 日毎の場合はDの月、月毎の場合はDの年の全ての日に影響する
+    # 戻り値: 影響する日付の範囲(datetime.date)のリスト
+    days = [datetime_parser(x).date() for x in gaps]
+    if resolution == "daily":
+        step = relativedelta(day=31)
+    elif resolution == "monthly":
+        step = relativedelta(month=12, day=31)
+    else:
+        step = relativedelta(days=1)
+    return merge_ranges([(x, x + step) for x in days])
+
+
+def refill_gaps(out_file, url_str, mode_flag, tgt_col, resolution="hourly"):
+    # out_file + ".gaps" の日付だけを取得し直して、out_fileの該当する行を
+    # 置き換える(他の行はそのまま)。戻り値: 残った(再び取得できなかった)日数
+    gap_data = read_gaps(out_file)
+    if gap_data is None:
+        return 0
+    gaps, start_datetime, end_datetime = gap_data
+    new_gaps = []
+    lines = {}  # 日時: 行
+    for tmp_start, tmp_end in gap_ranges(gaps, resolution):
+        # 出力ファイルの期間外の行は取得しない
+        tmp_start = max(tmp_start, start_datetime.date())
+        tmp_end = min(tmp_end, end_datetime.date())
+        if tmp_start > tmp_end:
+            continue
+        debug_print("refilling data of " + str(tmp_start) + " - "
+                    + str(tmp_end) + ".")
+        for chunk_start, chunk_end, stack in iter_weather_data(
+                url_str, datetime_parser(str(tmp_start)),
+                datetime_parser(str(tmp_end)), mode_flag, tgt_col,
+                gaps=new_gaps, resolution=resolution):
+            # 行だけを使用する(列名は使用しない)
+            out_data = process_data(stack, str(chunk_start)[0:10],
+                                    str(chunk_end)[0:10], mode_flag,
+                                    resolution)[0]
+            for line in out_data.to_csv(index=False, header=False) \
+                    .splitlines(True):
+                lines[line.split(",", 1)[0]] = line
+
+    # 出力ファイルの行を日時で置き換え、無い行は日時の順に挿入する
+    with open(out_file, encoding="utf-8") as f:
+        header = f.readline()
+        for line in f:
+            lines.setdefault(line.split(",", 1)[0], line)
+    with metrics.timer("write"):
+        with open(out_file + ".tmp", "w", encoding="utf-8") as f:
+            f.write(header)
+            for key in sorted(lines):
+                f.write(lines[key])
+        os.replace(out_file + ".tmp", out_file)
+    return len(write_gaps(out_file, new_gaps, start_datetime, end_datetime,
+                          resolution))
+
+
+def write_weather_csv(out_file, url_str, start_datetime, end_datetime,
+                      mode_flag, tgt_col, resolution="hourly"):
+    # 区間毎に取得・整形して、out_file + ".part" に追記する
+    # 区間毎に取得済みの最終日を out_file + ".journal" に記録し、途中で
+    # 異常終了した場合は、再実行時に続きの日付から取得する
+    # 全て取得できたら out_file に名前を変更する。戻り値: 取得した日数
+    # 取得できなかった日は空欄で出力し、out_file + ".gaps" に記録する
+    part_file = out_file + ".part"
+    journal_file = out_file + ".journal"
+    out_start = start_datetime
+    journal = None
+    gaps = []
+    if os.path.exists(part_file):
+        journal = read_journal(journal_file)
+    if journal is None:
+        header = True
+        with open(part_file, "w"):
+            pass
+    else:
+        # 最後に記録した位置まで戻して(記録後に追記した分は捨てて)再開
+        header = False
+        gaps = journal[2]
+        start_datetime = journal[0] + relativedelta(days=1)
+        with open(part_file, "r+") as f:
+            f.truncate(journal[1])
+        warn_print("resume getting data from " + str(start_datetime)[0:10]
+                   + ".")
+
+    day_cnt = 0
+    for tmp_start, tmp_end, stack in iter_weather_data(
+            url_str, start_datetime, end_datetime, mode_flag, tgt_col,
+            gaps=gaps, resolution=resolution):
+        out_data = process_data(stack, str(tmp_start)[0:10],
+                                str(tmp_end)[0:10], mode_flag, resolution)[0]
+        with metrics.timer("write"):
+            out_data.to_csv(part_file, mode="a", header=header, index=False)
+        header = False
+        write_journal(journal_file, tmp_end, os.path.getsize(part_file), gaps)
+        day_cnt = day_cnt + (tmp_end - tmp_start).days + 1
+
+    os.replace(part_file, out_file)
+    write_gaps(out_file, gaps, out_start, end_datetime, resolution)
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
+    return day_cnt
+
+
+def period_bounds(start_date, end_date, resolution="hourly"):
+    # 期間の最初と最後の行の日時(datetime64[h])
+    # 1時間毎: 開始日0時〜終了日23時、日毎: 開始日〜終了日(0時)、
+    # 月毎: 開始日の月の1日〜終了日の月の1日(0時)
+    start_d = np.datetime64(datetime_parser(str(start_date)).date(), "D")
+    end_d = np.datetime64(datetime_parser(str(end_date)).date(), "D")
+    if resolution == "monthly":
+        start_d = start_d.astype("datetime64[M]").astype("datetime64[D]")
+        end_d = end_d.astype("datetime64[M]").astype("datetime64[D]")
+    start_dt = start_d.astype("datetime64[h]")
+    end_dt = end_d.astype("datetime64[h]")
+    if resolution == "hourly":
+        end_dt = end_dt + np.timedelta64(23, "h")
+    return start_dt, end_dt
+
+
+def process_data(stack, start_date, end_date, mode_flag,
+                 resolution="hourly", day_end=False):
+    # データ整形、加工
+    # day_end=Trueの場合(1時間毎のみ)は、終了日の"24時"(翌日の0時)の行も
+    # 出力する(気象庁の日界で終了日を集計できるように)
+    # 戻り値: (気象データ, 品質情報)
+    #   気象データ: "日時"(datetime64)と各列(数値の列はfloat64、風向・天気
+    #               の列は文字列(object)。区間によらず、ページの形式から
+    #               判定する。形式が不明な場合は数値でない値を含む列を
+    #               文字列とする)
+    #               列名はstack.cols(page_layoutsの列名、または列番号)
+    #               日毎の場合は各日の0時、月毎の場合は各月の1日0時
+    #   品質情報: 各列の品質情報(jma_parserのFLAG_*)
+    tmp_time = time.perf_counter()
+    if resolution == "daily":
+        # 月のページの日付に(日-1)日を足す(月末を超える行は除く)
+        date_times = stack.days + (stack.hours - 1).astype("timedelta64[D]")
+        valid = date_times.astype("datetime64[M]") \
+            == stack.days.astype("datetime64[M]")
+        date_times = date_times.astype("datetime64[h]")
+    elif resolution == "monthly":
+        # 年のページの日付に(月-1)か月を足す
+        months = stack.days.astype("datetime64[M]") \
+            + (stack.hours - 1).astype("timedelta64[M]")
+        valid = (stack.hours >= 1) & (stack.hours <= 12)
+        date_times = months.astype("datetime64[h]")
+    else:
+        # 日付に時間を足して日時とする("24時"は翌日の"0時"になる)
+        date_times = stack.days.astype("datetime64[h]") \
+            + stack.hours.astype("timedelta64[h]")
+        valid = True
+
+    # 指定した開始日と終了日の範囲を出力
+    start_dt, end_dt = period_bounds(start_date, end_date, resolution)
+    if day_end and (resolution == "hourly"):
+        end_dt = end_dt + np.timedelta64(1, "h")
+    rows = np.flatnonzero((date_times >= start_dt) & (date_times <= end_dt)
+                          & valid)
+    rows = rows[np.argsort(date_times[rows], kind="mergesort")]
+
+    out_data = pd.DataFrame({"日時": date_times[rows].astype("datetime64[s]")})
+    flag_data = pd.DataFrame(index=out_data.index)
+    for j, tmp_col in enumerate(stack.cols):
+        values = stack.values[rows, j]
+        flags = stack.flags[rows, j]
+        text_mask = text_cells(values, flags)
+        is_text = text_mask.any() if stack.text_cols is None \
+            else stack.text_cols[j]
+        if is_text:
+            # 数値でない値の列は、その値を文字列のまま残す
+            tmp_values = values.astype(object)
+            tmp_values[text_mask] = stack.text[rows, j][text_mask]
+            # 値によって文字列型に推定されないように、objectで作成する
+            out_data[tmp_col] = pd.Series(tmp_values, index=out_data.index,
+                                          dtype=object)
+        else:
+            out_data[tmp_col] = values
+        flag_data[tmp_col] = flags
+    # 欠測等で値が無いセルの数
+    tmp_flags = stack.flags[rows]
+    metrics.add("missing_values", int(np.count_nonzero(
+        (tmp_flags >= FLAG_MISSING) & (tmp_flags != FLAG_TEXT))))
+    metrics.add("rows_out", len(out_data))
+    metrics.observe("clean", time.perf_counter() - tmp_time)
+    return out_data, flag_data
 
 
 # main処理
 if __name__ == '__main__':
 
+    setup_logger()
+    start_run(cmd)
+
     # 引数取得
     argvs = sys.argv
-    arg_str = ' '.join(map(str, argvs))
 
     # ログ関数生成
     def error_exit(code, msg):
@@ -173,16 +848,6 @@ if __name__ == '__main__':
         os.rename(logfile, logfile2)
         sys.exit(code)
 
-    def warn_print(msg):
-        d = datetime.datetime.today()
-        logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
-                    + str(msg)+" command: "+arg_str)
-
-    def debug_print(msg):
-        d = datetime.datetime.today()
-        logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
-                    + str(msg)+" command: "+arg_str)
-
     # 引数チェック
     debug_print("start process.")
 
@@ -200,10 +865,13 @@ if __name__ == '__main__':
         tgt_col = 1
         tgt_col_s = 1
         tgt_col_a = 1
+        resolution = "hourly"
         if mode_flag != "check":
             start_date = str(argvs[4])
             end_date = str(argvs[5])
             start_row = int(argvs[6])
+            if len(argvs) > 7:
+                resolution = str(argvs[7])
             if mode_flag != "all":
                 tgt_col_s = int(str(mode_flag).split(",")[0])
                 tgt_col_a = int(str(mode_flag).split(",")[1])
@@ -239,27 +907,38 @@ if __name__ == '__main__':
     if start_row < 1:
         error_exit(1, "start_row is less than 1. [main]")
 
+    # 取得するデータの単位のチェック
+    if resolution not in resolutions:
+        error_exit(1, "resolution is incorrect. [main]")
+
     # 列指定が1以上であることのチェック。0列目は時間なので収集対象外
     # if tgt_col < 1:
     #    error_exit(1, "target_col is less than 1. [main]")
 
     debug_print("end checking argments.")
 
-    # 気象台データ（オブジェクトファイル）の読み込み確認
+    # 気象台データ（登録ファイル）の読み込み確認
+    # 登録ファイルが無い場合はpickleファイルから変換し、どちらも無い場合
+    # のみ生成する。形式のバージョンが異なる場合は生成し直さずに終了する
     make_area_data = 0
     try:
-        with open('area_data_temp_valid.pickle', 'rb') as f:
-            area_DF = pickle.load(f)
-    except:
-        # 存在しないまたは、pythonバージョンが異なる等の理由でエラーとなる場合
-        warn_print("failed to read area_data_temp_valid.pickle")
+        ensure_registry(registry_file)
+    except FileNotFoundError:
+        warn_print("registry file not found: " + registry_file)
         make_area_data = 1
+    except RegistryVersionError as e:
+        error_exit(1, str(e) + " [ensure_registry]")
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [ensure_registry]")
 
-    # 気象台データ（オブジェクトファイル）の生成
+    # 気象台データ（登録ファイル）の生成
     if make_area_data == 1:
         try:
-            warn_print("try (re)creating area_data_temp_valid.pickle")
-            os.system("python make_area_data.py .")
+            warn_print("try creating " + registry_file)
+            # 別プロセスではなく、同じプロセス内で生成する
+            import make_area_data as area_data_maker
+            area_data_maker.make_area_data(".")
         except:
             error_exit(2, "function error. trace: "
                        + traceback.format_exc() + " [make_area_data.py]")
@@ -267,38 +946,13 @@ if __name__ == '__main__':
     debug_print("start getting post_num data.")
     # 郵便番号データの取得
     try:
-        tmp_post_num = post_num
-        post_num1 = tmp_post_num[0:3]
-        post_num2 = tmp_post_num[3:7]
-        err_cnt = 0
+        tmp_post_num, nearest_pref, nearest_area, tgt_proc_no, \
+            tgt_block_no, tgt_type = Observatory_get_retry(post_num)
     except:
         error_exit(2, "function error. trace: "
-                   + traceback.format_exc() + " [main]")
-    while True:
-        try:
-            nearest_pref, nearest_area, tgt_proc_no, tgt_block_no, tgt_type\
-                = Observatory_get_main(tmp_post_num)
-            break
-        except:
-            # 郵便番号データの取得に失敗した場合は、以下の様に番号を変えてretry
-            # 1. 下4桁を全て"0"にする
-            # 2. 上3桁を"1"ずつ減らしていく(最大20回失敗するまで繰り返す)
-            err_cnt = err_cnt + 1
-            warn_print("failed to get post num data: " + str(tmp_post_num))
-            if (err_cnt >= 20) | (post_num1 == "000"):
-                error_exit(2, "function error. trace: "
-                           # + traceback.format_exc(sys.exc_info()[2])
-                           + traceback.format_exc()
-                           + " [Observatory_get_main]")
-
-            if post_num2 == "0000":
-                tmp_post_num = str(int(post_num1)-1).zfill(3) + str(post_num2)
-                post_num1 = tmp_post_num[0:3]
-            else:
-                tmp_post_num = post_num1 + "0000"
-                post_num2 = "0000"
-            warn_print("retry getting post num data: " + str(tmp_post_num))
-            time.sleep(1)
+                   # + traceback.format_exc(sys.exc_info()[2])
+                   + traceback.format_exc()
+                   + " [Observatory_get_main]")
 
     debug_print("acquired post_num: " + tmp_post_num + ", nearest_pref: " +
                 nearest_pref + ", nearest_area: " + nearest_area +
@@ -322,216 +976,82 @@ if __name__ == '__main__':
         os.remove(logfile)
         sys.exit(0)
 
-    debug_print("start checking weather data.")
     try:
-        # 最寄が気象台か、その他観測所かでurl、データ形式が異なるための、対応
-        if tgt_type == "s":
-            tgt_col = tgt_col_s
-            url1 = url1_s
-            temp_col0 = temp_col0_s
-            temp_col1 = temp_col1_s
-            template = template_s
-            temp_cols = temp_cols_s
-            output_col = output_col_s
-        elif tgt_type == "a":
-            tgt_col = tgt_col_a
-            url1 = url1_a
-            temp_col0 = temp_col0_a
-            temp_col1 = temp_col1_a
-            template = template_a
-            temp_cols = temp_cols_a
-            output_col = output_col_a
-        else:
-            error_exit(1, "internal error, ObservatoryType unexpected: "
-                       + str(tgt_type)+". [main]")
-
-        # 気象データ取得用URLの基本部分生成
-        url_str = url1 + str(tgt_proc_no) + "&block_no="\
-                       + str(tgt_block_no) + "&"
-
-        # 最新の日付のページでデータ取得/形式チェックする
-        tmp_url = url_str + 'year=' + str(end_datetime.year) + '&month='\
-                          + str(end_datetime.month) + '&day='\
-                          + str(end_datetime.day) + '&view=p1'
+        tgt_col, url1 = get_type_params(tgt_type, tgt_col_s, tgt_col_a,
+                                        resolution)
+    except ValueError:
+        error_exit(1, "internal error, ObservatoryType unexpected: "
+                   + str(tgt_type)+". [main]")
+    try:
+        url_str = make_url_str(url1, tgt_proc_no, tgt_block_no)
     except:
         error_exit(2, "function error. trace: "
                    + traceback.format_exc() + " [main]")
+    record_demand(tgt_proc_no, tgt_block_no)
 
     # 結果ファイルが既に存在する場合はスキップ
-    if mode_flag == "all":
-        out_file = out_dir + "/" + nearest_pref + "_" + nearest_area \
-                   + "_all_" + start_date + "_" + end_date + ".csv"
-    else:
-        out_file = out_dir + "/" + nearest_pref + "_" + nearest_area \
-                   + "_" + str(tgt_col) + "_" + start_date + "_" + end_date \
-                   + ".csv"
+    out_file = make_out_file(out_dir, nearest_pref, nearest_area, mode_flag,
+                             tgt_col, start_date, end_date, resolution)
 
     if os.path.exists(out_file):
         warn_print("output file already exists.")
+        # 前回取得できなかった日がある場合は、その日だけを取得し直す
+        if read_gaps(out_file) is not None:
+            debug_print("start refilling weather data.")
+            try:
+                gap_cnt = refill_gaps(out_file, url_str, mode_flag, tgt_col,
+                                      resolution)
+            except:
+                error_exit(2, "function error. trace: "
+                           + traceback.format_exc() + " [refill_gaps]")
+            debug_print("end refilling weather data. remaining days: "
+                        + str(gap_cnt))
         debug_print("end process.")
         os.remove(logfile)
         sys.exit(0)
 
-    try:
-        table_datas = pd.io.html.read_html(tmp_url)
-    except:
-        # Webページのスクレイピングに失敗した場合は、1度だけリトライ
-        try:
-            warn_print("failed to get data of "+str(end_datetime)[0:10]+".")
-            warn_print("retry getting data of "+str(end_datetime)[0:10]+".")
-            time.sleep(1)
-            table_datas = pd.io.html.read_html(tmp_url)
-        except:
-            error_exit(2, "function error. trace: "
-                       # + traceback.format_exc(sys.exc_info()[2])
-                       + traceback.format_exc() + " [io.html.read_html]")
-
-    # 気象データの形式チェック
-    try:
-        # カラム数の一致チェック
-        if len(table_datas[0].columns) != temp_cols:
-            check_flag = False
-            warn_print("number of columns is defferent from template. cols:"
-                       + len(table_datas[0].columns))
-        # カラムの要素の一致チェック
-        elif start_row != len(template):
-            check_flag = False
-            warn_print("start_row is defferent from length of template."
-                       + " header records:" + str(len(table_datas[0])))
-        else:
-            check_DF = (table_datas[0].head(start_row).fillna(0)
-                        == template.fillna(0))
-            if check_DF.astype(int).sum().sum() != temp_cols*start_row:
-                warn_print("columns are defferent from template. template: "
-                           + str(list(template.ix[0])) + ","
-                           + str(list(template.ix[1])) + ", acquired: "
-                           + str(list(table_datas[0].ix[0])) + ","
-                           + str(list(table_datas[0].ix[1])))
-                check_flag = False
-    except:
-        error_exit(2, "function error. trace: "
-                   + traceback.format_exc() + " [main]")
-
-    debug_print("end checking weather data.")
-
-    debug_print("start getting weather data.")
-    # 指定された期間の気象データを取得処理
-    out_data = pd.DataFrame()
-    tmp_datetime = tmp_datetime - relativedelta(days=1)  # 前日から取得
-    while tmp_datetime <= end_datetime:
+    # 保存先(WEATHER_STORE)の指定がある場合は、保存先に無い日付だけを取得し
+    # 保存先から出力する
+    store = get_default_store()
+    if store is not None:
+        debug_print("start getting weather data with store.")
+        gaps = []
         try:
-            tmp_year = tmp_datetime.year
-            tmp_month = tmp_datetime.month
-            tmp_day = tmp_datetime.day
-
-            tmp_url = url_str + 'year=' + str(tmp_year) + '&month='\
-                              + str(tmp_month) + '&day=' + str(tmp_day)\
-                              + '&view=p1'
+            set_name = store_set_name(mode_flag, tgt_col, resolution)
+            day_cnt = update_store(store, set_name, tgt_proc_no, tgt_block_no,
+                                   url_str, tmp_datetime, end_datetime,
+                                   mode_flag, tgt_col, gaps, resolution)
+            debug_print("fetched days: " + str(day_cnt))
+            out_data = read_store_range(store, set_name, tgt_proc_no,
+                                        tgt_block_no, tmp_datetime,
+                                        end_datetime, resolution)
         except:
             error_exit(2, "function error. trace: "
-                       + traceback.format_exc() + " [main]")
-        try:
-            table_datas = pd.io.html.read_html(tmp_url)
-        except:
-            # Webページのスクレイピングに失敗した場合は、1度だけリトライ
-            try:
-                warn_print("failed to get data of "
-                           + str(end_datetime)[0:10] + ".")
-                warn_print("retry getting data of "
-                           + str(end_datetime)[0:10] + ".")
-                time.sleep(1)
-                table_datas = pd.io.html.read_html(tmp_url)
-            except:
-                error_exit(2, "function error. trace: "
-                           # + traceback.format_exc(sys.exc_info()[2])
-                           + traceback.format_exc() + " [io.html.read_html]")
-
+                       + traceback.format_exc() + " [update_store]")
+        debug_print("end getting weather data with store.")
+    else:
+        # 取得した区間毎に整形してファイルに追記する(途中で異常終了した場合
+        # は、再実行時に続きから取得する)
+        debug_print("start getting weather data.")
         try:
-            # データの開始行をstart_rowとし、列指定の場合はtgt_colを抽出
-            if mode_flag == "all":
-                tmp_data = table_datas[0].ix[start_row:, :].copy()
-            else:
-                tmp_data = table_datas[0].ix[start_row:, [0, tgt_col]].copy()
-
-            # 日付項を追加  ※後で日時のデータにするため、ここで日時としておく
-            col_list = ["日時"]
-            col_list.extend(tmp_data.columns)
-            tmp_data["日時"] = str(tmp_datetime)[0:10]
-            tmp_data = tmp_data[col_list]
-
-            # 結合して翌日へ
-            out_data = pd.concat([out_data, tmp_data])
-            tmp_datetime = tmp_datetime + relativedelta(days=1)
-
-            debug_print("getting data of "+str(tmp_datetime)[0:10]+" done.")
-
-            # スクレイピング先のサーバに負荷をかけないように1秒待つ
-            time.sleep(1)
+            day_cnt = write_weather_csv(out_file, url_str, tmp_datetime,
+                                        end_datetime, mode_flag, tgt_col,
+                                        resolution)
         except:
             error_exit(2, "function error. trace: "
-                       + traceback.format_exc() + " [main]")
-
-    debug_print("end getting weather data.")
+                       + traceback.format_exc() + " [write_weather_csv]")
+        debug_print("end getting weather data. fetched days: "
+                    + str(day_cnt))
 
-    debug_print("start processing data.")
-    # データ整形、加工
-    try:
-        # "24時"のレコードを翌日の"0時"にする
-        out_data_24h = out_data[out_data[0] == "24"].copy()
-        out_data_24h["日時"] = out_data_24h["日時"].apply(datetime_parser_2)
-        out_data_24h[0] = "0"
-        out_data_24h["日時"] = out_data_24h["日時"].astype(str)
-        out_data = pd.concat([out_data, out_data_24h])
-        out_data = out_data[out_data[0] != "24"].copy()
-
-        # 指定した開始日と終了日の範囲を出力
-        start_date_str = str(datetime_parser(start_date))[0:10]
-        end_date_str = str(datetime_parser(end_date))[0:10]
-        out_data = out_data[(out_data["日時"] >= start_date_str) &
-                            (out_data["日時"] <= end_date_str)].copy()
-
-        # 日付と時間を結合し、datetime型に変換
-        out_data["日時"] =\
-            out_data["日時"] + " " + out_data[0].astype(str) + ":00:00"
-        out_data["日時"] = out_data["日時"].apply(datetime_parser)
-        out_data = out_data.sort_values("日時")
-        del out_data[0]
-
-        # 記号の除去
-        out_data = out_data.replace("--", 0)
-        out_data = out_data.replace("0+", 0)
-        out_data = out_data.replace("10-", 10)
-        out_data = out_data.replace("×", np.nan)
-        out_data = out_data.replace("///", np.nan)
-        out_data = out_data.replace("#", np.nan)
-        out_data = out_data.replace("*", np.nan)
-        out_data = out_data.fillna("")
-        for tmp_col in out_data.columns:
-            out_data[tmp_col] = out_data[tmp_col].apply(del_symbol)
-            # 上の処理で各データが文字列型となるため注意
-
-        # "all"指定でかつ、テンプレートから変更が無い場合、カラム名付与
-        if (mode_flag == "all") & (check_flag):
-            out_data.columns = output_col
-    except:
-        error_exit(2, "function error. trace: "
-                   + traceback.format_exc() + " [main]")
-
-    debug_print("end processing data.")
+        debug_print("end process.")
+        os.remove(logfile)
+        sys.exit(0)
 
     debug_print('start output file.')
     try:
-        # out_file = out_dir + "/" + nearest_pref + "_" + nearest_area + "_" \
-        #             + mode_flag + "_" + start_date + "_" + end_date + ".csv"
-        if mode_flag == "all":
-            out_file = out_dir + "/" + nearest_pref + "_" + nearest_area \
-                       + "_all_" + start_date + "_" + end_date + ".csv"
-        else:
-            out_file = out_dir + "/" + nearest_pref + "_" + nearest_area \
-                       + "_" + str(tgt_col) + "_" + start_date + "_" \
-                       + end_date + ".csv"
-
-        out_data.to_csv(out_file, index=False)
+        with metrics.timer("write"):
+            out_data.to_csv(out_file, index=False)
+        write_gaps(out_file, gaps, tmp_datetime, end_datetime, resolution)
     except:
         error_exit(2, "function error. trace: "
                    # + traceback.format_exc(sys.exc_info()[2]) + " [to_csv]")
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 複数の観測所の1時間毎の気象データを、共通の時間軸・共通の列
+#              (変数)にそろえた1つの配列(観測所×日時×変数)にする
+#              - 変数は気象台("s")の列とし、その他の観測所("a")に無い変数は
+#                NaN(品質情報はFLAG_NOT_OBSERVED)とする
+#              - 風向は16方位を度(北=0、時計回り、静穏はNaN)に変換する
+#              - 天気(数値でない)は含めない
+#              同じ観測所を複数の郵便番号で指定した場合は、1回だけ取得する
+# arguments:
+#   argvs[1]: 出力ファイルのパス(拡張子で形式を指定)
+#             ".npz": 配列(values、flags)と軸(stations、times、variables)
+#             ".parquet"/".feather"/".csv": 1行1日時で「<観測所>:<変数>」
+#             の列を持つ横長の表
+#   argvs[2]: 開始日(YYYYMMDD)
+#   argvs[3]: 終了日(YYYYMMDD)
+#   argvs[4]以降: 観測所の指定(7桁の数字は郵便番号、それ以外はblock_no)
+# output:
+#   観測所の名前は、引数で指定した郵便番号またはblock_no
+#   日時は開始日の0時(前日の24時)〜終了日の23時の1時間毎
+
+# --基本モジュール--
+import numpy as np
+import pandas as pd
+import os
+import sys
+from collections import namedtuple, OrderedDict
+
+import weather_api
+import weather_get as wg
+from page_layouts import canonical_cols
+from jma_parser import FLAG_NOT_OBSERVED, FLAG_GAP
+from output_store import import_pyarrow
+from metrics import get_metrics, start_run
+
+# ログ用
+import traceback
+from logging import getLogger, StreamHandler, FileHandler, INFO, WARN
+import datetime
+cmd = "weather_matrix"
+pid = str(os.getpid())
+logfile = "/tmp/"+cmd+"_"+pid+".log"
+logger = getLogger(cmd)
+logger.setLevel(INFO)
+arg_str = ' '.join(map(str, sys.argv))
+
+
+def setup_logger():
+    # コマンドとして実行する場合のみログファイルを作成する
+    # weather_get側の関数が出力するログも同じファイルに出力する
+    Fhandler = FileHandler(logfile)
+    Fhandler.setLevel(INFO)
+    logger.addHandler(Fhandler)
+    wg.logger.addHandler(Fhandler)
+    Shandler = StreamHandler()
+    Shandler.setLevel(WARN)
+    logger.addHandler(Shandler)
+    wg.logger.addHandler(Shandler)
+
+
+def warn_print(msg):
+    d = datetime.datetime.today()
+    logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+def debug_print(msg):
+    d = datetime.datetime.today()
+    logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+# 変数定義
+time_col = "日時"
+wind_col = "風向"
+# 共通の変数(気象台の列から、数値にできない天気を除いたもの)
+variables = [col for col in canonical_cols[("s", "hourly")][1:]
+             if col != "天気"]
+# 16方位(北から時計回り)
+wind_directions = ["北", "北北東", "北東", "東北東", "東", "東南東", "南東",
+                   "南南東", "南", "南南西", "南西", "西南西", "西", "西北西",
+                   "北西", "北北西"]
+wind_degrees = dict((name, 22.5*i) for i, name in enumerate(wind_directions))
+matrix_formats = [".npz", ".parquet", ".feather", ".csv"]
+post_num_len = 7
+
+Matrix = namedtuple("Matrix", [
+    "stations",   # 観測所の名前のリスト
+    "times",      # 日時(datetime64[h]の配列)
+    "variables",  # 変数の名前のリスト
+    "values",     # 値(float64、観測所×日時×変数)
+    "flags",      # 品質情報(uint8、観測所×日時×変数、jma_parserのFLAG_*)
+])
+
+
+# 関数定義
+def resolve_station(code):
+    # 7桁の数字は郵便番号、それ以外はblock_noとして観測所を探す
+    # 戻り値: 観測所(Series)
+    code = str(code)
+    if (len(code) == post_num_len) and code.isdigit():
+        return weather_api.station_for_post_num(code)
+    return weather_api.find_station(code)
+
+
+def to_numbers(col, values):
+    # 列の値をfloat64の配列にする(風向は度に変換する)
+    if col == wind_col:
+        return np.array([wind_degrees.get(value, np.nan) for value in values],
+                        dtype=np.float64)
+    return pd.to_numeric(pd.Series(values), errors="coerce") \
+        .values.astype(np.float64)
+
+
+def time_axis(start, end):
+    # 戻り値: 開始日0時〜終了日23時の1時間毎の日時(datetime64[h])
+    start_dt, end_dt = wg.period_bounds(start, end)
+    return np.arange(start_dt, end_dt + np.timedelta64(1, "h"),
+                     dtype="datetime64[h]")
+
+
+def fill_station(values, flags, times, station, start, end):
+    # 1つの観測所の気象データを、values・flags(日時×変数)に書き込む
+    var_index = dict((col, k) for k, col in enumerate(variables))
+    for out_data, flag_data in weather_api.iter_hourly(
+            station, start, end, chunk="month", with_flags=True):
+        if not all(isinstance(col, str) for col in flag_data.columns):
+            # ページの形式が登録されていなくて列名を付けられない
+            raise ValueError("page layout is unexpected: "
+                             + str(station["block_no"]))
+        rows = ((out_data[time_col].values.astype("datetime64[h]")
+                 - times[0]) // np.timedelta64(1, "h")).astype(np.int64)
+        valid = (rows >= 0) & (rows < len(times))
+        rows = rows[valid]
+        for col in flag_data.columns:
+            k = var_index.get(col)
+            if k is None:
+                continue
+            values[rows, k] = to_numbers(col, out_data[col].values[valid])
+            flags[rows, k] = flag_data[col].values[valid]
+
+
+def build_matrix(codes, start, end):
+    # codes: 観測所の指定(郵便番号またはblock_no)のリスト
+    # start, end: 開始日・終了日(YYYYMMDD)
+    # 戻り値: Matrix
+    times = time_axis(start, end)
+    names = [str(code) for code in codes]
+    shape = (len(names), len(times), len(variables))
+    values = np.full(shape, np.nan)
+    # 取得した時間・列以外は、取得できなかった(FLAG_GAP)とする
+    flags = np.full(shape, FLAG_GAP, dtype=np.uint8)
+    done = OrderedDict()  # (proc_no, block_no): 最初に取得した位置
+    for i, code in enumerate(names):
+        station = resolve_station(code)
+        key = (str(station["proc_no"]), str(station["block_no"]))
+        if key in done:
+            values[i] = values[done[key]]
+            flags[i] = flags[done[key]]
+            continue
+        with get_metrics().timer("matrix_station"):
+            if station["ObservatoryType"] != "s":
+                # その他の観測所で観測していない変数
+                observed = set(canonical_cols[("a", "hourly")][1:])
+                for k, col in enumerate(variables):
+                    if col not in observed:
+                        flags[i, :, k] = FLAG_NOT_OBSERVED
+            fill_station(values[i], flags[i], times, station, start, end)
+        done[key] = i
+    get_metrics().add("matrix_stations", len(done))
+    return Matrix(names, times, list(variables), values, flags)
+
+
+def to_wide_frame(matrix):
+    # 1行1日時で「<観測所>:<変数>」の列を持つDataFrameにする
+    columns = OrderedDict()
+    columns[time_col] = matrix.times.astype("datetime64[s]")
+    for i, name in enumerate(matrix.stations):
+        for k, col in enumerate(matrix.variables):
+            columns[name + ":" + col] = matrix.values[i, :, k]
+    return pd.DataFrame(columns)
+
+
+def write_matrix(out_file, matrix):
+    # 拡張子に応じた形式で出力する(一時ファイルに書き込んでから名前を変更)
+    ext = os.path.splitext(out_file)[1].lower()
+    if ext not in matrix_formats:
+        raise ValueError("output format unexpected: " + out_file)
+    tmp_file = out_file + ".tmp"
+    with get_metrics().timer("write"):
+        if ext == ".npz":
+            with open(tmp_file, "wb") as f:
+                np.savez_compressed(
+                    f, values=matrix.values, flags=matrix.flags,
+                    stations=np.array(matrix.stations),
+                    times=matrix.times,
+                    variables=np.array(matrix.variables))
+        elif ext == ".csv":
+            to_wide_frame(matrix).to_csv(tmp_file, index=False)
+        else:
+            pyarrow = import_pyarrow()
+            table = pyarrow.Table.from_pandas(to_wide_frame(matrix),
+                                              preserve_index=False)
+            if ext == ".parquet":
+                pyarrow.parquet.write_table(table, tmp_file)
+            else:
+                pyarrow.feather.write_feather(table, tmp_file)
+        os.replace(tmp_file, out_file)
+
+
+# main処理
+if __name__ == '__main__':
+
+    setup_logger()
+    start_run(cmd)
+
+    # 引数取得
+    argvs = sys.argv
+
+    # ログ関数生成
+    def error_exit(code, msg):
+        d = datetime.datetime.today()
+        logger.error(d.strftime("%Y-%m-%d %H:%M:%S")+" ERROR "+cmd+" - "
+                     + str(msg)+" command: "+arg_str)
+        logfile2 = \
+            "/var/log/"+cmd+"_"+d.strftime("%Y%m%d%H%M%S")+"_"+pid+".log"
+        os.rename(logfile, logfile2)
+        sys.exit(code)
+
+    debug_print("start process.")
+
+    # 引数チェック
+    debug_print("start checking argments.")
+    if len(argvs) <= 4:
+        error_exit(1, "number of args is less than expected. [main]")
+
+    out_file = str(argvs[1])
+    codes = [str(x) for x in argvs[4:]]
+    if os.path.splitext(out_file)[1].lower() not in matrix_formats:
+        error_exit(1, "output format is incorrect. [main]")
+    try:
+        start_date = wg.datetime_parser(str(argvs[2]))
+        end_date = wg.datetime_parser(str(argvs[3]))
+    except:
+        error_exit(1, "start_date/end_date is incorrect. [main]")
+    if start_date > end_date:
+        error_exit(1, "start_date is later than end_date. [main]")
+    debug_print("end checking argments.")
+
+    debug_print("start building matrix.")
+    try:
+        matrix = build_matrix(codes, str(argvs[2]), str(argvs[3]))
+    except KeyError:
+        error_exit(1, "station not found. trace: "
+                   + traceback.format_exc() + " [build_matrix]")
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [build_matrix]")
+    debug_print("end building matrix. shape: " + str(matrix.values.shape))
+
+    debug_print("start output file.")
+    try:
+        write_matrix(out_file, matrix)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [write_matrix]")
+    debug_print("end output file.")
+
+    debug_print("end process.")
+    os.remove(logfile)
+
+    sys.exit(0)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 気象台の一覧(area_data_temp_valid)の全ての観測所について、
+#              新しく公開された日の1時間毎の気象データを取得し、保存先
+#              (output_store.py)に追加する(夜間に定期実行する想定)
+#              - 最近の要求回数(station_demand.py)が多い観測所から順に取得
+#              - 保存先で取得済みの日は取得しない(途中で終了した場合も、
+#                再実行すると残りの観測所・日付だけを取得する)
+#              - 直近の日付(WEATHER_PREFETCH_RECENT_DAYS)は暫定の範囲として
+#                保存し、実行毎に取得し直して置き換える(昼間のweather_get.py
+#                等は、暫定の範囲も保存先から出力する)
+#              - リクエスト数の上限(WEATHER_RATE)はプロセス全体で共有し、
+#                1回の実行で取得するページ数の上限を指定できる
+#              昼間のweather_get.py等(同じWEATHER_STOREを指定)は、取得済み
+#              の日を気象庁のサイトにアクセスせずに保存先から出力する
+# arguments:
+#   argvs[1]: モードフラグ("all"、列番号) ※weather_get.pyと同じ
+#   argvs[2]: 取得する日数(終了日から遡る日数) 省略時は3
+#             (実行しなかった日があっても、次回の実行で取得するため)
+#   argvs[3]: 終了日(YYYYMMDD) 省略時は前日
+# environment:
+#   WEATHER_STORE: 保存先ディレクトリ(必須) ※output_store.pyと同じ
+#   WEATHER_PREFETCH_MAX_PAGES: 1回の実行で取得するページ数の上限
+#                               (超える観測所は次回に取得する)
+#                               既定値は0(上限なし)
+#   WEATHER_PREFETCH_RECENT_DAYS: 保存先で暫定の範囲とする直近の日数
+#                                 既定値は2(output_store.pyと同じ。直近の
+#                                 速報値は、確定後に次回以降の実行で取得し
+#                                 直す)
+#   WEATHER_DEMAND: 要求回数の記録ファイル ※station_demand.pyと同じ
+# output:
+#   保存先に weather_get.py(WEATHER_STORE指定時)と同じ形式で出力する
+
+# --基本モジュール--
+import os
+import sys
+import threading
+
+from dateutil.relativedelta import relativedelta
+
+import weather_get as wg
+from fetch_engine import fetch_map
+from output_store import OutputStore
+from output_store import default_recent_days as store_recent_days
+from station_demand import get_default_demand
+from station_registry import ensure_registry, registry_file
+from metrics import get_metrics, start_run
+
+# ログ用
+import traceback
+from logging import getLogger, StreamHandler, FileHandler, INFO, WARN
+import datetime
+cmd = "weather_prefetch"
+pid = str(os.getpid())
+logfile = "/tmp/"+cmd+"_"+pid+".log"
+logger = getLogger(cmd)
+logger.setLevel(INFO)
+arg_str = ' '.join(map(str, sys.argv))
+
+
+def setup_logger():
+    # コマンドとして実行する場合のみログファイルを作成する
+    # weather_get側の関数が出力するログも同じファイルに出力する
+    Fhandler = FileHandler(logfile)
+    Fhandler.setLevel(INFO)
+    logger.addHandler(Fhandler)
+    wg.logger.addHandler(Fhandler)
+    Shandler = StreamHandler()
+    Shandler.setLevel(WARN)
+    logger.addHandler(Shandler)
+    wg.logger.addHandler(Shandler)
+
+
+def warn_print(msg):
+    d = datetime.datetime.today()
+    logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+def debug_print(msg):
+    d = datetime.datetime.today()
+    logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+# 変数定義
+default_days = 3
+default_max_pages = 0
+default_recent_days = store_recent_days
+
+
+class PageBudget(object):
+    # 1回の実行で取得するページ数の上限(0以下は上限なし)
+
+    def __init__(self, max_pages):
+        self.max_pages = max_pages
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, pages):
+        # 上限を超えない場合はページ数を加算してTrueを返す
+        with self.lock:
+            if (self.max_pages > 0) and \
+                    (self.used + pages > self.max_pages):
+                return False
+            self.used = self.used + pages
+            return True
+
+
+# 関数定義
+def read_stations(path=registry_file):
+    # 戻り値: 一覧の順の(prec_no, block_no, ObservatoryType)のリスト
+    registry = ensure_registry(path)
+    return list(zip(registry.text("proc_no"), registry.text("block_no"),
+                    registry.types()))
+
+
+def order_stations(stations, demand=None):
+    # 最近の要求回数が多い順(同じ場合は最終要求日が新しい順、要求が無い
+    # 観測所は一覧の順)に並べ替える
+    if demand is None:
+        return list(stations)
+    scores = demand.scores()
+    return sorted(stations, key=lambda x: scores.get(x[0:2], (0, "")),
+                  reverse=True)
+
+
+def prefetch_station(store, station, mode_flag, tgt_col_s, tgt_col_a,
+                     start_datetime, end_datetime, budget):
+    # 戻り値: (結果, 取得した日数, 取得できなかった日数)
+    #   結果: "fetched"(取得した)、"done"(取得済み)、"budget"(ページ数の
+    #         上限のため次回に取得する)
+    tgt_proc_no, tgt_block_no, tgt_type = station
+    tgt_col, url1 = wg.get_type_params(tgt_type, tgt_col_s, tgt_col_a)
+    set_name = wg.store_set_name(mode_flag, tgt_col)
+    # 暫定の範囲(直近の日付)は取得し直す
+    missing = store.missing_ranges(set_name, tgt_proc_no, tgt_block_no,
+                                   start_datetime, end_datetime,
+                                   provisional=False)
+    if len(missing) == 0:
+        return "done", 0, 0
+    # 各範囲の前日のページも取得する("24時"を翌日の"0時"にするため)
+    pages = sum((tmp_end - tmp_start).days + 2
+                for tmp_start, tmp_end in missing)
+    if not budget.reserve(pages):
+        return "budget", 0, 0
+    gaps = []
+    url_str = wg.make_url_str(url1, tgt_proc_no, tgt_block_no)
+    day_cnt = wg.update_store(store, set_name, tgt_proc_no, tgt_block_no,
+                              url_str, start_datetime, end_datetime,
+                              mode_flag, tgt_col, gaps, provisional=False)
+    return "fetched", day_cnt, len(gaps)
+
+
+def prefetch_all(store, stations, mode_flag, tgt_col_s, tgt_col_a,
+                 start_datetime, end_datetime, max_pages=default_max_pages):
+    # 観測所毎の処理を並行して実行する(リクエスト数はfetch_urlで制限)
+    # 戻り値: {結果: 観測所の数}(失敗した観測所は"failed")
+    budget = PageBudget(max_pages)
+    metrics = get_metrics()
+
+    def run_station(station):
+        try:
+            with metrics.timer("prefetch_station"):
+                result, day_cnt, gap_cnt = prefetch_station(
+                    store, station, mode_flag, tgt_col_s, tgt_col_a,
+                    start_datetime, end_datetime, budget)
+        except:
+            warn_print("failed to prefetch. prec_no: " + str(station[0])
+                       + ", block_no: " + str(station[1]) + ", trace: "
+                       + traceback.format_exc())
+            return "failed"
+        if result == "fetched":
+            debug_print("prefetched. prec_no: " + str(station[0])
+                        + ", block_no: " + str(station[1]) + ", days: "
+                        + str(day_cnt) + ", missing days: " + str(gap_cnt))
+        return result
+
+    counts = {}
+    for result in fetch_map(run_station, stations):
+        counts[result] = counts.get(result, 0) + 1
+        metrics.add("prefetch_" + result)
+    return counts
+
+
+# main処理
+if __name__ == '__main__':
+
+    setup_logger()
+    start_run(cmd)
+
+    # 引数取得
+    argvs = sys.argv
+
+    # ログ関数生成
+    def error_exit(code, msg):
+        d = datetime.datetime.today()
+        logger.error(d.strftime("%Y-%m-%d %H:%M:%S")+" ERROR "+cmd+" - "
+                     + str(msg)+" command: "+arg_str)
+        logfile2 = \
+            "/var/log/"+cmd+"_"+d.strftime("%Y%m%d%H%M%S")+"_"+pid+".log"
+        os.rename(logfile, logfile2)
+        sys.exit(code)
+
+    debug_print("start process.")
+
+    # 引数チェック
+    debug_print("start checking argments.")
+    if len(argvs) <= 1:
+        error_exit(1, "number of args is less than expected. [main]")
+
+    try:
+        mode_flag = str(argvs[1])
+        days = default_days
+        end_datetime = wg.datetime_parser(str(
+            datetime.date.today() - datetime.timedelta(days=1)))
+        tgt_col_s = 1
+        tgt_col_a = 1
+        if len(argvs) > 2:
+            days = int(argvs[2])
+        if len(argvs) > 3:
+            end_datetime = wg.datetime_parser(str(argvs[3]))
+        if mode_flag != "all":
+            tgt_col_s = int(str(mode_flag).split(",")[0])
+            tgt_col_a = int(str(mode_flag).split(",")[1])
+    except:
+        error_exit(1, "args are incorrect. [main]")
+    if days < 1:
+        error_exit(1, "number of days is less than 1. [main]")
+    start_datetime = end_datetime - relativedelta(days=days-1)
+    store_dir = os.environ.get("WEATHER_STORE", "")
+    if store_dir == "":
+        error_exit(1, "WEATHER_STORE is not specified. [main]")
+    try:
+        max_pages = int(os.environ.get("WEATHER_PREFETCH_MAX_PAGES",
+                                       default_max_pages))
+        recent_days = int(os.environ.get("WEATHER_PREFETCH_RECENT_DAYS",
+                                         default_recent_days))
+    except:
+        error_exit(1, "WEATHER_PREFETCH_MAX_PAGES/RECENT_DAYS is incorrect."
+                   + " [main]")
+    debug_print("end checking argments.")
+
+    debug_print("start reading stations.")
+    try:
+        stations = order_stations(read_stations(), get_default_demand())
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [read_stations]")
+    debug_print("end reading stations. stations: " + str(len(stations)))
+
+    debug_print("start prefetching weather data. period: "
+                + str(start_datetime)[0:10] + " - "
+                + str(end_datetime)[0:10])
+    try:
+        store = OutputStore(store_dir,
+                            os.environ.get("WEATHER_STORE_FORMAT", "parquet"),
+                            recent_days)
+        counts = prefetch_all(store, stations, mode_flag, tgt_col_s,
+                              tgt_col_a, start_datetime, end_datetime,
+                              max_pages)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [prefetch_all]")
+    debug_print("end prefetching weather data. stations: " + str(counts))
+
+    if counts.get("budget", 0) > 0:
+        warn_print("number of stations left for the next run: "
+                   + str(counts["budget"]))
+    if counts.get("failed", 0) > 0:
+        error_exit(2, "number of failed stations: " + str(counts["failed"])
+                   + ". [main]")
+
+    debug_print("end process.")
+    os.remove(logfile)
+
+    sys.exit(0)
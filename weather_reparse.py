@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 保管したページ(page_archive.py)を気象庁のサイトにアクセスせず
+#              に読み込み直し、データ整形して保存先(output_store.py)に出力する
+#              ページの形式やデータ整形の処理を変更した場合に、全ての期間を
+#              取得し直さずに作り直すため
+#              - 観測所・年毎に、複数のプロセス(既定値はCPUの数)で並行して
+#                ページの読み込み・データ整形を行う
+#              - 保存先への書き込みはこのプロセスだけで行う(同じ日時のデータ
+#                は後から追加した方を優先するため、既存のデータを置き換える)
+#              - 保管していない日は取得できなかった日として扱い、保存先で
+#                取得済みとしない(weather_get.pyの実行時に取得する)
+# arguments:
+#   argvs[1]: モードフラグ("all"、列番号) ※weather_get.pyと同じ
+#   argvs[2]: 保存先ディレクトリのパス
+#   argvs[3]: 取得するデータの単位("hourly"、"daily"、"monthly")
+#             省略時は"hourly" ※weather_get.pyと同じ
+#   argvs[4]: プロセス数 省略時はCPUの数
+# environment:
+#   WEATHER_ARCHIVE: ページの保管先ディレクトリ(必須)
+#   WEATHER_STORE_FORMAT: 保存先の形式 ※output_store.pyと同じ
+# output:
+#   保存先に weather_get.py(WEATHER_STORE指定時)と同じ形式で出力する
+
+# --基本モジュール--
+import multiprocessing
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+
+from dateutil.relativedelta import relativedelta
+
+import weather_get as wg
+from jma_parser import parse_hourly
+from output_store import OutputStore, subtract_ranges
+from page_archive import PageArchive, read_record
+from metrics import get_metrics, start_run
+
+# ログ用
+import traceback
+from logging import getLogger, StreamHandler, FileHandler, INFO, WARN
+import datetime
+cmd = "weather_reparse"
+pid = str(os.getpid())
+logfile = "/tmp/"+cmd+"_"+pid+".log"
+logger = getLogger(cmd)
+logger.setLevel(INFO)
+arg_str = ' '.join(map(str, sys.argv))
+
+
+def setup_logger():
+    # コマンドとして実行する場合のみログファイルを作成する
+    # (子プロセスがこのモジュールをimportした場合に作成しないため)
+    # weather_get側の関数が出力するログも同じファイルに出力する
+    Fhandler = FileHandler(logfile)
+    Fhandler.setLevel(INFO)
+    logger.addHandler(Fhandler)
+    wg.logger.addHandler(Fhandler)
+    Shandler = StreamHandler()
+    Shandler.setLevel(WARN)
+    logger.addHandler(Shandler)
+    wg.logger.addHandler(Shandler)
+
+
+def warn_print(msg):
+    d = datetime.datetime.today()
+    logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+def debug_print(msg):
+    d = datetime.datetime.today()
+    logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+# 変数定義
+# ページ種別(URLのファイル名): (ObservatoryType, 単位)
+page_kinds = dict(
+    (os.path.splitext(os.path.basename(urlsplit(url1).path))[0], key)
+    for key, url1 in wg.type_params.items())
+
+
+# 関数定義
+def period_end(date_str, resolution="hourly"):
+    # ページの日付から、そのページに含まれる最後の日
+    tmp_datetime = wg.datetime_parser(date_str)
+    if resolution == "daily":
+        return tmp_datetime + relativedelta(day=31)
+    if resolution == "monthly":
+        return tmp_datetime + relativedelta(month=12, day=31)
+    return tmp_datetime
+
+
+def make_jobs(archive, resolution, mode_flag, tgt_col_s, tgt_col_a):
+    # 観測所・年毎のジョブのリスト
+    # ジョブ: (prec_no, block_no, 年, 単位, mode_flag, tgt_col, ページの
+    #         位置のリスト)。1時間毎の場合は前年の最終日のページを含む
+    kinds = [kind for kind, key in page_kinds.items()
+             if key[1] == resolution]
+    jobs = []
+    for kind, prec_no, block_no, year in archive.shards(kinds):
+        tgt_col = tgt_col_s if page_kinds[kind][0] == "s" else tgt_col_a
+        start = year + "-01-01"
+        if resolution == "hourly":
+            start = str(int(year) - 1) + "-12-31"
+        entries = archive.entries(kind, prec_no, block_no, start,
+                                  year + "-12-31")
+        jobs.append((prec_no, block_no, year, resolution, mode_flag, tgt_col,
+                     [(x.date, x.path, x.offset, x.size) for x in entries]))
+    return jobs
+
+
+def reparse_shard(job):
+    # 子プロセスで実行する(ページの読み込み・データ整形)
+    # 戻り値: (prec_no, block_no, 年, tgt_col, [(開始日, 終了日, 気象データ,
+    #         品質情報), ...], 保管していない日のリスト, ページ数, 秒)
+    #         例外の場合は、最後の要素をトレースバック(文字列)とする
+    prec_no, block_no, year, resolution, mode_flag, tgt_col, entries = job
+    tmp_time = time.perf_counter()
+    try:
+        pages = dict((x[0], x[1:]) for x in entries)
+        dates = [x[0] for x in entries if x[0][0:4] == year]
+        start_datetime = wg.datetime_parser(dates[0])
+        end_datetime = period_end(dates[-1], resolution)
+        tgt_datetimes = wg.page_datetimes(start_datetime, end_datetime,
+                                          resolution)
+        gaps = []
+        tables = []
+        for tmp_datetime in tgt_datetimes:
+            tmp_date = str(tmp_datetime)[0:10]
+            if tmp_date not in pages:
+                gaps.append(tmp_date)
+                tables.append(wg.gap_table(tmp_datetime, resolution))
+                continue
+            body = read_record(*pages[tmp_date])[1]
+            tables.append(parse_hourly(body.decode("utf-8")))
+        cols = None if mode_flag == "all" else [tgt_col]
+        stack = wg.stack_days(tables, [str(x)[0:10] for x in tgt_datetimes],
+                              cols)
+        results = []
+        for ok_start, ok_end in subtract_ranges(
+                start_datetime.date(), end_datetime.date(),
+                wg.gap_ranges(gaps, resolution)):
+            out_data, flag_data = wg.process_data(
+                stack, str(ok_start), str(ok_end), mode_flag, resolution,
+                day_end=True)
+            results.append((ok_start, ok_end, out_data, flag_data))
+        return (prec_no, block_no, year, tgt_col, results, gaps,
+                len(entries), time.perf_counter() - tmp_time)
+    except:
+        return (prec_no, block_no, year, tgt_col, None, None, len(entries),
+                traceback.format_exc())
+
+
+def reparse_archive(archive, store, mode_flag, tgt_col_s, tgt_col_a,
+                    resolution="hourly", processes=None):
+    # 戻り値: (処理した観測所・年の数, 失敗した観測所・年の数)
+    metrics = get_metrics()
+    jobs = make_jobs(archive, resolution, mode_flag, tgt_col_s, tgt_col_a)
+    debug_print("shards: " + str(len(jobs)))
+    done_cnt = 0
+    err_cnt = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for prec_no, block_no, year, tgt_col, results, gaps, page_cnt, \
+                tmp_time in pool.imap_unordered(reparse_shard, jobs):
+            if results is None:
+                warn_print("failed to reparse. prec_no: " + str(prec_no)
+                           + ", block_no: " + str(block_no) + ", year: "
+                           + year + ", trace: " + tmp_time)
+                err_cnt = err_cnt + 1
+                continue
+            metrics.observe("reparse", tmp_time)
+            metrics.add("reparse_pages", page_cnt)
+            metrics.add("gap_days", len(gaps))
+            set_name = wg.store_set_name(mode_flag, tgt_col, resolution)
+            for ok_start, ok_end, out_data, flag_data in results:
+                with metrics.timer("write"):
+                    store.append(set_name, prec_no, block_no, out_data,
+                                 ok_start, ok_end, flag_data=flag_data)
+            done_cnt = done_cnt + 1
+            debug_print("reparsed. prec_no: " + str(prec_no)
+                        + ", block_no: " + str(block_no) + ", year: " + year
+                        + ", pages: " + str(page_cnt) + ", missing days: "
+                        + str(len(gaps)))
+    finally:
+        pool.close()
+        pool.join()
+    return done_cnt, err_cnt
+
+
+# main処理
+if __name__ == '__main__':
+
+    setup_logger()
+    start_run(cmd)
+
+    # 引数取得
+    argvs = sys.argv
+
+    # ログ関数生成
+    def error_exit(code, msg):
+        d = datetime.datetime.today()
+        logger.error(d.strftime("%Y-%m-%d %H:%M:%S")+" ERROR "+cmd+" - "
+                     + str(msg)+" command: "+arg_str)
+        logfile2 = \
+            "/var/log/"+cmd+"_"+d.strftime("%Y%m%d%H%M%S")+"_"+pid+".log"
+        os.rename(logfile, logfile2)
+        sys.exit(code)
+
+    debug_print("start process.")
+
+    # 引数チェック
+    debug_print("start checking argments.")
+    if len(argvs) <= 2:
+        error_exit(1, "number of args is less than expected. [main]")
+
+    try:
+        mode_flag = str(argvs[1])
+        store_dir = str(argvs[2])
+        resolution = "hourly"
+        processes = None
+        tgt_col_s = 1
+        tgt_col_a = 1
+        if len(argvs) > 3:
+            resolution = str(argvs[3])
+        if len(argvs) > 4:
+            processes = int(argvs[4])
+        if mode_flag != "all":
+            tgt_col_s = int(str(mode_flag).split(",")[0])
+            tgt_col_a = int(str(mode_flag).split(",")[1])
+    except:
+        error_exit(1, "args are incorrect. [main]")
+    if resolution not in wg.resolutions:
+        error_exit(1, "resolution is incorrect: " + resolution + ". [main]")
+    if (processes is not None) and (processes < 1):
+        error_exit(1, "number of processes is less than 1. [main]")
+    archive_dir = os.environ.get("WEATHER_ARCHIVE", "")
+    if not os.path.isdir(archive_dir):
+        error_exit(1, "WEATHER_ARCHIVE is not a directory: " + archive_dir
+                   + ". [main]")
+    debug_print("end checking argments.")
+
+    debug_print("start reparsing archive.")
+    try:
+        archive = PageArchive(archive_dir)
+        store = OutputStore(store_dir, os.environ.get("WEATHER_STORE_FORMAT",
+                                                      "parquet"))
+        done_cnt, err_cnt = reparse_archive(archive, store, mode_flag,
+                                            tgt_col_s, tgt_col_a, resolution,
+                                            processes)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [reparse_archive]")
+    debug_print("end reparsing archive. shards: " + str(done_cnt))
+
+    if err_cnt > 0:
+        error_exit(2, "number of failed shards: " + str(err_cnt) + ". [main]")
+
+    debug_print("end process.")
+    os.remove(logfile)
+
+    sys.exit(0)
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+#
+# discription: 観測所の検索・気象データの取得を、HTTP(JSON)で受け付ける常駐
+#              サーバ
+#              観測所の一覧・郵便番号の索引・ページのキャッシュは起動時に読み
+#              込み、以降のリクエストで共有する(リクエスト毎の起動・読み込み
+#              が不要)。リクエストはスレッド毎に並行して処理し、同じページを
+#              同時に要求された場合は1回だけ取得する
+# arguments:
+#   argvs[1]: 待ち受けるポート番号
+#   argvs[2]: 待ち受けるアドレス 省略時は"127.0.0.1"
+# requests:
+#   GET /nearest?postal=<郵便番号>[&k=<件数>]
+#   GET /nearest?lat=<緯度>&lng=<経度>[&k=<件数>]
+#     最寄りの観測所(近い順にk件、既定値は1件)
+#   GET /hourly?station=<block_no>&start=<YYYYMMDD>&end=<YYYYMMDD>
+#              [&prec_no=<prec_no>][&col=<列番号>]
+#     1時間単位の気象データ(colを省略した場合は全ての列)
+#     月毎に取得して、取得した分から順に返す
+#   GET /metrics
+#     起動してからの処理の段階毎の所要時間・件数(Prometheusのテキスト形式)
+# output:
+#   JSON(UTF-8)。エラー時は {"error": メッセージ}
+#   (400: 引数の誤り、404: 観測所・郵便番号が無い、502: 取得の失敗)
+
+# --基本モジュール--
+import numpy as np
+import json
+import os
+import sys
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+import weather_api
+import weather_get as wg
+from postal_geocoder import load_postal_geocoder
+from page_cache import get_default_cache
+from metrics import get_metrics, start_run
+
+# ログ用
+import traceback
+from logging import getLogger, StreamHandler, FileHandler, INFO, WARN
+import datetime
+cmd = "weather_server"
+pid = str(os.getpid())
+logfile = "/tmp/"+cmd+"_"+pid+".log"
+logger = getLogger(cmd)
+logger.setLevel(INFO)
+arg_str = ' '.join(map(str, sys.argv))
+
+
+def setup_logger():
+    # コマンドとして実行する場合のみログファイルを作成する
+    # weather_get側の関数が出力するログも同じファイルに出力する
+    Fhandler = FileHandler(logfile)
+    Fhandler.setLevel(INFO)
+    logger.addHandler(Fhandler)
+    wg.logger.addHandler(Fhandler)
+    Shandler = StreamHandler()
+    Shandler.setLevel(WARN)
+    logger.addHandler(Shandler)
+    wg.logger.addHandler(Shandler)
+
+
+def warn_print(msg):
+    d = datetime.datetime.today()
+    logger.warn(d.strftime("%Y-%m-%d %H:%M:%S")+" WARN "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+def debug_print(msg):
+    d = datetime.datetime.today()
+    logger.info(d.strftime("%Y-%m-%d %H:%M:%S")+" INFO "+cmd+" - "
+                + str(msg)+" command: "+arg_str)
+
+
+# 変数定義
+default_host = "127.0.0.1"
+time_col = "日時"
+
+
+class QueryError(Exception):
+    # リクエストの誤り(statusはHTTPのステータスコード)
+
+    def __init__(self, status, msg):
+        Exception.__init__(self, msg)
+        self.status = status
+
+
+# 関数定義
+def get_param(query, name, default=None):
+    values = query.get(name)
+    if not values:
+        if default is None:
+            raise QueryError(400, "parameter is required: " + name)
+        return default
+    return values[0]
+
+
+def station_record(station):
+    # 観測所(Series)をJSONに変換できるdictにする
+    record = {}
+    for key, value in station.items():
+        if key == "緯度_経度":
+            record["lat"], record["lng"] = float(value[0]), float(value[1])
+        elif isinstance(value, np.generic):
+            record[key] = value.item()
+        else:
+            record[key] = value
+    return record
+
+
+def frame_rows(out_data):
+    # 気象データ(DataFrame)を行のリストにする
+    # 日時は"YYYY-MM-DD HH:MM:SS"、欠測(NaN)はnull
+    times = out_data[time_col].dt.strftime("%Y-%m-%d %H:%M:%S").tolist()
+    cols = [out_data[col].astype(object).where(out_data[col].notnull(),
+                                               None).tolist()
+            for col in out_data.columns[1:]]
+    return [[tmp_time] + [col[i] for col in cols]
+            for i, tmp_time in enumerate(times)]
+
+
+def query_nearest(query):
+    k = get_param(query, "k", "1")
+    try:
+        k = int(k)
+    except ValueError:
+        raise QueryError(400, "k is incorrect: " + k)
+    if k < 1:
+        raise QueryError(400, "k is less than 1.")
+    out = {}
+    if "postal" in query:
+        post_num = get_param(query, "postal")
+        if (len(post_num) != 7) or (not post_num.isdigit()):
+            raise QueryError(400, "postal is incorrect: " + post_num)
+        try:
+            out["post_num"], lat, lng = wg.geocode_retry(post_num)
+        except KeyError:
+            raise QueryError(404, "post_num not found: " + post_num)
+    else:
+        try:
+            lat = float(get_param(query, "lat"))
+            lng = float(get_param(query, "lng"))
+        except ValueError:
+            raise QueryError(400, "lat/lng is incorrect.")
+    out["lat"], out["lng"] = lat, lng
+    stations = weather_api.nearest_station(lat, lng, k)
+    out["stations"] = [station_record(station)
+                       for _, station in stations.iterrows()]
+    return out
+
+
+def iter_query_hourly(query):
+    # 戻り値: (観測所, 月毎の気象データのジェネレータ)
+    block_no = get_param(query, "station")
+    proc_no = query.get("prec_no", [None])[0]
+    start = get_param(query, "start")
+    end = get_param(query, "end")
+    try:
+        start = wg.datetime_parser(start)
+        end = wg.datetime_parser(end)
+    except (ValueError, OverflowError):
+        raise QueryError(400, "start/end is incorrect.")
+    if start > end:
+        raise QueryError(400, "start is later than end.")
+    mode = get_param(query, "col", "all")
+    if mode != "all":
+        try:
+            mode = int(mode)
+        except ValueError:
+            raise QueryError(400, "col is incorrect: " + mode)
+    try:
+        station = weather_api.find_station(block_no, proc_no)
+    except KeyError:
+        raise QueryError(404, "station not found: " + block_no)
+    return station, weather_api.iter_hourly(station, start, end, mode,
+                                            chunk="month")
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WeatherHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        debug_print(self.address_string() + " " + (format % args))
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path == "/nearest":
+                self.send_json(200, query_nearest(query))
+            elif url.path == "/hourly":
+                self.send_hourly(query)
+            elif url.path == "/metrics":
+                self.send_metrics()
+            else:
+                raise QueryError(404, "unknown path: " + url.path)
+        except QueryError as e:
+            self.send_json(e.status, {"error": str(e)})
+        except:
+            warn_print("failed to process request: " + self.path
+                       + " trace: " + traceback.format_exc())
+            self.send_json(502, {"error": "failed to get data."})
+
+    def send_metrics(self):
+        body = get_metrics().prometheus_text(cmd).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_hourly(self, query):
+        # 1か月目を取得できてから応答を始め、以降は月毎に書き込む
+        # (期間が長くても、サーバのメモリ使用量は1か月分)
+        station, chunks = iter_query_hourly(query)
+        out_data = next(chunks)
+        head = json.dumps({"station": station_record(station),
+                           "columns": [str(col) for col in out_data.columns]},
+                          ensure_ascii=False)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        self.wfile.write((head[:-1] + ', "data": [').encode("utf-8"))
+        sep = ""
+        try:
+            while out_data is not None:
+                for row in frame_rows(out_data):
+                    line = sep + json.dumps(row, ensure_ascii=False)
+                    self.wfile.write(line.encode("utf-8"))
+                    sep = ", "
+                out_data = next(chunks, None)
+        except:
+            # 応答の途中で失敗した場合は、JSONを閉じずに接続を切る
+            warn_print("failed to get data: " + self.path + " trace: "
+                       + traceback.format_exc())
+            return
+        self.wfile.write(b"]}")
+
+
+def warm_up():
+    # 観測所の一覧・郵便番号の索引・キャッシュを読み込んでおく
+    weather_api.load_registry()
+    load_postal_geocoder()
+    get_default_cache()
+
+
+# main処理
+if __name__ == '__main__':
+
+    setup_logger()
+    start_run(cmd)
+
+    # 引数取得
+    argvs = sys.argv
+
+    # ログ関数生成
+    def error_exit(code, msg):
+        d = datetime.datetime.today()
+        logger.error(d.strftime("%Y-%m-%d %H:%M:%S")+" ERROR "+cmd+" - "
+                     + str(msg)+" command: "+arg_str)
+        logfile2 = \
+            "/var/log/"+cmd+"_"+d.strftime("%Y%m%d%H%M%S")+"_"+pid+".log"
+        os.rename(logfile, logfile2)
+        sys.exit(code)
+
+    debug_print("start process.")
+
+    # 引数チェック
+    debug_print("start checking argments.")
+    if len(argvs) <= 1:
+        error_exit(1, "number of args is less than expected. [main]")
+
+    try:
+        port = int(argvs[1])
+        host = str(argvs[2]) if len(argvs) > 2 else default_host
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [int]")
+    debug_print("end checking argments.")
+
+    debug_print("start loading data.")
+    try:
+        warm_up()
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [warm_up]")
+    debug_print("end loading data.")
+
+    try:
+        server = ThreadingHTTPServer((host, port), WeatherHandler)
+    except:
+        error_exit(2, "function error. trace: "
+                   + traceback.format_exc() + " [HTTPServer]")
+    debug_print("start serving. " + host + ":" + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+    debug_print("end process.")
+    os.remove(logfile)
+
+    sys.exit(0)